@@ -34,18 +34,23 @@ class ChatDataProcesser:
         self.complete_persona = complete_persona
         self.limit_length = limit_length
 
-    def get_examples(self, path, mode):
+    def get_examples(self, path, mode, shard_id=0, num_shards=1, byte_range=None):
+        """shard_id, num_shards: only yield examples of lines i % num_shards == shard_id
+        byte_range: only read the lines in it, from utils.split_file
+        """
         file_path = os.path.join(path, mode + '.txt')
         parse_loc = lambda x: x != '' and ' '.join(x) or UNK
         parse_gender = lambda x: '男' if x == 'male' else ('女' if x == 'female' else UNK)
         parse_tag = lambda x: x and ' '.join(x.replace(';', '')) or UNK
 
-        with open(file_path) as f:
+        with open(file_path, 'rb') as f:
             cnt = 0
-            for line in f:
+            for line in utils.read_lines(f, byte_range):
                 if self.limit_length is not None and cnt == self.limit_length:
                     break
                 cnt += 1
+                if (cnt - 1) % num_shards != shard_id:
+                    continue
 
                 obj = json.loads(line)
                 dialogs = obj['dialog']
@@ -205,14 +210,16 @@ class ChatFeature:
     resp_pad_mask: Tensor
     persona_pad_mask: Tensor
 
+    # None for inference batches
     lm: LMFeature
 
 
 # https://pytorch.org/tutorials/beginner/text_sentiment_ngrams_tutorial.html?highlight=collate_fn
-def generate_batch(batch, pad_idx):
+def generate_batch(batch, pad_idx, with_lm=True):
+    """with_lm: False for inference batches, feature.lm will be None"""
     context, segs, personas_no_tag, tags, resp, persona, lm = zip(*batch)
 
-    fn = lambda x: list(map(torch.tensor, x)) 
+    fn = lambda x: [torch.tensor(v, dtype=torch.long) for v in x]
     context_pad = pad_sequence(fn(context), padding_value=pad_idx)
     segs_pad = pad_sequence(fn(segs), padding_value=pad_idx)
     tags = itertools.chain(*tags)
@@ -230,7 +237,10 @@ def generate_batch(batch, pad_idx):
     # n_persona X batch_size X 2 --> 2 X n_persona X batch_size
     personas_no_tag_pad = pad_sequence(tmp, padding_value=pad_idx).permute(2, 0, 1) 
 
-    lm = generate_lm_batch(lm, pad_idx, in_chat=True)
+    if with_lm:
+        lm = generate_lm_batch(lm, pad_idx, in_chat=True)
+    else:
+        lm = None
 
     return ChatFeature(
             context=context_pad,
@@ -252,9 +262,9 @@ def generate_batch(batch, pad_idx):
 
 def generate_lm_batch(batch, pad_idx, in_chat=False):
     if not in_chat:
-        batch = torch.tensor(batch).T
+        batch = torch.stack([torch.tensor(v, dtype=torch.long) for v in batch]).T
     else:
-        batch = pad_sequence(list(map(torch.tensor, batch)) , padding_value=pad_idx)
+        batch = pad_sequence([torch.tensor(v, dtype=torch.long) for v in batch] , padding_value=pad_idx)
     x = batch[:-1]
     y = batch[1:]
     x_mask = utils.generate_square_subsequent_mask(x.shape[0])
@@ -263,6 +273,25 @@ def generate_lm_batch(batch, pad_idx, in_chat=False):
     return LMFeature(x=x, y=y, x_mask=x_mask, x_pad_mask=x_pad_mask)
 
 
+class ChatCollate:
+    """Picklable collate_fn of generate_batch for DataLoader workers"""
+    def __init__(self, pad_idx, with_lm=True):
+        self.pad_idx = pad_idx
+        self.with_lm = with_lm
+
+    def __call__(self, batch):
+        return generate_batch(batch, self.pad_idx, self.with_lm)
+
+
+class LMCollate:
+    """Picklable collate_fn of generate_lm_batch for DataLoader workers"""
+    def __init__(self, pad_idx):
+        self.pad_idx = pad_idx
+
+    def __call__(self, batch):
+        return generate_lm_batch(batch, self.pad_idx)
+
+
 def build_corpus(raw_fname, corpus_fname):
     datas = []
     with open(raw_fname) as f:
@@ -49,12 +49,22 @@ class Evaler:
         parser.add_argument('--seed', default=42, type=int, required=False, help='')
         parser.add_argument('--batch_size', default=128, type=int, required=False, help='')
         parser.add_argument('--limit_example_length', default=256, type=int, required=False, help='')
+        parser.add_argument('--num_workers', default=0, type=int, required=False, 
+                help='DataLoader worker processes')
+        parser.add_argument('--prefetch_factor', default=2, type=int, required=False, 
+                help='Batches loaded in advance by each worker')
+        parser.add_argument('--persistent_workers', action='store_true', required=False, 
+                help='Keep DataLoader workers between epochs')
+        parser.add_argument('--background_prefetch', action='store_true', required=False, 
+                help='Load batches in a background thread with utils.DataLoaderX')
 
         parser.add_argument('--min_seq_length', default=10, type=int, required=False, help='')
         parser.add_argument('--temperature', default=0.7, type=float, required=False, help='Sampling softmax temperature')
         parser.add_argument('--top_k', default=0, type=int, required=False, help='Filter top-k tokens before sampling (<=0: no filtering)')
         parser.add_argument('--top_p', default=0.9, type=float, required=False, help='Nucleus filtering (top-p) before sampling (<=0.0: no filtering)')
         parser.add_argument('--no_sample', action='store_true', required=False, help='')
+        parser.add_argument('--beam_size', default=1, type=int, required=False, help='Beam search if > 1, else sampling')
+        parser.add_argument('--length_penalty', default=1.0, type=float, required=False, help='Beam search length penalty alpha (0: no penalty)')
 
         parser.add_argument('--pretrained_fname', default='models/model__epoch1/', type=str, required=False, help='')
         parser.add_argument('--data_path', default='datas/', type=str, required=False, help='')
@@ -82,7 +92,9 @@ class Evaler:
     def build_dataloaders(self):
         args = self.args
         model_config = self.model_config
-        gb = lambda batch: datasets.generate_batch(batch, self.pad_idx)
+        # LM feature only for the auxiliary loss, 
+        # sample_sequence and beam_search decode from the encoder state without it
+        gb = datasets.ChatCollate(self.pad_idx)
 
         dp = datasets.ChatDataProcesser(limit_length=args.limit_example_length, 
                 max_seq_length=args.max_seq_length, 
@@ -92,7 +104,7 @@ class Evaler:
                 self.vocab, model_config.max_seq_length, args.limit_example_length, 
                 data_path=args.data_path, cache_path=args.cache_path, 
                 data_processer=dp, mode='test_char')
-        self.test_iter = DataLoader(ds, batch_size=args.batch_size,
+        self.test_iter = utils.build_dataloader(ds, args, batch_size=args.batch_size,
                 collate_fn=gb, shuffle=False)
     
     def build_model(self):
@@ -123,7 +135,9 @@ class Evaler:
             for batch_idx, feature in enumerate(self.test_iter):
                 utils.feature_to_device(feature, self.device)
 
-                out, out_lm = self.model(feature)
+                # encode once for loss and sample_sequence
+                state = self.model.encode_state(feature)
+                out, out_lm = self.model(feature, state)
                 print(self.vocab.itos(out[3, 0].argmax(dim=0).item()), 
                         self.vocab.itos(out_lm[3, 0].argmax(dim=0).item()))
                 loss, loss_lm = models.AR.loss(self.out_loss_fn, out, out_lm, feature.resp, feature.lm.y)
@@ -133,8 +147,12 @@ class Evaler:
 
                 # target include w1, w2...[EOS], len: max_seq_length + 1
                 target = copy.deepcopy(feature.resp[1:])
-                # feature will be changed
-                pred, pred_padded = utils.sample_sequence(feature, self.vocab, self.model, self.args)
+                if self.args.beam_size > 1:
+                    pred, pred_padded = utils.beam_search(feature, self.vocab,
+                            self.model, self.args, state=state)
+                else:
+                    pred, pred_padded = utils.sample_sequence(feature, self.vocab, 
+                            self.model, self.args, state=state)
 
                 pred_tokens = [[self.vocab.itos(k) for k in ks]
                                for ks in pred]
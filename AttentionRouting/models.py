@@ -36,12 +36,57 @@ class AR(nn.Module):
         self._share_encoder_decoder()
         utils.xavier_init_weights(self)
 
-    def forward(self, feature):
-        context_enc, persona_enc = self.encode(feature)
+    def forward(self, feature, state=None):
+        """state: encode_state(feature) result, skip encoding if given
+
+        The auxiliary LM branch is skipped (out_lm is None) when feature.lm is None,
+        use encode_state and decode_step for generation.
+        """
+        if state is None:
+            context_enc, persona_enc = self.encode(feature)
+        else:
+            context_enc, persona_enc = state.context_enc, state.persona_enc
         out = self.decode(feature, context_enc, persona_enc)
 
         return out
 
+    def encode_state(self, feature):
+        """Encode context and persona once for decode_step"""
+        context_enc, persona_enc = self.encode(feature)
+
+        return utils.EncoderState(
+                context_enc=context_enc,
+                persona_enc=persona_enc,
+                context_pad_mask=feature.context_pad_mask,
+                persona_pad_mask=feature.persona_pad_mask,
+                cache=self.resp_decoder.init_cache(),
+        )
+
+    def decode_step(self, state, resp, resp_pad_mask, resp_mask=None):
+        """Incremental decoding with state from encode_state
+
+        Args:
+            resp: positions after state.cache.step, the earlier positions are in cache
+            resp_pad_mask: pad mask of all positions
+            resp_mask: subsequent mask rows of resp, can be None if resp is one position
+
+        Shape:
+            resp: new_len X batch_size
+            resp_pad_mask: batch_size X total_len
+            resp_mask: new_len X total_len
+            output: new_len X batch_size X output_dim
+        """
+        start_pos = state.cache.step
+        resp_enc = self.output_emb(resp, start_pos)
+        out = self.resp_decoder(resp_enc, state.context_enc, state.persona_enc, 
+                memory_key_padding_mask=state.context_pad_mask, 
+                tgt_mask=resp_mask, 
+                tgt_key_padding_mask=resp_pad_mask, 
+                persona_pad_mask=state.persona_pad_mask,
+                cache=state.cache) 
+
+        return self.generate(out)
+
     def encode(self, feature):
         context_emb = self.context_emb(feature)
         persona_emb = self.persona_emb(feature.persona)
@@ -59,6 +104,10 @@ class AR(nn.Module):
                 tgt_key_padding_mask=feature.resp_pad_mask, 
                 persona_pad_mask=feature.persona_pad_mask) 
 
+        # no LM feature for inference batches
+        if feature.lm is None:
+            return self.generate(out), None
+
         enc_lm = self.output_emb(feature.lm.x)
         out_lm = self.resp_decoder(enc_lm, tgt_mask=feature.lm.x_mask,
                 tgt_key_padding_mask=feature.lm.x_pad_mask) 
@@ -128,7 +177,9 @@ class AR(nn.Module):
     @staticmethod
     def loss(loss_fn, out, out_lm, resp, lm_y):
         loss = loss_fn(out[:-1].view(-1, out.shape[-1]), resp[1:].view(-1))
-        loss_lm = loss_fn(out_lm.view(-1, out.shape[-1]), lm_y.view(-1))
+        loss_lm = None
+        if out_lm is not None:
+            loss_lm = loss_fn(out_lm.view(-1, out.shape[-1]), lm_y.view(-1))
 
         return loss, loss_lm
 
@@ -109,9 +109,10 @@ class OutputEmb(nn.Module):
         self.pos_encoder = utils.PositionalEncoding(emb_dim)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, output):
+    def forward(self, output, start_pos=0):
+        """start_pos: position of output[0], for incremental decoding"""
         emb = self.emb(output) * math.sqrt(self.emb_dim)
-        emb = self.dropout(emb + self.pos_encoder(emb))
+        emb = self.dropout(emb + self.pos_encoder(emb, start_pos))
 
         return emb                
  
@@ -157,7 +158,8 @@ class TransformerEncoderLayer(nn.Module):
 
         self.activation = nn.modules.transformer._get_activation_fn(activation)
 
-    def forward(self, src, src_mask=None, src_key_padding_mask=None):
+    def forward(self, src, src_mask=None, src_key_padding_mask=None, is_causal=False):
+        # is_causal is passed by nn.TransformerEncoder of torch >= 2.0, src_mask has the mask
         src = self.norm2(src)
         src2 = self.self_attn(src, src, src, attn_mask=src_mask,
                               key_padding_mask=src_key_padding_mask)[0]
@@ -193,22 +195,32 @@ class TransformerDecoderLayer(nn.Module):
 
         self.activation = nn.modules.transformer._get_activation_fn(activation)
 
+    def _attn(self, query, key, cache=None, cache_key=None,
+            attn_mask=None, key_padding_mask=None):
+        if cache is None:
+            return self.multihead_attn(query, key, key, attn_mask=attn_mask,
+                                  key_padding_mask=key_padding_mask)[0]
+        # incremental decoding, query and self attention key are the new positions only
+        return utils.cached_multihead_attn(self.multihead_attn, query, key, 
+                cache, cache_key, attn_mask=attn_mask, 
+                key_padding_mask=key_padding_mask, static=cache_key != 'prev')
+
     def forward(self, tgt, memory, persona,
             tgt_mask=None, memory_mask=None,
             tgt_key_padding_mask=None, memory_key_padding_mask=None,
-            persona_pad_mask=None):
+            persona_pad_mask=None, cache=None):
         tgt = self.norm2(tgt)
 
         if True:
             attn_t = 0
             attn_c = 0
-            attn_prev = self.multihead_attn(tgt, tgt, tgt, attn_mask=tgt_mask,
-                                  key_padding_mask=tgt_key_padding_mask)[0]
+            attn_prev = self._attn(tgt, tgt, cache, 'prev', attn_mask=tgt_mask,
+                                  key_padding_mask=tgt_key_padding_mask)
             if persona is not None and memory is not None:
-                attn_t = self.multihead_attn(tgt, persona, persona, 
-                        key_padding_mask=persona_pad_mask)[0]
-                attn_c = self.multihead_attn(tgt, memory, memory, attn_mask=memory_mask, 
-                        key_padding_mask=memory_key_padding_mask)[0]
+                attn_t = self._attn(tgt, persona, cache, 'persona',
+                        key_padding_mask=persona_pad_mask)
+                attn_c = self._attn(tgt, memory, cache, 'memory', attn_mask=memory_mask, 
+                        key_padding_mask=memory_key_padding_mask)
             alpha = self.cls(memory) if self.attn_alpha is None else self.attn_alpha 
             attn_merge = alpha*attn_t + (1-alpha)*attn_c + attn_c + attn_prev
             attn_merge = tgt + self.dropout(attn_merge)
@@ -246,8 +258,12 @@ class TransformerDecoder(nn.Module):
     def forward(self, tgt, memory=None, persona=None, 
             memory_mask=None, memory_key_padding_mask=None,
             tgt_mask=None, tgt_key_padding_mask=None,
-            persona_pad_mask=None):
-        """Train language model When memory and persona is None"""
+            persona_pad_mask=None, cache=None):
+        """Train language model When memory and persona is None
+
+        When cache (from init_cache) is given, tgt is only the positions 
+        after cache.step, tgt_mask and tgt_key_padding_mask cover all positions.
+        """
         output = tgt
 
         for i in range(self.num_layers):
@@ -255,13 +271,20 @@ class TransformerDecoder(nn.Module):
                                     memory_mask=memory_mask, persona=persona,
                                     tgt_key_padding_mask=tgt_key_padding_mask,
                                     memory_key_padding_mask=memory_key_padding_mask,
-                                    persona_pad_mask=persona_pad_mask)
+                                    persona_pad_mask=persona_pad_mask,
+                                    cache=None if cache is None else cache[i])
 
         if self.norm:
             output = self.norm(output)
 
+        if cache is not None:
+            cache.step += tgt.shape[0]
+
         return output
 
+    def init_cache(self):
+        return utils.DecoderCache(self.num_layers)
+
 
 class Generater(nn.Module):
     def __init__(
@@ -0,0 +1,90 @@
+"""Shared helpers of the AttentionRouting tests
+
+AttentionRoutingPlus has modules of the same names (modules, models, datasets),
+the modules of this package are imported once here and put back into
+sys.modules by conftest before every test.
+"""
+import os
+import sys
+import random
+import types
+
+PKG_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOT = os.path.dirname(PKG_DIR)
+NAMES = ('utils', 'modules', 'models', 'datasets')
+
+
+def _import_modules():
+    for name in NAMES:
+        sys.modules.pop(name, None)
+    sys.path[:0] = [PKG_DIR, ROOT]
+    try:
+        import utils, modules, models, datasets
+    finally:
+        del sys.path[:2]
+    return {name: sys.modules[name] for name in NAMES}
+
+
+MODULES = _import_modules()
+utils = MODULES['utils']
+modules = MODULES['modules']
+models = MODULES['models']
+datasets = MODULES['datasets']
+
+
+def use_modules():
+    sys.modules.update(MODULES)
+
+
+class FakeVocab:
+    """n words and the special tokens, pad is utils.PAD"""
+    def __init__(self, n=50):
+        self.tokens = ['w%d' % i for i in range(n)] + utils.PRESET_SPECIAL_TOKENS
+        self.index = {k: i for i, k in enumerate(self.tokens)}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def stoi(self, s):
+        return self.index.get(s, self.index[utils.UNK])
+
+    def itos(self, i):
+        return self.tokens[i]
+
+
+def model_args(**kwargs):
+    """Small config of models.AR.build"""
+    args = types.SimpleNamespace(
+        d_model=32, emb_freeze=False, enc_dropout=0.0, dec_dropout=0.0,
+        num_layers=3, n_head=4, d_ff=64, attn_alpha=1, n_epochs_early_stage=0,
+        max_seq_length=8)
+    args.__dict__.update(kwargs)
+    return args
+
+
+def build_model(vocab, seed=0, **kwargs):
+    import torch
+    torch.manual_seed(seed)
+    return models.AR.build(model_args(**kwargs), len(vocab), len(vocab), vocab)
+
+
+def chat_examples(vocab, n, max_len=8, seed=0):
+    """Features of n random chat examples, as ChatDataProcesser.convert_examples_to_features"""
+    rnd = random.Random(seed)
+    words = range(40)
+    sep, spe1, spe2 = vocab.stoi(utils.SEP), vocab.stoi(utils.SPE1), vocab.stoi(utils.SPE2)
+    examples = []
+    for _ in range(n):
+        n_posts = rnd.choice([1, 3, 5])
+        posts = [[rnd.choice(words) for _ in range(rnd.randint(1, max_len))] + [sep]
+                for _ in range(n_posts)]
+        segs = []
+        for i in range(0, n_posts, 2):
+            segs += [spe1] * len(posts[i]) + ([spe2] * len(posts[i+1]) if i+1 < n_posts else [])
+        personas_no_tag = [[rnd.choice(words) for _ in range(rnd.randint(2, 3))] for _ in range(2)]
+        tags = [[rnd.choice(words) for _ in range(rnd.randint(1, 4))] for _ in range(2)]
+        resp = [vocab.stoi(utils.SOS)] + [rnd.choice(words)
+                for _ in range(rnd.randint(1, max_len))] + [vocab.stoi(utils.EOS)]
+        persona = [rnd.choice(words) for _ in range(rnd.randint(3, 7))]
+        examples.append((sum(posts, []), segs, personas_no_tag, tags, resp, persona, resp))
+    return examples
@@ -0,0 +1,8 @@
+import pytest
+
+import ar_testing
+
+
+@pytest.fixture(autouse=True)
+def package_modules():
+    ar_testing.use_modules()
@@ -0,0 +1,85 @@
+import types
+
+import torch
+
+import ar_testing
+from ar_testing import datasets, utils, FakeVocab
+
+
+def _batch(vocab, n=5, seed=0, with_lm=True):
+    examples = ar_testing.chat_examples(vocab, n, seed=seed)
+    return datasets.generate_batch(examples, vocab.stoi(utils.PAD), with_lm)
+
+
+def _assert_close_at_tokens(actual, expected, resp_pad_mask):
+    mask = ~resp_pad_mask.T.unsqueeze(2)
+    torch.testing.assert_close(actual * mask, expected * mask, rtol=1e-4, atol=1e-5)
+
+
+def test_cached_decoder_equals_full_decoder():
+    vocab = FakeVocab()
+    model = ar_testing.build_model(vocab).eval()
+    feature = _batch(vocab)
+    with torch.no_grad():
+        context_enc, persona_enc = model.encode(feature)
+        kwargs = dict(memory_key_padding_mask=feature.context_pad_mask,
+                tgt_key_padding_mask=feature.resp_pad_mask,
+                persona_pad_mask=feature.persona_pad_mask)
+        full = model.resp_decoder(model.output_emb(feature.resp), context_enc, persona_enc,
+                tgt_mask=feature.resp_mask, **kwargs)
+
+        cache = model.resp_decoder.init_cache()
+        steps = []
+        for t in range(feature.resp.shape[0]):
+            emb = model.output_emb(feature.resp[t:t+1], t)
+            steps.append(model.resp_decoder(emb, context_enc, persona_enc,
+                    cache=cache, **dict(kwargs, tgt_key_padding_mask=feature.resp_pad_mask[:, :t+1])))
+        assert cache.step == feature.resp.shape[0]
+    _assert_close_at_tokens(torch.cat(steps), full, feature.resp_pad_mask)
+
+
+def test_decode_step_equals_forward():
+    vocab = FakeVocab()
+    model = ar_testing.build_model(vocab).eval()
+    feature = _batch(vocab, with_lm=False)
+    resp, resp_pad_mask = feature.resp, feature.resp_pad_mask
+    with torch.no_grad():
+        full, _ = model(feature)
+        state = model.encode_state(feature)
+        assert torch.equal(model(feature, state)[0], full)
+
+        steps = [model.decode_step(state, resp[t:t+1], resp_pad_mask[:, :t+1])
+                for t in range(resp.shape[0])]
+        _assert_close_at_tokens(torch.cat(steps), full, resp_pad_mask)
+
+        # a prefix of several positions, then the rest
+        state = model.encode_state(feature)
+        head = model.decode_step(state, resp[:3], resp_pad_mask[:, :3], feature.resp_mask[:3, :3])
+        tail = model.decode_step(state, resp[3:], resp_pad_mask, feature.resp_mask[3:])
+    _assert_close_at_tokens(torch.cat([head, tail]), full, resp_pad_mask)
+
+
+def test_inference_batch_skips_lm():
+    vocab = FakeVocab()
+    model = ar_testing.build_model(vocab).eval()
+    feature = _batch(vocab)
+    inference = _batch(vocab, with_lm=False)
+    assert inference.lm is None
+    with torch.no_grad():
+        out, out_lm = model(feature)
+        out_inference, out_lm_inference = model(inference)
+    assert out_lm is not None and out_lm_inference is None
+    assert torch.equal(out_inference, out)
+
+
+def test_generation_does_not_read_lm():
+    vocab = FakeVocab()
+    model = ar_testing.build_model(vocab).eval()
+    args = types.SimpleNamespace(temperature=1.0, top_k=0, top_p=0.0, no_sample=True,
+            min_seq_length=2, max_seq_length=6, beam_size=2, length_penalty=1.0)
+    with torch.no_grad():
+        for decode in (utils.sample_sequence, utils.beam_search):
+            pred, pred_padded = decode(_batch(vocab), vocab, model, args)
+            expected, expected_padded = decode(_batch(vocab, with_lm=False), vocab, model, args)
+            assert pred == expected
+            assert torch.equal(pred_padded, expected_padded)
@@ -1,9 +1,11 @@
 
 import os
+import re
 import shutil
 import random
 import math
 import time
+import logging
 import argparse
 import yaml
 from collections import OrderedDict
@@ -30,14 +32,32 @@ class Trainer:
         args = self.parse_args()
         self.args = args
         self.best_valid_loss = float('inf')
+        # first epoch to train, restored by resume
+        self.start_epoch = 0
+        # distributed if launched by torchrun
+        self.rank, self.local_rank, self.world_size = utils.init_distributed(args.dist_backend)
         self.device = utils.get_device(args.device)
-        utils.set_random_seed(self.args.seed, self.device)
+        if self.device.type == 'cuda' and self.world_size > 1:
+            self.device = torch.device('cuda', self.local_rank)
+            torch.cuda.set_device(self.device)
+        # tensors of utils.all_reduce_sum, cpu for gloo
+        self.dist_device = self.device if args.dist_backend == 'nccl' else 'cpu'
+        # different dropout in processes, DDP broadcasts the model of rank 0
+        utils.set_random_seed(self.args.seed + self.rank, self.device)
 
         self.ensure_deps()
 
         self.grad_util = utils.Grads()
 
         self.logger = utils.create_logger(self.args.log_path, 'trainer')
+        if not utils.is_main_process():
+            self.logger.setLevel(logging.WARNING)
+        # the checkpoints of the runs before count in keep_checkpoints,
+        # only the ones of this experiment, other runs may share model_path
+        saved, best = utils.list_checkpoints(args.model_path, 
+                r'model_(lm)?_epoch\d+_' + re.escape(args.experiment_name))
+        self.checkpoint_writer = utils.CheckpointWriter(args.keep_checkpoints, self.logger,
+                saved, best)
 
         print('Build vocab and embeddings...')
         self.build_vocab_and_embeddings()
@@ -63,6 +83,16 @@ class Trainer:
         parser.add_argument('--max_seq_length', default=300, type=int, required=False, help='')
         parser.add_argument('--max_context_size', default=10, type=int, required=False, help='')
         parser.add_argument('--shuffle_data', action='store_true', required=False, help='')
+        parser.add_argument('--num_workers', default=0, type=int, required=False, 
+                help='DataLoader worker processes')
+        parser.add_argument('--prefetch_factor', default=2, type=int, required=False, 
+                help='Batches loaded in advance by each worker')
+        parser.add_argument('--persistent_workers', action='store_true', required=False, 
+                help='Keep DataLoader workers between epochs')
+        parser.add_argument('--background_prefetch', action='store_true', required=False, 
+                help='Load batches in a background thread with utils.DataLoaderX')
+        parser.add_argument('--dist_backend', default='gloo', type=str, required=False, 
+                help='torch.distributed backend when launched by torchrun, gloo for cpu')
         parser.add_argument('--max_vocab_size', default=40000, type=int, required=False, help='')
         parser.add_argument('--pretrain_emb', action='store_true', required=False, help='')
 
@@ -82,8 +112,14 @@ class Trainer:
 
         parser.add_argument('--model_path', default='models/', type=str, required=False, help='')
         parser.add_argument('--pretrained_path', type=str, required=False, help='')
+        parser.add_argument('--resume', type=str, required=False, 
+                help='Checkpoint dir of save_model, resume the model, optimizer, scheduler, rng and epoch')
+        parser.add_argument('--keep_checkpoints', default=1, type=int, required=False, 
+                help='Keep the last keep_checkpoints checkpoints and the best one, 0 to keep all')
         parser.add_argument('--data_path', default='datas/', type=str, required=False, help='')
         parser.add_argument('--cache_path', default='caches/', type=str, required=False, help='')
+        parser.add_argument('--cache_max_age_days', default=0, type=float, required=False, 
+                help='Remove the caches in cache_path not used for that many days, 0 to keep them')
         parser.add_argument('--log_path', default='logs/', type=str, required=False, help='')
         parser.add_argument('--corpus_fname', default='datas/corpus.txt', type=str, required=False, help='')
         parser.add_argument('--vec_fname', default='models/vec.txt', type=str, required=False, help='')
@@ -137,8 +173,8 @@ class Trainer:
                                                                                          
     def build_dataloaders(self):
         args = self.args
-        gb = lambda batch: datasets.generate_batch(batch, self.pad_idx)
-        gb_lm = lambda batch: datasets.generate_lm_batch(batch, self.pad_idx)
+        gb = datasets.ChatCollate(self.pad_idx)
+        gb_lm = datasets.LMCollate(self.pad_idx)
 
         if args.n_epochs_early_stage > 0:
             dp = datasets.LMDataProcesser(limit_length=args.limit_example_length, 
@@ -147,7 +183,7 @@ class Trainer:
                     self.vocab, args.max_seq_length, args.limit_example_length, 
                     data_path=args.data_path, cache_path=args.cache_path, 
                     data_processer=dp, mode='train_lm')
-            self.train_iter = DataLoader(ds, batch_size=args.batch_size, 
+            self.train_iter = utils.build_dataloader(ds, args, batch_size=args.batch_size, 
                     collate_fn=gb_lm, shuffle=True) 
         else:
             dp = datasets.ChatDataProcesser(limit_length=args.limit_example_length, 
@@ -156,7 +192,7 @@ class Trainer:
                     self.vocab, args.max_seq_length, args.limit_example_length, 
                     data_path=args.data_path, cache_path=args.cache_path, 
                     data_processer=dp, mode='train_char')
-            self.train_iter = DataLoader(ds, batch_size=args.batch_size, 
+            self.train_iter = utils.build_dataloader(ds, args, batch_size=args.batch_size, 
                     collate_fn=gb, shuffle=args.shuffle_data) 
 
         self.valid_iter = None
@@ -165,16 +201,20 @@ class Trainer:
                 self.vocab, args.max_seq_length, args.limit_example_length, 
                 data_path=args.data_path, cache_path=args.cache_path, 
                 data_processer=dp, mode='valid_char')
-        self.valid_iter = DataLoader(ds, batch_size=args.batch_size,
+        self.valid_iter = utils.build_dataloader(ds, args, batch_size=args.batch_size,
                 collate_fn=gb, shuffle=args.shuffle_data) 
 
         ds = utils.PersonaDataset(
                 self.vocab, args.max_seq_length, args.limit_example_length, 
                 data_path=args.data_path, cache_path=args.cache_path, 
                 data_processer=dp, mode='test_char')
-        self.test_iter = DataLoader(ds, batch_size=args.batch_size,
+        self.test_iter = utils.build_dataloader(ds, args, batch_size=args.batch_size,
                 collate_fn=gb, shuffle=args.shuffle_data)
 
+        if args.cache_max_age_days > 0:
+            # after the datasets above are loaded, their caches are just used
+            utils.CacheManifest(args.cache_path).evict_unused(args.cache_max_age_days * 86400)
+
     def build_model(self):
         args = self.args
         output_dim = self.input_dim
@@ -200,11 +240,22 @@ class Trainer:
             print(f'Load pretrained model {args.pretrained_path}...')
             self.load_model()
 
+        if args.resume is not None:
+            print(f'Resume from checkpoint {args.resume}...')
+            self.resume()
+
+        # forward of training and eval, self.model is for the state
+        self.dist_model = self.model
+        if self.world_size > 1:
+            self.dist_model = nn.parallel.DistributedDataParallel(self.model, 
+                    device_ids=[self.device.index] if self.device.type == 'cuda' else None,
+                    broadcast_buffers=False, find_unused_parameters=True)
+
     def build_loss_fns(self):
         self.out_loss_fn = nn.CrossEntropyLoss(ignore_index=self.pad_idx)
 
     def run_early_stage(self):
-        for epoch in range(self.args.n_epochs_early_stage):
+        for epoch in range(self.start_epoch, self.args.n_epochs_early_stage):
             start_time = time.time()
 
             train_loss = self.train_lm(epoch)
@@ -222,23 +273,24 @@ class Trainer:
         if self.args.n_epochs_early_stage > 0:
             print('Run early stage...')
             trainer.run_early_stage()
+            self.checkpoint_writer.wait()
             # after fin, rerun with pretrained model 
             return
 
         print('Run main stage...')
 
-        best_val_loss = float("inf")
-
-        for epoch in range(self.args.n_epochs):
+        for epoch in range(self.start_epoch, self.args.n_epochs):
             start_time = time.time()
 
             train_loss = self.train(epoch)
             valid_loss = self.eval(self.valid_iter)
  
-            if valid_loss < best_val_loss:
-                best_val_loss = valid_loss
+            is_best = valid_loss < self.best_valid_loss
+            if is_best:
+                self.best_valid_loss = valid_loss
                 self.best_model = self.model
-                self.save_model(epoch)
+            # written in background, keep_checkpoints removes the old ones
+            self.save_model(epoch, is_best=is_best)
 
             # scheduler.step()
 
@@ -254,18 +306,22 @@ class Trainer:
         test_loss = self.eval(self.test_iter)
         self.logger.info(f'| Test Loss: {test_loss:.3f} | Test PPL: {math.exp(test_loss):7.3f} |')
 
+        self.checkpoint_writer.wait()
         self.grad_util.plot()
 
     def train_lm(self, epoch):
         self.model.train()
 
-        epoch_loss = 0
-        for batch_idx, feature in enumerate(self.train_iter):
+        epoch_loss, n_batches = 0, 0
+        utils.set_loader_epoch(self.train_iter, epoch)
+        for batch_idx, feature in enumerate(
+                utils.distributed_batches(self.train_iter, self.dist_device)):
+            n_batches += 1
             self.optimizer.zero_grad()
 
             utils.feature_to_device(feature, self.device)
 
-            out = self.model(feature)
+            out = self.dist_model(feature)
             loss = self.out_loss_fn(out.view(-1, out.shape[-1]), 
                     feature.y.view(-1))
             # utils.print_backward_graph(loss)
@@ -278,7 +334,8 @@ class Trainer:
             epoch_loss += iloss
             self.logger.info(f'Step {batch_idx+1}/{epoch+1:02} | Train Loss: {iloss:.3f} | Train PPL: {math.exp(iloss):7.3f} | Time: {secs:.3f}s\n')
 
-        return epoch_loss / len(self.train_iter)
+        epoch_loss, n_batches = utils.all_reduce_sum([epoch_loss, n_batches], self.dist_device)
+        return epoch_loss / n_batches
  
 
     def train(self, epoch, data_iter=None):
@@ -287,15 +344,18 @@ class Trainer:
         if data_iter is None:
             data_iter = self.train_iter
 
-        epoch_loss = 0
-        for batch_idx, feature in enumerate(data_iter):
+        epoch_loss, n_batches = 0, 0
+        utils.set_loader_epoch(data_iter, epoch)
+        for batch_idx, feature in enumerate(
+                utils.distributed_batches(data_iter, self.dist_device)):
+            n_batches += 1
             start_time = time.time()
 
             self.optimizer.zero_grad()
 
             utils.feature_to_device(feature, self.device)
 
-            out, out_lm = self.model(feature)
+            out, out_lm = self.dist_model(feature)
             loss, loss_lm = models.AR.loss(self.out_loss_fn, 
                     out, out_lm, feature.resp, feature.lm.y)
             loss = loss + self.args.alpha * loss_lm
@@ -315,7 +375,8 @@ class Trainer:
             secs = end_time - start_time
             self.logger.info(f'Step {batch_idx+1}/{epoch+1:02} | Train Loss: {iloss:.3f} | Train PPL: {math.exp(iloss):7.3f} | Time: {secs:.3f}s\n')
 
-        return epoch_loss / len(data_iter)
+        epoch_loss, n_batches = utils.all_reduce_sum([epoch_loss, n_batches], self.dist_device)
+        return epoch_loss / n_batches
 
     def eval(self, data_iter=None):
         self.model.eval()
@@ -329,30 +390,61 @@ class Trainer:
 
                 utils.feature_to_device(feature, self.device)
 
-                out, out_lm = self.model(feature)
+                out, out_lm = self.dist_model(feature)
                 loss, loss_lm = models.AR.loss(self.out_loss_fn, 
                         out, out_lm, feature.resp, feature.lm.y)
                 loss = loss + self.args.alpha * loss_lm
 
                 epoch_loss += loss.item()
 
-        return epoch_loss / len(data_iter)
+        # the losses of the shards of all processes
+        epoch_loss, n_batches = utils.all_reduce_sum([epoch_loss, len(data_iter)], self.dist_device)
+        return epoch_loss / n_batches
 
     # resuming vs Warmstarting(transfer learning)?
     # it just have difference of optimizer state_dict
     # https://pytorch.org/tutorials/beginner/saving_loading_models.html#saving-loading-a-general-checkpoint-for-inference-and-or-resuming-training
-    def save_model(self, epoch, stage=''):
+    def save_model(self, epoch, stage='', is_best=False):
+        """Save model.pt and the training state checkpoint.pt for resume,
+        the states are copied to cpu and written by self.checkpoint_writer in background
+        """
+        if not utils.is_main_process():
+            return
         model_path = os.path.join(self.args.model_path, 
-                'model_{}_epoch{}'.format(stage, epoch + 1))
-        if not os.path.exists(model_path):
-            os.mkdir(model_path)
-        torch.save(self.model.state_dict(), model_path + '/model.pt')
-        shutil.copyfile(self.args.config_file, model_path + '/config.yml')
-        shutil.copyfile(self.args.vocab_fname, model_path + '/vocab')
+                'model_{}_epoch{}_{}'.format(stage, epoch + 1, self.args.experiment_name))
+        checkpoint = {
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict(),
+            'rng': utils.get_rng_state(),
+            'epoch': epoch,
+            'best_valid_loss': self.best_valid_loss,
+        }
+        self.checkpoint_writer.save(model_path, 
+                {'model.pt': self.model.state_dict(), 'checkpoint.pt': checkpoint},
+                {'config.yml': self.args.config_file, 'vocab': self.args.vocab_fname},
+                is_best=is_best)
 
     def load_model(self):
         self.model.load_state_dict(torch.load(self.args.pretrained_path))
 
+    def resume(self):
+        """Restore the training state of the save_model dir args.resume, 
+        run continues from the next epoch
+        """
+        path = self.args.resume
+        self.model.load_state_dict(torch.load(os.path.join(path, 'model.pt'), map_location='cpu'))
+        checkpoint = torch.load(os.path.join(path, 'checkpoint.pt'), map_location='cpu')
+        self.optimizer.load_state_dict(checkpoint['optimizer'])
+        self.scheduler.load_state_dict(checkpoint['scheduler'])
+        self.best_valid_loss = checkpoint['best_valid_loss']
+        self.start_epoch = checkpoint['epoch'] + 1
+
+        if self.world_size > 1:
+            # the rng state is of rank 0
+            utils.set_random_seed(self.args.seed + self.rank + self.start_epoch, self.device)
+        else:
+            utils.set_rng_state(checkpoint['rng'])
+
 
 def epoch_time(start_time: int, end_time: int):
     elapsed_time = end_time - start_time
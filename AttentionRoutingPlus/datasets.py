@@ -2,7 +2,6 @@
 import os
 import json
 import time
-import random
 import itertools
 from dataclasses import dataclass
 from typing import Sequence
@@ -13,8 +12,12 @@ sys.path.append('../')
 import utils
 from utils import UNK, SEP, SOS, EOS, SPE1, SPE2, CLS
 
+import numpy as np
+from filelock import FileLock
+
 import torch
 from torch import Tensor
+from torch.utils.data import Dataset
 from torch.nn.utils.rnn import pad_sequence
 
 _USE_BERT_FEATURE = False
@@ -103,7 +106,24 @@ class ChatDataProcesser:
         self.persona_vocab = persona_vocab
         self.tokenizer = tokenizer
 
-    def get_examples(self, path, mode):
+    def get_examples(self, path, mode, shard_id=0, num_shards=1, byte_range=None):
+        """shard_id, num_shards: only yield examples of lines i % num_shards == shard_id
+        byte_range: only read the lines in it, from utils.split_file
+        """
+        for posts, personas_no_tag, tags, persona in self.get_sessions(
+                path, mode, shard_id, num_shards, byte_range):
+            for i in range(0, len(posts), 2):
+                context = posts[:i+1][-(self.max_context_size+1):]
+                resp = posts[i+1]
+
+                # print(context, personas_no_tag, tags, resp, persona)
+                yield context, personas_no_tag, tags, resp, persona
+
+    def get_sessions(self, path, mode, shard_id=0, num_shards=1, byte_range=None):
+        """Sessions of get_examples, the posts of a session are tokenized once
+
+        An example is post i (even) of posts as the last post of context, and post i+1 as resp.
+        """
         file_path = os.path.join(path, mode + '.txt')
         _tok = self.tokenizer
         tokenizer = lambda x: _tok(x.replace(' ', '')) if _tok is not None else x.split()
@@ -115,12 +135,14 @@ class ChatDataProcesser:
             parse_tag = lambda x: x and ' '.join(x.replace(';', '')) or UNK
         parse_gender = lambda x: '男' if x == 'male' else ('女' if x == 'female' else UNK)
 
-        with open(file_path) as f:
+        with open(file_path, 'rb') as f:
             cnt = 0
-            for line in f:
+            for line in utils.read_lines(f, byte_range):
                 if self.limit_length is not None and cnt == self.limit_length:
                     break
                 cnt += 1
+                if (cnt - 1) % num_shards != shard_id:
+                    continue
 
                 obj = json.loads(line)
                 dialogs = obj['dialog']
@@ -161,11 +183,9 @@ class ChatDataProcesser:
                 for i in range(0, d_len, 2):
                     if dialogs[i] == '':
                         dialogs[i] = UNK
-                    context = [tokenizer(v[0]) for v in dialogs[:i+1][-(self.max_context_size+1):]]
-                    resp = tokenizer(dialogs[i+1][0])
+                posts = [tokenizer(v[0]) for v in dialogs]
 
-                    # print(context, personas_no_tag, tags, resp, persona)
-                    yield context, personas_no_tag, tags, resp, persona
+                yield posts, personas_no_tag, tags, persona
 
     def convert_examples_to_features(
         self,
@@ -190,13 +210,8 @@ class ChatDataProcesser:
                 iresp = [vocab.stoi(SOS)] + [vocab.stoi(k) 
                         for k in resp[:self.max_seq_length]] + [vocab.stoi(EOS)]
 
-            if self.persona_vocab is not None:
-                _vocab = self.persona_vocab
-            else:
-                _vocab = self.vocab
-            ipersonas_no_tag = list(map(lambda x: list(map(_vocab.stoi, x)), personas_no_tag))
-            itags = list(map(lambda x: list(map(_vocab.stoi, x)), tags))
-            ipersona = list(map(_vocab.stoi, persona))
+            ipersonas_no_tag, itags, ipersona = self._convert_personas(
+                    personas_no_tag, tags, persona)
            #print()
            #print('context:')
            #print([vocab.itos(v) for v in list(itertools.chain(*icontext))])
@@ -224,6 +239,59 @@ class ChatDataProcesser:
                     # fast and use fewer memory
                     iresp)
 
+    def _convert_personas(self, personas_no_tag, tags, persona):
+        if self.persona_vocab is not None:
+            _vocab = self.persona_vocab
+        else:
+            _vocab = self.vocab
+        ipersonas_no_tag = list(map(lambda x: list(map(_vocab.stoi, x)), personas_no_tag))
+        itags = list(map(lambda x: list(map(_vocab.stoi, x)), tags))
+        ipersona = list(map(_vocab.stoi, persona))
+        return ipersonas_no_tag, itags, ipersona
+
+    def convert_sessions_to_features(
+        self,
+        vocab,
+        sessions,
+        mode
+    ):
+        """Session features: tokens of all posts, post lengths,
+        personas_no_tag, tags and persona
+        """
+        for posts, personas_no_tag, tags, persona in sessions:
+            iposts = [[vocab.stoi(k) for k in post[:self.max_seq_length]] for post in posts]
+            ipersonas_no_tag, itags, ipersona = self._convert_personas(
+                    personas_no_tag, tags, persona)
+            yield (list(itertools.chain(*iposts)), [len(v) for v in iposts],
+                    ipersonas_no_tag, itags, ipersona)
+
+    def session_example(self, session, i):
+        """Example of post i of a convert_sessions_to_features session,
+        same as the convert_examples_to_features one
+        """
+        tokens, post_lens, personas_no_tag, tags, persona = session
+        offsets = np.concatenate(([0], np.cumsum(post_lens)))
+        start = max(0, i - self.max_context_size)
+
+        # SEP after every post
+        context = np.insert(tokens[offsets[start]:offsets[i+1]],
+                offsets[start+1:i+2] - offsets[start], self.vocab.stoi(SEP))
+        lens = np.asarray(post_lens[start:i+1]) + 1
+        if _USE_BERT_FEATURE:
+            context = np.concatenate(([self.vocab.stoi(CLS)], context))
+            lens[0] += 1
+        speakers = np.where(np.arange(len(lens)) % 2 == 0,
+                self.vocab.stoi(SPE1), self.vocab.stoi(SPE2))
+        segs = np.repeat(speakers, lens)
+
+        if _USE_BERT_FEATURE:
+            bos, eos = self.vocab.stoi(CLS), self.vocab.stoi(SEP)
+        else:
+            bos, eos = self.vocab.stoi(SOS), self.vocab.stoi(EOS)
+        resp = np.concatenate(([bos], tokens[offsets[i+1]:offsets[i+2]], [eos]))
+
+        return context, segs, personas_no_tag, tags, resp, persona, resp
+
 
 class LMDataProcesser:
     def __init__(
@@ -271,6 +339,219 @@ class LMDataProcesser:
             yield [vocab.stoi(k) for k in seq]
  
  
+class PretrainFeatureStore:
+    """Precomputed pretrain feature model hidden states of a dataset split
+
+    emb1 runs over the dataset once in build, the hidden states are memory mapped
+    and indexed by example id (index in the dataset). Every example has
+    context_len + 2 + persona_len rows:
+        context: ContextEmb context feature
+        speakers: sum of the personas_no_tag and tags features of the 2 speakers,
+                  only the tokens are summed, not pad, by utils.speakers_sum as ContextEmb
+        persona: PersonaEmb persona feature
+
+    The features are of ContextEmb persona_feature_version VERSION, 
+    it is in the cache names, the stores of other versions are not read.
+    """
+    VERSION = 2
+
+    def __init__(self, fname):
+        self.fname = fname
+        meta = np.load(fname + '.idx.npz')
+        self.offsets = meta['offsets']
+        self.context_lens = meta['context_lens']
+        self.hids = np.memmap(fname + '.bin', dtype=np.float32, mode='r',
+                shape=(int(self.offsets[-1]), int(meta['hid_dim'])))
+
+    def __reduce__(self):
+        # reopen in DataLoader workers, not pickle the memory map
+        return (self.__class__, (self.fname,))
+
+    def __len__(self):
+        return len(self.context_lens)
+
+    def __getitem__(self, i):
+        hids = torch.from_numpy(np.array(self.hids[self.offsets[i]:self.offsets[i+1]]))
+        l = self.context_lens[i]
+        return hids[:l], hids[l:l+2], hids[l+2:]
+
+    @classmethod
+    def load_or_build(cls, fname, dataset, emb1, vocab, persona_vocab, 
+            batch_size, device):
+        # Make sure only the first process builds it, the others will load it
+        with FileLock(fname + '.lock'):
+            if not os.path.exists(fname + '.idx.npz'):
+                start = time.time()
+                cls.build(fname, dataset, emb1, vocab, persona_vocab, batch_size, device)
+                print("Saving pretrain features into %s [took %.3f s]" % (fname, time.time() - start))
+        return cls(fname)
+
+    @staticmethod
+    def build(fname, dataset, emb1, vocab, persona_vocab, batch_size, device):
+        pad_idx = vocab.stoi(utils.PAD)
+        persona_pad_idx = pad_idx
+        if persona_vocab is not None:
+            persona_pad_idx = persona_vocab.stoi(utils.PAD)
+
+        def hid(seqs, pad_idx, zero_position_ids=False):
+            x = pad_sequence([torch.tensor(v, dtype=torch.long) for v in seqs],
+                    batch_first=True, padding_value=pad_idx).to(device)
+            # same as ContextEmb, persona features have no position
+            position_ids = torch.zeros_like(x) if zero_position_ids else None
+            attention_mask = (x != pad_idx).float()
+            return emb1(x, position_ids=position_ids, 
+                    attention_mask=attention_mask, hidden_idx=-2).float().cpu().numpy()
+
+        def speakers_hid(seqs):
+            # seqs: 2 speakers of every example, in the ContextEmb layout
+            # batch_size X 2 * n, the tokens of speaker 1 then speaker 2
+            x, _ = pad_seqs([v for ex in seqs for v in ex], persona_pad_idx)
+            x = x.T.reshape(len(seqs), -1).to(device)
+            attention_mask = (x != persona_pad_idx).float()
+            hid = emb1(x, position_ids=torch.zeros_like(x), 
+                    attention_mask=attention_mask, hidden_idx=-2).float()
+            # batch_size X 2 X hid_dim
+            return utils.speakers_sum(hid, attention_mask).transpose(0, 1).cpu().numpy()
+
+        context_lens = np.array([len(v[0]) for v in dataset], dtype=np.int64)
+        persona_lens = np.array([len(v[5]) for v in dataset], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(context_lens + 2 + persona_lens)])
+        hids = None
+        for start in range(0, len(dataset), batch_size):
+            batch = [dataset[i] for i in range(start, min(start+batch_size, len(dataset)))]
+            context, segs, personas_no_tag, tags, resp, persona, lm = zip(*batch)
+            context_hid = hid(context, pad_idx)
+            speakers = speakers_hid(personas_no_tag) + speakers_hid(tags)
+            persona_hid = hid(persona, persona_pad_idx, True)
+            if hids is None:
+                hids = np.memmap(fname + '.bin', dtype=np.float32, mode='w+',
+                        shape=(int(offsets[-1]), context_hid.shape[-1]))
+
+            for j, i in enumerate(range(start, start + len(batch))):
+                o, l = offsets[i], context_lens[i]
+                hids[o:o+l] = context_hid[j, :l]
+                hids[o+l:o+l+2] = speakers[j]
+                hids[o+l+2:offsets[i+1]] = persona_hid[j, :persona_lens[i]]
+
+        if hids is not None:
+            hids.flush()
+            # the index is saved last, the store is complete if it exists
+            np.savez(fname + '.idx.npz', offsets=offsets, 
+                    context_lens=context_lens, hid_dim=hids.shape[1])
+
+
+class PretrainFeatureDataset(Dataset):
+    """Examples of dataset with their PretrainFeatureStore features appended"""
+    def __init__(self, dataset, store):
+        assert len(dataset) == len(store)
+        self.dataset = dataset
+        self.store = store
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, i):
+        return tuple(self.dataset[i]) + (self.store[i],)
+
+
+class ChatSessionProcesser:
+    """Sessions of ChatDataProcesser as the examples of utils.PersonaDataset"""
+    def __init__(self, data_processer):
+        self.data_processer = data_processer
+        self.limit_length = data_processer.limit_length
+
+    def get_examples(self, path, mode, shard_id=0, num_shards=1, byte_range=None):
+        return self.data_processer.get_sessions(path, mode, shard_id, num_shards, byte_range)
+
+    def convert_examples_to_features(self, vocab, examples, mode):
+        return self.data_processer.convert_sessions_to_features(vocab, examples, mode)
+
+
+class ChatSessionDataset(Dataset):
+    """Chat examples of utils.PersonaDataset, with the features stored once per session
+
+    An example is the view (session id, post index), expanded by 
+    ChatDataProcesser.session_example, the persona features of the examples 
+    of a session are the same arrays.
+    """
+    def __init__(
+        self,
+        vocab,
+        max_seq_length,
+        limit_example_length,
+        data_path,
+        cache_path,
+        data_processer,
+        mode='train',
+        overwrite_cache=False,
+        n_build_workers=1,
+    ):
+        self.data_processer = data_processer
+        self.sessions = utils.PersonaDataset(vocab, max_seq_length, limit_example_length,
+                data_path, cache_path, ChatSessionProcesser(data_processer),
+                mode, overwrite_cache, n_build_workers)
+        self.cache_name = self.sessions.cache_name
+        self.cache_config = self.sessions.cache_config
+
+        n_posts = self.sessions.features.lengths(1)
+        n_examples = n_posts // 2
+        self.session_ids = np.repeat(np.arange(len(n_posts)), n_examples)
+        first_example = np.cumsum(n_examples) - n_examples
+        self.post_ids = (np.arange(len(self.session_ids)) 
+                - np.repeat(first_example, n_examples)) * 2
+
+    def __len__(self):
+        return len(self.session_ids)
+
+    def __getitem__(self, i):
+        return self.data_processer.session_example(
+                self.sessions[self.session_ids[i]], int(self.post_ids[i]))
+
+    def lengths(self):
+        """Context, resp and lm lengths of all examples, from the post lengths
+
+        Shape:
+            output: n_examples X 3
+        """
+        post_lens, n_posts = self.sessions.features.field(1)
+        post_lens = post_lens.astype(np.int64)
+        first_post = (np.cumsum(n_posts) - n_posts)[self.session_ids]
+        start = first_post + np.maximum(0, self.post_ids - self.data_processer.max_context_size)
+        end = first_post + self.post_ids + 1
+        cum_lens = np.concatenate(([0], np.cumsum(post_lens + 1)))
+        # with SEP of every post
+        context = cum_lens[end] - cum_lens[start] + int(_USE_BERT_FEATURE)
+        resp = post_lens[end] + 2
+        return np.stack([context, resp, resp], axis=1)
+
+
+def chat_lengths(dataset):
+    """Context, resp and lm lengths of the examples of chat utils.PersonaDataset 
+    or ChatSessionDataset, for utils.BucketBatchSampler
+
+    Shape:
+        output: n_examples X 3
+    """
+    if isinstance(dataset, PretrainFeatureDataset):
+        dataset = dataset.dataset
+    if isinstance(dataset, ChatSessionDataset):
+        return dataset.lengths()
+    features = dataset.features
+    return np.stack([features.lengths(0), features.lengths(4), features.lengths(6)], axis=1)
+
+
+@dataclass
+class PretrainHidFeature:
+    __slots__ = ['context', 'speakers', 'persona']
+
+    # context_len X batch_size X hid_dim
+    context: Tensor
+    # 2 X batch_size X hid_dim
+    speakers: Tensor
+    # persona_len X batch_size X hid_dim
+    persona: Tensor
+
+
 @dataclass
 class LMFeature:
     __slots__ = ['x', 'y', 'x_mlm', 
@@ -294,7 +575,7 @@ class ChatFeature:
             'context_pad_mask', 'resp_mask', 
             'resp_pad_mask', 'persona_pad_mask',
             'personas_no_tag_pad_mask', 'tags_pad_mask', 
-            'post', 'post_pad_mask', 'lm']
+            'pretrain_hid', 'post', 'post_pad_mask', 'lm']
 
     # context include post
     context: Tensor
@@ -316,38 +597,73 @@ class ChatFeature:
     # for pretrain_feature
     personas_no_tag_pad_mask: Tensor
     tags_pad_mask: Tensor
+    # None if not from PretrainFeatureDataset
+    pretrain_hid: PretrainHidFeature
 
+    # None for inference batches
     lm: LMFeature
 
 
 # https://pytorch.org/tutorials/beginner/text_sentiment_ngrams_tutorial.html?highlight=collate_fn
-def generate_batch(batch, vocab, persona_vocab, is_mlm):
+def pad_seqs(seqs, padding_value):
+    """Same as pad_sequence of seqs (lists or numpy arrays), with one copy of all tokens
+
+    Shape:
+        output: max_len X batch_size, lens: batch_size
+    """
+    lens = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    out = np.full((lens.max(initial=0), len(seqs)), padding_value, dtype=np.int64)
+    if lens.sum() > 0:
+        out.T[np.arange(out.shape[0]) < lens[:, None]] = np.concatenate(seqs)
+    return torch.from_numpy(out), torch.from_numpy(lens)
+
+
+def _post_pad(context_pad, context_lens, vocab, pad_idx):
+    """post of every context: the context without its last token, the SEP that 
+    every context ends with, or CLS and the whole context if _USE_BERT_FEATURE
+    """
+    if _USE_BERT_FEATURE:
+        # cls_idx for bert-like sentence rep, xlnet is last token
+        cls = torch.full_like(context_pad[:1], vocab.stoi(utils.CLS))
+        return torch.cat([cls, context_pad])
+    pos = torch.arange(context_pad.shape[0] - 1).unsqueeze(1)
+    return context_pad[:-1].masked_fill(pos == context_lens - 1, pad_idx)
+
+
+def generate_batch(batch, vocab, persona_vocab, is_mlm, with_lm=True, generator=None,
+        persona_feature_version=2):
+    """with_lm: False for inference batches, feature.lm will be None
+    generator: torch.Generator of the MLM masks, None for the default one
+    persona_feature_version: model config, 1 for the tags layout of models trained 
+        before version 2, which mixes the tags of neighbouring examples
+    """
     pad_idx = vocab.stoi(utils.PAD)
     persona_pad_idx = pad_idx
     if persona_vocab is not None:
         persona_pad_idx = persona_vocab.stoi(utils.PAD)
+
+    # examples of PretrainFeatureDataset have the precomputed features appended
+    pretrain_hid = None
+    if len(batch[0]) > 7:
+        context_hid, speakers_hid, persona_hid = zip(*[v[7] for v in batch])
+        pretrain_hid = PretrainHidFeature(
+                context=pad_sequence(context_hid),
+                speakers=torch.stack(speakers_hid, dim=1),
+                persona=pad_sequence(persona_hid))
+        batch = [v[:7] for v in batch]
     context, segs, personas_no_tag, tags, resp, persona, lm = zip(*batch)
 
-    post = []
-    cls_idx = vocab.stoi(utils.CLS)
-    sep_idx = vocab.stoi(utils.SEP)
-    for v in context:
-        post_start = list(reversed(v)).index(sep_idx)
-        if _USE_BERT_FEATURE:
-            # cls_idx for bert-like sentence rep, xlnet is last token
-            post.append([cls_idx] + v[-post_start:])
-        else:
-            post.append(v[-post_start:-1])
-
-    fn = lambda x: list(map(torch.tensor, x)) 
-    context_pad = pad_sequence(fn(context), padding_value=pad_idx)
-    post_pad = pad_sequence(fn(post), padding_value=pad_idx)
-    segs_pad = pad_sequence(fn(segs), padding_value=pad_idx)
-    tags = itertools.chain(*tags)
-    tags_pad = pad_sequence(fn(tags), padding_value=persona_pad_idx)
-    tags_pad = tags_pad.view(-1, 2, int(tags_pad.shape[1]/2)).transpose(1, 0)
-    resp_pad = pad_sequence(fn(resp), padding_value=pad_idx)
-    persona_pad = pad_sequence(fn(persona), padding_value=persona_pad_idx)
+    context_pad, context_lens = pad_seqs(context, pad_idx)
+    post_pad = _post_pad(context_pad, context_lens, vocab, pad_idx)
+    segs_pad, _ = pad_seqs(segs, pad_idx)
+    # n_tags X (batch_size * 2) --> 2 X n_tags X batch_size
+    tags_pad, _ = pad_seqs([v for ex in tags for v in ex], persona_pad_idx)
+    if persona_feature_version >= 2:
+        tags_pad = tags_pad.view(tags_pad.shape[0], -1, 2).permute(2, 0, 1)
+    else:
+        tags_pad = tags_pad.view(-1, 2, int(tags_pad.shape[1]/2)).transpose(1, 0)
+    resp_pad, _ = pad_seqs(resp, pad_idx)
+    persona_pad, _ = pad_seqs(persona, persona_pad_idx)
 
     context_pad_mask = (context_pad == pad_idx).T
     post_pad_mask = (post_pad == pad_idx).T
@@ -355,14 +671,17 @@ def generate_batch(batch, vocab, persona_vocab, is_mlm):
     resp_mask = utils.generate_square_subsequent_mask(resp_pad.shape[0])
     resp_pad_mask = (resp_pad == pad_idx).T
     persona_pad_mask = (persona_pad == persona_pad_idx).T
-    # batch_size X n_persona X 2 
-    tmp = list(map(lambda x: pad_sequence(fn(x), padding_value=persona_pad_idx),
-            personas_no_tag))
-    # n_persona X batch_size X 2 --> 2 X n_persona X batch_size
-    personas_no_tag_pad = pad_sequence(tmp, padding_value=persona_pad_idx).permute(2, 0, 1) 
+    # n_persona X (batch_size * 2) --> 2 X n_persona X batch_size
+    personas_no_tag_pad, _ = pad_seqs([v for ex in personas_no_tag for v in ex], 
+            persona_pad_idx)
+    personas_no_tag_pad = personas_no_tag_pad.view(
+            personas_no_tag_pad.shape[0], -1, 2).permute(2, 0, 1)
     personas_no_tag_pad_mask = (personas_no_tag_pad == persona_pad_idx).T
 
-    lm = generate_lm_batch(lm, vocab, is_mlm, in_chat=True)
+    if with_lm:
+        lm = generate_lm_batch(lm, vocab, is_mlm, in_chat=True, generator=generator)
+    else:
+        lm = None
 
     return ChatFeature(
             context=context_pad,
@@ -382,43 +701,60 @@ def generate_batch(batch, vocab, persona_vocab, is_mlm):
 
             personas_no_tag_pad_mask=personas_no_tag_pad_mask,
             tags_pad_mask=tags_pad_mask,
+            pretrain_hid=pretrain_hid,
 
             lm=lm,
     )
 
 
-def generate_lm_batch(batch, vocab, is_mlm, in_chat=False):
+def mask_span(batch, lens, mask_idx, pad_idx, generator=None):
+    """Replace a random span of every seq in batch with one mask_idx
+
+    Not bos and eos, the span is 1 token if len < 6, else 2 tokens (99/100) 
+    or 0 tokens (1/100, mask_idx is inserted), seqs of len <= 3 (bos + w + eos) 
+    are not masked.
+
+    generator: torch.Generator of the spans, None for the default one, 
+    which is seeded by utils.set_random_seed and in every DataLoader worker
+
+    Shape:
+        batch: max_len X batch_size, lens: batch_size
+        output: max_len X batch_size
+    """
+    u = torch.rand(2, len(lens), generator=generator)
+    n_mask = torch.where(lens > 5, torch.where(u[0] < 0.01, 0, 2), 1)
+    # start in [1, len-n_mask-1]
+    start = 1 + (u[1] * (lens - n_mask - 1).clamp(min=1)).long()
+    no_mask = lens <= 3
+    n_mask = n_mask.masked_fill(no_mask, 1)
+    start = start.masked_fill(no_mask, batch.shape[0])
+    out_lens = lens - n_mask + 1
+
+    pos = torch.arange(batch.shape[0] + 1).unsqueeze(1)
+    src = torch.where(pos < start, pos, pos + n_mask - 1).clamp(max=batch.shape[0]-1)
+    out = batch.gather(0, src)
+    out.masked_fill_(pos == start, mask_idx)
+    out.masked_fill_(pos >= out_lens, pad_idx)
+
+    return out[:out_lens.max(), :]
+
+
+def generate_lm_batch(batch, vocab, is_mlm, in_chat=False, generator=None):
+    """generator: torch.Generator of the MLM masks, None for the default one"""
     pad_idx = vocab.stoi(utils.PAD)
     mask_idx = vocab.stoi(utils.MASK)
 
     if not in_chat:
         x_mlm = None
         x_mlm_pad_mask = None
-        batch = torch.tensor(batch).T
+        batch, _ = pad_seqs(batch, pad_idx)
     elif not is_mlm:
         x_mlm = None
         x_mlm_pad_mask = None
-        batch = pad_sequence(list(map(torch.tensor, batch)), padding_value=pad_idx)
+        batch, _ = pad_seqs(batch, pad_idx)
     else:
-        x_mlm = []
-        for v in batch:
-            l = len(v)
-            if l == 3:
-                # bos + w + eos
-                x_mlm.append(v)
-                continue
-            mask = 1
-            if l > 5:
-                # mask = 2
-                # 99/100 is 2, 1/100 is 0
-                mask = min(2, random.randint(0, 99))
-                if mask == 1:
-                    mask = 2
-            start = random.randint(1, l-mask-1)
-            x_mlm.append(v[0:start] + [mask_idx] + v[start+mask:])
-
-        batch = pad_sequence(list(map(torch.tensor, batch)), padding_value=pad_idx)
-        x_mlm = pad_sequence(list(map(torch.tensor, x_mlm)), padding_value=pad_idx)
+        batch, lens = pad_seqs(batch, pad_idx)
+        x_mlm = mask_span(batch, lens, mask_idx, pad_idx, generator)
         x_mlm_pad_mask = (x_mlm == pad_idx).T
 
     x = batch[:-1]
@@ -431,6 +767,31 @@ def generate_lm_batch(batch, vocab, is_mlm, in_chat=False):
             x_mlm_pad_mask=x_mlm_pad_mask)
 
 
+class ChatCollate:
+    """Picklable collate_fn of generate_batch for DataLoader workers"""
+    def __init__(self, vocab, persona_vocab, is_mlm, with_lm=True, persona_feature_version=2):
+        self.vocab = vocab
+        self.persona_vocab = persona_vocab
+        self.is_mlm = is_mlm
+        self.with_lm = with_lm
+        self.persona_feature_version = persona_feature_version
+
+    def __call__(self, batch):
+        return generate_batch(batch, self.vocab, self.persona_vocab, 
+                self.is_mlm, self.with_lm, 
+                persona_feature_version=self.persona_feature_version)
+
+
+class LMCollate:
+    """Picklable collate_fn of generate_lm_batch for DataLoader workers"""
+    def __init__(self, vocab, is_mlm):
+        self.vocab = vocab
+        self.is_mlm = is_mlm
+
+    def __call__(self, batch):
+        return generate_lm_batch(batch, self.vocab, self.is_mlm)
+
+
 def build_corpus(raw_fname, corpus_fname):
     datas = []
     with open(raw_fname) as f:
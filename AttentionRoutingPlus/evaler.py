@@ -62,12 +62,28 @@ class Evaler:
         parser.add_argument('--seed', default=42, type=int, required=False, help='')
         parser.add_argument('--batch_size', default=128, type=int, required=False, help='')
         parser.add_argument('--limit_example_length', default=256, type=int, required=False, help='')
+        parser.add_argument('--num_workers', default=0, type=int, required=False, 
+                help='DataLoader worker processes')
+        parser.add_argument('--prefetch_factor', default=2, type=int, required=False, 
+                help='Batches loaded in advance by each worker')
+        parser.add_argument('--persistent_workers', action='store_true', required=False, 
+                help='Keep DataLoader workers between epochs')
+        parser.add_argument('--background_prefetch', action='store_true', required=False, 
+                help='Load batches in a background thread with utils.DataLoaderX')
+        parser.add_argument('--amp', action='store_true', required=False, 
+                help='bf16 autocast of the model')
+        parser.add_argument('--bucket_size', default=0, type=int, required=False, 
+                help='Batch examples of similar lengths in buckets of bucket_size batches, 0 for no bucket')
+        parser.add_argument('--max_tokens', default=0, type=int, required=False, 
+                help='Token budget of batches, counting padded context, resp and lm tokens, 0 for fixed batch_size')
 
         parser.add_argument('--min_seq_length', default=10, type=int, required=False, help='')
         parser.add_argument('--temperature', default=0.7, type=float, required=False, help='Sampling softmax temperature')
         parser.add_argument('--top_k', default=0, type=int, required=False, help='Filter top-k tokens before sampling (<=0: no filtering)')
         parser.add_argument('--top_p', default=0.9, type=float, required=False, help='Nucleus filtering (top-p) before sampling (<=0.0: no filtering)')
         parser.add_argument('--no_sample', action='store_true', required=False, help='')
+        parser.add_argument('--beam_size', default=1, type=int, required=False, help='Beam search if > 1, else sampling')
+        parser.add_argument('--length_penalty', default=1.0, type=float, required=False, help='Beam search length penalty alpha (0: no penalty)')
 
         parser.add_argument('--pretrained_fname', default='models/model__epoch1/', type=str, required=False, help='')
         parser.add_argument('--data_path', default='datas/', type=str, required=False, help='')
@@ -139,8 +155,12 @@ class Evaler:
         args = self.args
         model_config = self.model_config
         is_mlm = self.model_config.auxiliary_task == 'MLM'
-        gb = lambda batch: datasets.generate_batch(batch, 
-                self.vocab, self.persona_vocab, is_mlm)
+        # LM feature only for the auxiliary loss, 
+        # sample_sequence and beam_search decode from the encoder state without it
+        with_lm = self.model_config.auxiliary_task is not None
+        # model configs of older experiments have no persona_feature_version
+        gb = datasets.ChatCollate(self.vocab, self.persona_vocab, is_mlm, with_lm,
+                getattr(model_config, 'persona_feature_version', 1))
 
         dp = datasets.ChatDataProcesser(limit_length=args.limit_example_length, 
                     max_seq_length=model_config.max_seq_length, 
@@ -151,8 +171,15 @@ class Evaler:
                 self.vocab, model_config.max_seq_length, args.limit_example_length, 
                 data_path=args.data_path, cache_path=args.cache_path, 
                 data_processer=dp, mode='test_char')
-        self.test_iter = DataLoader(ds, batch_size=args.batch_size,
-                collate_fn=gb, shuffle=False)
+        if args.bucket_size <= 0 and args.max_tokens <= 0:
+            self.test_iter = utils.build_dataloader(ds, args, batch_size=args.batch_size,
+                    collate_fn=gb, shuffle=False)
+        else:
+            batch_sampler = utils.BucketBatchSampler(datasets.chat_lengths(ds), 
+                    args.batch_size, False, max(args.bucket_size, 1), 
+                    args.max_tokens if args.max_tokens > 0 else None)
+            self.test_iter = utils.build_dataloader(ds, args, batch_sampler=batch_sampler, 
+                    collate_fn=gb)
     
     def build_model(self):
         args = self.args
@@ -179,22 +206,30 @@ class Evaler:
         total_loss = 0
 
         print('Run eval...')
-        with torch.no_grad():
+        with torch.no_grad(), utils.autocast(self.device, self.args.amp):
             for batch_idx, feature in enumerate(self.test_iter):
                 utils.feature_to_device(feature, self.device)
 
-                out, out_lm = self.model(feature)
-                print(out[0, 0], out_lm[0, 0])
+                # encode once for loss and sample_sequence
+                state = self.model.encode_state(feature)
+                out, out_lm = self.model(feature, state)
+                print(out[0, 0], out_lm[0, 0] if out_lm is not None else None)
                 loss, loss_lm = models.AR.loss(self.model_config.auxiliary_task,
-                        self.out_loss_fn, out, out_lm, feature.resp, feature.lm.y)
+                        self.out_loss_fn, out, out_lm, feature.resp, 
+                        feature.lm.y if feature.lm is not None else None)
                 print(loss, loss_lm)
-                loss = loss + self.model_config.alpha * loss_lm
+                if loss_lm is not None:
+                    loss = loss + self.model_config.alpha * loss_lm
                 total_loss += loss.item()
 
                 # target include w1, w2...[EOS], len: max_seq_length + 1
                 target = copy.deepcopy(feature.resp[1:])
-                # feature will be changed
-                pred, pred_padded = utils.sample_sequence(feature, self.vocab, self.model, self.args)
+                if self.args.beam_size > 1:
+                    pred, pred_padded = utils.beam_search(feature, self.vocab,
+                            self.model, self.args, state=state)
+                else:
+                    pred, pred_padded = utils.sample_sequence(feature, self.vocab, 
+                            self.model, self.args, state=state)
 
                 pred_tokens = [[self.vocab.itos(k) for k in ks]
                                for ks in pred]
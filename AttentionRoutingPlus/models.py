@@ -14,6 +14,34 @@ import utils
 import modules
 
 
+def pretrain_feature_fn(pretrain_feature_model):
+    """Wrap the frozen pretrain feature model as emb1 of the emb modules"""
+    # don't define as layer, or the model weights will be saved to checkpoint
+    n_hidden_states = pretrain_feature_model.config.num_hidden_layers + 1
+    truncated_models = {}
+    def fn(x, position_ids=None, attention_mask=None, hidden_idx=-1):
+        """Return hidden_states[hidden_idx] of pretrain_feature_model,
+        only the layers before it are run
+        """
+        n_layers = hidden_idx % n_hidden_states
+        if n_layers not in truncated_models:
+            truncated_models[n_layers] = modules.truncate_pretrain_feature_model(
+                    pretrain_feature_model, n_layers)
+        m = truncated_models[n_layers]
+        # 'requires_grad_(False)' just for disable backward calc grad, 
+        # add 'with torch.no_grad()' to disable save activation
+        with torch.no_grad():
+            if m is None:
+                return pretrain_feature_model(
+                        x, position_ids=position_ids,
+                        attention_mask=attention_mask)[-1][hidden_idx]
+            # last layer hid of the truncated model
+            return m(x, position_ids=position_ids,
+                     attention_mask=attention_mask)[0]
+
+    return fn
+
+
 class AR(nn.Module):
     """
     Much simpler transformer implemention:
@@ -90,33 +118,95 @@ class AR(nn.Module):
             else:
                 self._init_with_pretrain_feature_model_layers(pretrain_feature_model)
 
-    def forward(self, feature):
-        if self.use_mem_n2n:
-            context_enc, persona_enc, x_mlm_enc = self.mem_n2n(feature)
+    def forward(self, feature, state=None, logits=True, loss_chunk=None):
+        """state: encode_state(feature) result, skip encoding if given
+        logits: False to return the decoder outputs before generater
+        loss_chunk: (ignore_index, chunk_size), return chunked_loss of feature 
+            instead of the outputs, the generater weight of the loss is used in forward, 
+            so DistributedDataParallel all-reduces its gradient
+
+        The auxiliary LM branch is skipped (out_lm is None) 
+        when feature.lm is None or no auxiliary_task,
+        use encode_state and decode_step for generation.
+        """
+        if state is None:
+            context_enc, persona_enc = self.encode_context(feature)
         else:
-            context_enc, persona_enc, x_mlm_enc = self.encode(feature)
-        out = self.decode(feature, context_enc, persona_enc, x_mlm_enc)
+            context_enc, persona_enc = state.context_enc, state.persona_enc
+        x_mlm_enc = None
+        if self._with_lm(feature):
+            x_mlm_enc = self.encode_lm(feature)
+        out = self.decode(feature, context_enc, persona_enc, x_mlm_enc, 
+                logits and loss_chunk is None)
+        if loss_chunk is not None:
+            ignore_index, chunk_size = loss_chunk
+            out, out_lm = out
+            return self.chunked_loss(self.auxiliary_task, ignore_index, chunk_size, 
+                    out, out_lm, feature.resp, feature.lm.y)
 
         return out
 
+    def encode_state(self, feature):
+        """Encode context and persona once for decode_step"""
+        context_enc, persona_enc = self.encode_context(feature)
+
+        return utils.EncoderState(
+                context_enc=context_enc,
+                persona_enc=persona_enc,
+                context_pad_mask=feature.context_pad_mask,
+                persona_pad_mask=feature.persona_pad_mask,
+                cache=self.resp_decoder.init_cache(),
+        )
+
+    def decode_step(self, state, resp, resp_pad_mask, resp_mask=None):
+        """Incremental decoding with state from encode_state
+
+        Args:
+            resp: positions after state.cache.step, the earlier positions are in cache
+            resp_pad_mask: pad mask of all positions
+            resp_mask: subsequent mask rows of resp, can be None if resp is one position
+
+        Shape:
+            resp: new_len X batch_size
+            resp_pad_mask: batch_size X total_len
+            resp_mask: new_len X total_len
+            output: new_len X batch_size X output_dim
+        """
+        start_pos = state.cache.step
+        resp_emb = self.output_emb(resp, resp_pad_mask[:, start_pos:], start_pos)
+        out = self.resp_decoder(
+                resp_emb, memory=state.context_enc, persona=state.persona_enc, 
+                memory_key_padding_mask=state.context_pad_mask, 
+                tgt_mask=resp_mask, 
+                tgt_key_padding_mask=resp_pad_mask, 
+                persona_pad_mask=state.persona_pad_mask,
+                cache=state.cache) 
+
+        return self.generate(out)
+
+    def encode_context(self, feature):
+        if self.use_mem_n2n:
+            return self.mem_n2n(feature)
+        return self.encode(feature)
+
     def encode(self, feature):
-        context_emb = self.context_emb(feature)
-        persona_emb = self.persona_emb(feature.persona, feature.persona_pad_mask)
+        # persona pretrain feature is in the same emb1 call as context
+        context_emb, persona_hid = self.context_emb(feature, with_persona=True)
+        persona_emb = self.persona_emb(feature.persona, feature.persona_pad_mask, persona_hid)
 
         context_enc = self.post_encoder(context_emb, feature.context_pad_mask)
         persona_enc = self.post_encoder(persona_emb, feature.persona_pad_mask)
-
-        x_mlm_enc = self.encode_lm(feature)
  
-        return context_enc, persona_enc, x_mlm_enc
+        return context_enc, persona_enc
 
     def mem_n2n(self, feature):
         persona_enc = None
         if self.pretrain_feature_model is None:
             post_emb = self.seq_emb(feature.post, feature.post_pad_mask)
         else:
+            # last layer CLS hid
             post_emb = self.pretrain_feature_model(feature.post.T, 
-                    attention_mask=feature.post_pad_mask)[0][:, 0]
+                    attention_mask=feature.post_pad_mask, hidden_idx=-1)[:, 0]
         # worse
         # post_enc = self.post_encoder(post_emb, feature.post_pad_mask)
         context_emb = self.context_emb(feature)
@@ -135,15 +225,16 @@ class AR(nn.Module):
         context_emb = context_emb + o
         context_enc = self.post_encoder(context_emb, feature.context_pad_mask)
 
-        x_mlm_enc = self.encode_lm(feature)
-        
-        return context_enc, persona_enc, x_mlm_enc
+        return context_enc, persona_enc
 
     def _share_mem_n2n_layers(self):
         for i in range(self.mem_n2n_hops):
             if i < self.mem_n2n_hops-1:
                 self.mem_output[i].emb.weight = self.mem_input[i+1].emb.weight
 
+    def _with_lm(self, feature):
+        return self.auxiliary_task is not None and feature.lm is not None
+
     def encode_lm(self, feature):
         x_mlm_enc = None
         if self.auxiliary_task == 'MLM':
@@ -151,7 +242,7 @@ class AR(nn.Module):
             x_mlm_enc = self.post_encoder(x_mlm_emb, feature.lm.x_mlm_pad_mask)
         return x_mlm_enc
 
-    def decode(self, feature, context_enc, persona_enc, x_mlm_enc):
+    def decode(self, feature, context_enc, persona_enc, x_mlm_enc, logits=True):
         persona_bias = None
        #post_emb = self.seq_emb(feature.post, feature.post_pad_mask)
        #p = self.mem_input(feature.persona, post_emb, feature.persona_pad_mask)
@@ -168,17 +259,18 @@ class AR(nn.Module):
 
 
         if persona_bias is not None:
-            out_gen = self.generate(out + persona_bias)
-        else:
-            out_gen = self.generate(out)
-
-        enc_lm = self.output_emb(feature.lm.x, 
-                feature.lm.x_pad_mask)
-        out_lm = self.resp_decoder(enc_lm, memory=x_mlm_enc, 
-                memory_key_padding_mask=feature.lm.x_mlm_pad_mask,
-                tgt_mask=feature.lm.x_mask,
-                tgt_key_padding_mask=feature.lm.x_pad_mask) 
-        out_lm_gen = self.generate(out_lm)
+            out = out + persona_bias
+        out_gen = self.generate(out) if logits else out
+
+        out_lm_gen = None
+        if self._with_lm(feature):
+            enc_lm = self.output_emb(feature.lm.x, 
+                    feature.lm.x_pad_mask)
+            out_lm = self.resp_decoder(enc_lm, memory=x_mlm_enc, 
+                    memory_key_padding_mask=feature.lm.x_mlm_pad_mask,
+                    tgt_mask=feature.lm.x_mask,
+                    tgt_key_padding_mask=feature.lm.x_pad_mask) 
+            out_lm_gen = self.generate(out_lm) if logits else out_lm
 
         return out_gen, out_lm_gen
 
@@ -317,29 +409,19 @@ class AR(nn.Module):
         fn = None
         _pretrain_feature_model = pretrain_feature_model
         if pretrain_feature_model is not None and args.pretrain_feature_type != 'weight':
-            # don't define as layer, or the model weights will be saved to checkpoint
-            def fn(x, position_ids=None, attention_mask=None):
-                # 'requires_grad_(False)' just for disable backward calc grad, 
-                # add 'with torch.no_grad()' to disable save activation
-                with torch.no_grad():
-                    return pretrain_feature_model(
-                            x, position_ids=position_ids,
-                            attention_mask=attention_mask)
-                            # last layer hid
-                            #attention_mask=attention_mask)[0]
-                            # last layer CLS hid
-                            # attention_mask=attention_mask)[0][0].unsqueeze(0)
-                            # emb
-                            #attention_mask=attention_mask)[1][0]
+            fn = pretrain_feature_fn(pretrain_feature_model)
             if args.pretrain_feature_type == 'mem_n2n':
                 _pretrain_feature_model = fn
                 fn = None
 
+        # model configs of older experiments have no persona_feature_version, 
+        # they are trained with version 1
+        persona_feature_version = getattr(args, 'persona_feature_version', 1)
         context_emb = modules.ContextEmb(sep_idx, spe1_idx, spe2_idx,
                 input_dim, args.emb_dim, args.emb_freeze, 
                 args.d_model, pad_idx, args.dropout, 
                 args.persona_vocab_size, args.use_mem_n2n, 
-                embeddings, fn)
+                embeddings, fn, persona_feature_version)
         if args.use_mem_n2n:
             persona_emb = modules.PersonaEmb(
                     args.persona_vocab_size, args.emb_dim, False,
@@ -352,16 +434,19 @@ class AR(nn.Module):
         output_emb = modules.OutputEmb(input_dim, args.emb_dim, args.emb_freeze,
                 args.d_model, pad_idx, args.dropout, embeddings, fn)
 
+        # model configs of older experiments have no grad_checkpoint
+        grad_checkpoint = getattr(args, 'grad_checkpoint', False)
         post_encoder = modules.TransformerEncoder(input_dim, args.d_model, args.d_ff, 
                 args.n_head, args.num_layers, args.num_groups, args.dropout,
                 'relu', args.factor_ff, args.adapter_finetune, args.adapter_d_ff,
-                args.use_rezero)
+                args.use_rezero, grad_checkpoint=grad_checkpoint)
 
         resp_decoder_layer = modules.TransformerDecoderLayer(args.d_model, args.n_head, 
                 args.attn_alpha, args.d_ff, args.dropout, 
                 'relu', args.factor_ff, args.adapter_finetune, args.adapter_d_ff,
                 args.use_rezero)
-        resp_decoder = modules.TransformerDecoder(resp_decoder_layer, args.num_layers, args.num_groups)
+        resp_decoder = modules.TransformerDecoder(resp_decoder_layer, args.num_layers, args.num_groups,
+                grad_checkpoint=grad_checkpoint)
         generater = modules.Generater(args.emb_dim, args.d_model, output_dim)
 
         if args.n_epochs_early_stage > 0:
@@ -390,11 +475,23 @@ class AR(nn.Module):
     def loss(auxiliary_task, loss_fn, out, out_lm, resp, lm_y):
         loss = loss_fn(out[:-1].view(-1, out.shape[-1]), resp[1:].view(-1))
         loss_lm = None
-        if auxiliary_task is not None:
+        if auxiliary_task is not None and out_lm is not None:
             loss_lm = loss_fn(out_lm.view(-1, out.shape[-1]), lm_y.view(-1))
 
         return loss, loss_lm
 
+    def chunked_loss(self, auxiliary_task, ignore_index, chunk_size, out, out_lm, resp, lm_y):
+        """Same as loss, with decoder outputs of forward(logits=False), 
+        the vocab logits are computed in chunks of chunk_size positions by Generater.loss,
+        use forward(loss_chunk=...) in distributed training
+        """
+        loss = self.generater.loss(out[:-1], resp[1:], ignore_index, chunk_size)
+        loss_lm = None
+        if auxiliary_task is not None and out_lm is not None:
+            loss_lm = self.generater.loss(out_lm, lm_y, ignore_index, chunk_size)
+
+        return loss, loss_lm
+
 
 class LM(AR):
     def forward(self, feature):
@@ -1,4 +1,5 @@
 
+import copy
 import math
 import random
 import sys
@@ -9,13 +10,39 @@ import utils
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint as torch_cp
 
 
 # FIXME: fix old code, all combined dim with view, the new dim should be dim0 * dim1, not dim0 + dim1
 # FIXME: attention should all mask pad, see http://nlp.seas.harvard.edu/2018/04/03/attention.html, or softmax will add score to 0s
 
 
-_ALL_HID_STATES_IDX = -1
+def truncate_pretrain_feature_model(model, n_layers):
+    """Shallow copy of the pretrain feature model which only runs the first n_layers
+
+    Its last hidden state is hidden_states[n_layers] of the full model
+    (hidden_states[0] is the embedding output), the weights are shared.
+    Returns None if the model can't be truncated.
+    """
+    encoder = copy.copy(model.encoder)
+    encoder._modules = copy.copy(model.encoder._modules)
+    encoder.config = copy.copy(model.encoder.config)
+    encoder.config.num_hidden_layers = n_layers
+    if hasattr(encoder, 'layer'):
+        # bert
+        encoder.layer = nn.ModuleList(model.encoder.layer[:n_layers])
+    elif model.config.num_hidden_groups != 1:
+        # albert layer group index depends on num_hidden_layers
+        return None
+
+    truncated = copy.copy(model)
+    truncated._modules = copy.copy(model._modules)
+    truncated.config = copy.copy(model.config)
+    truncated.config.num_hidden_layers = n_layers
+    truncated.config.output_hidden_states = False
+    truncated.encoder = encoder
+
+    return truncated
 
 
 class ContextEmb(nn.Module):
@@ -35,11 +62,16 @@ class ContextEmb(nn.Module):
         use_mem_n2n,
         embeddings=None,
         pretrain_feature_model=None,
+        persona_feature_version=2,
     ):
+        """persona_feature_version: 2 sums only the tokens of the pretrain speaker 
+            features by utils.speakers_sum, 1 is for models trained before it
+        """
         super().__init__()
         self.sep_idx = sep_idx
         self.spe1_idx = spe1_idx
         self.spe2_idx = spe2_idx
+        self.persona_feature_version = persona_feature_version
         self.emb_dim = emb_dim
         self.input_dim = input_dim
         self.d_model = d_model
@@ -62,7 +94,10 @@ class ContextEmb(nn.Module):
         if use_mem_n2n:
             self.persona_emb = nn.Embedding(persona_vocab_size, emb_dim)
 
-    def forward(self, feature):
+    def forward(self, feature, with_persona=False):
+        """with_persona: also return the pretrain feature of feature.persona for PersonaEmb,
+                      it is in the same emb1 call, None if not pretrain_feature
+        """
         def orig_emb(feature):
             # context: seq_len X batch_size
             #      seq: ..._SEP...
@@ -92,45 +127,69 @@ class ContextEmb(nn.Module):
 
         if self.pretrain_feature:
             def new_emb(feature):
+                if feature.pretrain_hid is not None:
+                    # precomputed by datasets.PretrainFeatureStore,
+                    # speakers: 2 X batch_size X emb_dim
+                    emb = add_personas_emb(feature.pretrain_hid.context, 
+                            feature.pretrain_hid.speakers, feature.segs)
+                    return emb, feature.pretrain_hid.persona
+
                 context = feature.context.transpose(0, 1)
                 segs = feature.segs.transpose(0, 1)
+                # batch_size X 2 * n_persona, the tokens of speaker 1 then speaker 2
                 personas_no_tag = feature.personas_no_tag.permute(2, 0, 1)
                 tags = feature.tags.permute(2, 0, 1)
-                personas_no_tag = personas_no_tag.view(personas_no_tag.shape[0], -1)
-                tags = tags.view(tags.shape[0], -1)
+                personas_no_tag = personas_no_tag.reshape(personas_no_tag.shape[0], -1)
+                tags = tags.reshape(tags.shape[0], -1)
                 context_pad_mask = (feature.context_pad_mask != 1).float()
-                personas_no_tag_pad_mask = (feature.personas_no_tag_pad_mask.view(
-                        feature.personas_no_tag_pad_mask.shape[0], -1) != 1).float()
-                tags_pad_mask = (feature.tags_pad_mask.view(
-                        feature.tags_pad_mask.shape[0], -1) != 1).float()
+
+                def speakers_pad_mask(pad_mask):
+                    # batch_size X n_persona X 2 --> batch_size X 2 * n_persona, 
+                    # the same layout as the tokens, version 1 keeps the (n_persona, 2) order
+                    if self.persona_feature_version >= 2:
+                        pad_mask = pad_mask.transpose(1, 2)
+                    return (pad_mask.reshape(pad_mask.shape[0], -1) != 1).float()
+
+                personas_no_tag_pad_mask = speakers_pad_mask(feature.personas_no_tag_pad_mask)
+                tags_pad_mask = speakers_pad_mask(feature.tags_pad_mask)
 
                 personas_no_tag_position_ids = torch.zeros_like(personas_no_tag)
                 tags_position_ids = torch.zeros_like(tags)
-                persona_dim = 1
-
-                emb = self.emb1(context, attention_mask=context_pad_mask)[_ALL_HID_STATES_IDX][-2]
 
                 # segs_emb = self.emb1(segs)
 
+                inputs = [(context, None, context_pad_mask),
+                        (personas_no_tag, personas_no_tag_position_ids, personas_no_tag_pad_mask),
+                        (tags, tags_position_ids, tags_pad_mask)]
+                if with_persona:
+                    # same as PersonaEmb
+                    persona = feature.persona.transpose(0, 1)
+                    inputs.append((persona, torch.zeros_like(persona), 
+                        (feature.persona_pad_mask != 1).float()))
+                # all short sequences in one emb1 call
+                hids = fused_emb1(self.emb1, inputs, hidden_idx=-2)
                 # batch_size X 2 * n_persona X emb_dim
-                personas_emb = self.emb1(personas_no_tag, 
-                        position_ids=personas_no_tag_position_ids,
-                        attention_mask=personas_no_tag_pad_mask)[_ALL_HID_STATES_IDX][-2]
                 # batch_size X 2 * n_tags X emb_dim
-                tags_emb = self.emb1(tags,
-                        position_ids=tags_position_ids,
-                        attention_mask=tags_pad_mask)[_ALL_HID_STATES_IDX][-2]
+                emb, personas_emb, tags_emb = hids[:3]
+                persona_hid = hids[3].transpose(0, 1) if with_persona else None
 
-                personas_emb = personas_emb.view(personas_emb.shape[0], 2, 
-                        -1, personas_emb.shape[2])
-                tags_emb = tags_emb.view(tags_emb.shape[0], 2, -1, tags_emb.shape[2])
                 segs = segs.transpose(0, 1)
-                personas_emb = personas_emb.permute(1, 2, 0, 3)
-                tags_emb = tags_emb.permute(1, 2, 0, 3)
                 emb = emb.transpose(0, 1)
 
-                # 2 X batch_size X emb_dim
-                personas_emb = torch.cat([personas_emb, tags_emb], dim=persona_dim).sum(dim=persona_dim)
+                # 2 X batch_size X emb_dim, the same sum as datasets.PretrainFeatureStore
+                if self.persona_feature_version >= 2:
+                    personas_emb = (utils.speakers_sum(personas_emb, personas_no_tag_pad_mask)
+                            + utils.speakers_sum(tags_emb, tags_pad_mask))
+                else:
+                    # the pads are summed too
+                    personas_emb = torch.cat([
+                        personas_emb.reshape(personas_emb.shape[0], 2, -1, personas_emb.shape[2]), 
+                        tags_emb.reshape(tags_emb.shape[0], 2, -1, tags_emb.shape[2])], 
+                        dim=2).sum(dim=2).transpose(0, 1)
+
+                return add_personas_emb(emb, personas_emb, segs), persona_hid
+
+            def add_personas_emb(emb, personas_emb, segs):
                 # segs spe1_idx and spe2_idx is not a must
                 # (segs == idx) can be created from iterate context
                 fn = lambda emb, idx, i: torch.where(
@@ -145,7 +204,7 @@ class ContextEmb(nn.Module):
            #emb = emb + self.pos_encoder(emb)
            #emb = self.proj(emb)
            #emb = self.dropout(emb)
-            emb = new_emb(feature)
+            emb, persona_hid = new_emb(feature)
         else:
             emb = orig_emb(feature)
             emb = emb + self.pos_encoder(emb)
@@ -153,15 +212,47 @@ class ContextEmb(nn.Module):
             if self.emb_dim != self.d_model:
                 emb = self.proj(emb)
             emb = self.dropout(emb)
+            persona_hid = None
 
+        if with_persona:
+            return emb, persona_hid
         return emb
 
 
-def create_position_ids(input_ids):
+def fused_emb1(emb1, inputs, hidden_idx=-2):
+    """Run emb1 once for several inputs, padded into one batch
+
+    inputs: [(x, position_ids, attention_mask)], batch first,
+            position_ids None for 0, 1, 2...
+    Returns the hidden states of every input, batch_size X seq_len X hid_dim
+    """
+    max_len = max(x.shape[1] for x, _, _ in inputs)
+    xs, position_ids, attention_masks = [], [], []
+    for x, pos, mask in inputs:
+        if pos is None:
+            pos = create_position_ids(x.T).T
+        # the padded positions are masked
+        pad = (0, max_len - x.shape[1])
+        xs.append(F.pad(x, pad))
+        position_ids.append(F.pad(pos, pad))
+        attention_masks.append(F.pad(mask, pad))
+
+    hid = emb1(torch.cat(xs), position_ids=torch.cat(position_ids),
+            attention_mask=torch.cat(attention_masks), hidden_idx=hidden_idx)
+    hids = []
+    start = 0
+    for x, _, _ in inputs:
+        hids.append(hid[start:start+x.shape[0], :x.shape[1]])
+        start += x.shape[0]
+
+    return hids
+
+
+def create_position_ids(input_ids, start_pos=0):
     device = input_ids.device
     input_shape = input_ids.shape
     seq_length = input_shape[0]
-    position_ids = torch.arange(seq_length, dtype=torch.long, device=device)
+    position_ids = torch.arange(start_pos, start_pos+seq_length, dtype=torch.long, device=device)
     position_ids = position_ids.unsqueeze(1).expand(input_shape)
     return position_ids
 
@@ -194,7 +285,8 @@ class PersonaEmb(nn.Module):
             self.emb1 = pretrain_feature_model
         self.emb = utils.embedding(input_dim, emb_dim, embeddings, emb_freeze, pad_idx)
 
-    def forward(self, persona, persona_pad_mask):
+    def forward(self, persona, persona_pad_mask, persona_hid=None):
+        """persona_hid: precomputed pretrain feature of persona, or None"""
         def orig_emb(persona):
             # seq_len(k;v) X batch_size X emb_dim
             emb = self.emb(persona) * math.sqrt(self.emb_dim)
@@ -209,7 +301,7 @@ class PersonaEmb(nn.Module):
                 # batch_size X seq_len(k;v) X emb_dim
                 emb = self.emb1(persona, 
                         position_ids=persona_position_ids,
-                        attention_mask=persona_pad_mask)[_ALL_HID_STATES_IDX][-2]
+                        attention_mask=persona_pad_mask, hidden_idx=-2)
 
                 emb = emb.transpose(0, 1)
 
@@ -218,7 +310,10 @@ class PersonaEmb(nn.Module):
            #emb = torch.cat([new_emb(persona, persona_pad_mask), orig_emb(persona)], dim=2)
            #emb = self.proj(emb)
            #emb = self.dropout(emb)
-            emb = new_emb(persona, persona_pad_mask)
+            if persona_hid is not None:
+                emb = persona_hid
+            else:
+                emb = new_emb(persona, persona_pad_mask)
         else:
             emb = orig_emb(persona)
             if self.emb_dim != self.d_model:
@@ -269,7 +364,7 @@ class SeqEmb(nn.Module):
                 x_pad_mask = (x_pad_mask != 1).float()
 
                 emb = self.emb1(x, 
-                        attention_mask=x_pad_mask)[_ALL_HID_STATES_IDX][-2]
+                        attention_mask=x_pad_mask, hidden_idx=-2)
 
                 emb = emb.transpose(0, 1)
 
@@ -317,7 +412,8 @@ class OutputEmb(nn.Module):
             self.emb1 = pretrain_feature_model
         self.emb = utils.embedding(input_dim, emb_dim, embeddings, emb_freeze, pad_idx)
 
-    def forward(self, output, output_pad_mask):
+    def forward(self, output, output_pad_mask, start_pos=0):
+        """start_pos: position of output[0], for incremental decoding"""
         def orig_emb(x):
             emb = self.emb(output) * math.sqrt(self.emb_dim)
             return emb 
@@ -326,11 +422,14 @@ class OutputEmb(nn.Module):
             def new_emb(x, x_pad_mask):
                 x = x.transpose(0, 1)
                 x_pad_mask = (x_pad_mask != 1).float()
+                position_ids = None
+                if start_pos > 0:
+                    position_ids = create_position_ids(x.T, start_pos).T
 
                 # XXX: must get pretrain_feature_model emb, not hidden state after self attention
                 #      or future output token will be attended
-                emb = self.emb1(x, 
-                        attention_mask=x_pad_mask)[_ALL_HID_STATES_IDX][0]
+                emb = self.emb1(x, position_ids=position_ids,
+                        attention_mask=x_pad_mask, hidden_idx=0)
 
                 emb = emb.transpose(0, 1)
 
@@ -340,7 +439,7 @@ class OutputEmb(nn.Module):
             emb = new_emb(output, output_pad_mask)
         else:
             emb = orig_emb(output)
-            emb = emb + self.pos_encoder(emb)
+            emb = emb + self.pos_encoder(emb, start_pos)
             if self.emb_dim != self.d_model:
                 emb = self.proj(emb)
             emb = self.dropout(emb)
@@ -363,10 +462,13 @@ class TransformerEncoder(nn.Module):
         adapter_finetune, 
         adapter_d_ff,
         use_rezero=True,
-        norm=None
+        norm=None,
+        grad_checkpoint=False
     ):
+        """grad_checkpoint: recompute the activations of every layer call in backward"""
         super().__init__()
         self.num_layers = num_layers
+        self.grad_checkpoint = grad_checkpoint
 
         # TODO: move out layer define
         if use_rezero:
@@ -386,8 +488,8 @@ class TransformerEncoder(nn.Module):
         layers_in_group = len(self.layers)
         for _ in range(self.num_groups):
             for i in range(layers_in_group):
-                output = self.layers[i](output, src_mask=None,
-                                        src_key_padding_mask=pad_mask)
+                output = _layer_call(self.grad_checkpoint, self.layers[i], 
+                        output, src_mask=None, src_key_padding_mask=pad_mask)
 
         if self.norm:
             output = self.norm(output)
@@ -503,26 +605,36 @@ class TransformerDecoderLayer(nn.Module):
 
         self.activation = nn.modules.transformer._get_activation_fn(activation)
 
+    def _attn(self, query, key, cache=None, cache_key=None,
+            attn_mask=None, key_padding_mask=None):
+        if cache is None:
+            return self.multihead_attn(query, key, key, attn_mask=attn_mask,
+                                  key_padding_mask=key_padding_mask)[0]
+        # incremental decoding, query and self attention key are the new positions only
+        return utils.cached_multihead_attn(self.multihead_attn, query, key, 
+                cache, cache_key, attn_mask=attn_mask, 
+                key_padding_mask=key_padding_mask, static=cache_key != 'prev')
+
     def forward(self, tgt, memory, persona, 
             tgt_mask=None, memory_mask=None,
             tgt_key_padding_mask=None, memory_key_padding_mask=None,
-            persona_pad_mask=None):
+            persona_pad_mask=None, cache=None):
         tgt = self.pre_norm(tgt)
 
         if self.use_rezero:
             attn_t = 0
             attn_c = 0
-            attn_prev = self.multihead_attn(tgt, tgt, tgt, attn_mask=tgt_mask,
-                                  key_padding_mask=tgt_key_padding_mask)[0]
+            attn_prev = self._attn(tgt, tgt, cache, 'prev', attn_mask=tgt_mask,
+                                  key_padding_mask=tgt_key_padding_mask)
             if persona is not None and memory is not None:
-                attn_t = self.multihead_attn(tgt, persona, persona, 
-                        key_padding_mask=persona_pad_mask)[0]
-                attn_c = self.multihead_attn(tgt, memory, memory, attn_mask=memory_mask, 
-                        key_padding_mask=memory_key_padding_mask)[0]
+                attn_t = self._attn(tgt, persona, cache, 'persona',
+                        key_padding_mask=persona_pad_mask)
+                attn_c = self._attn(tgt, memory, cache, 'memory', attn_mask=memory_mask, 
+                        key_padding_mask=memory_key_padding_mask)
             elif memory is not None:
                 # for mlm
-                attn_c = self.multihead_attn(tgt, memory, memory, attn_mask=memory_mask, 
-                        key_padding_mask=memory_key_padding_mask)[0]
+                attn_c = self._attn(tgt, memory, cache, 'memory', attn_mask=memory_mask, 
+                        key_padding_mask=memory_key_padding_mask)
             alpha = self.cls(memory) if self.attn_alpha is None else self.attn_alpha 
             attn_merge = alpha*attn_t + (1-alpha)*attn_c + attn_c + attn_prev
             a = 0.1
@@ -552,17 +664,17 @@ class TransformerDecoderLayer(nn.Module):
         elif True:
             attn_t = 0
             attn_c = 0
-            attn_prev = self.multihead_attn(tgt, tgt, tgt, attn_mask=tgt_mask,
-                                  key_padding_mask=tgt_key_padding_mask)[0]
+            attn_prev = self._attn(tgt, tgt, cache, 'prev', attn_mask=tgt_mask,
+                                  key_padding_mask=tgt_key_padding_mask)
             if persona is not None and memory is not None:
-                attn_t = self.multihead_attn(tgt, persona, persona, 
-                        key_padding_mask=persona_pad_mask)[0]
-                attn_c = self.multihead_attn(tgt, memory, memory, attn_mask=memory_mask, 
-                        key_padding_mask=memory_key_padding_mask)[0]
+                attn_t = self._attn(tgt, persona, cache, 'persona',
+                        key_padding_mask=persona_pad_mask)
+                attn_c = self._attn(tgt, memory, cache, 'memory', attn_mask=memory_mask, 
+                        key_padding_mask=memory_key_padding_mask)
             # auxiliary_task == 'MLM'
             elif memory is not None:
-                attn_c = self.multihead_attn(tgt, memory, memory, attn_mask=memory_mask, 
-                        key_padding_mask=memory_key_padding_mask)[0]
+                attn_c = self._attn(tgt, memory, cache, 'memory', attn_mask=memory_mask, 
+                        key_padding_mask=memory_key_padding_mask)
 
             alpha = self.cls(memory) if self.attn_alpha is None else self.attn_alpha 
             attn_merge = alpha*attn_t + (1-alpha)*attn_c + attn_c + attn_prev
@@ -799,36 +911,62 @@ class TransformerDecoder(nn.Module):
     r"""Derived from torch.nn.TransformerDecoder
     """
 
-    def __init__(self, decoder_layer, num_layers, num_groups, norm=None):
+    def __init__(self, decoder_layer, num_layers, num_groups, norm=None, grad_checkpoint=False):
+        """grad_checkpoint: recompute the activations of every layer call in backward, 
+        not for incremental decoding with cache
+        """
         super(TransformerDecoder, self).__init__()
 
         layers_in_group = num_layers // num_groups
         self.num_groups = num_groups
         self.layers = nn.modules.transformer._get_clones(decoder_layer, layers_in_group)
         self.norm = norm
+        self.grad_checkpoint = grad_checkpoint
 
     def forward(self, tgt_emb, memory=None, persona=None, 
             memory_mask=None, memory_key_padding_mask=None,
             tgt_mask=None, tgt_key_padding_mask=None,
-            persona_pad_mask=None):
-        """Train language model When memory and persona is None"""
+            persona_pad_mask=None, cache=None):
+        """Train language model When memory and persona is None
+
+        When cache (from init_cache) is given, tgt_emb is only the positions 
+        after cache.step, tgt_mask and tgt_key_padding_mask cover all positions.
+        """
         output = tgt_emb
 
         layers_in_group = len(self.layers)
-        for _ in range(self.num_groups):
+        for j in range(self.num_groups):
             for i in range(layers_in_group):
-                output, alpha = self.layers[i](
+                output, alpha = _layer_call(
+                        self.grad_checkpoint and cache is None, self.layers[i],
                         output, memory, persona=persona,
                         tgt_mask=tgt_mask, memory_mask=memory_mask, 
                         tgt_key_padding_mask=tgt_key_padding_mask,
                         memory_key_padding_mask=memory_key_padding_mask,
-                        persona_pad_mask=persona_pad_mask)
+                        persona_pad_mask=persona_pad_mask,
+                        cache=None if cache is None else cache[j*layers_in_group + i])
 
         if self.norm:
             output = self.norm(output)
 
+        if cache is not None:
+            cache.step += tgt_emb.shape[0]
+
         return output
 
+    def init_cache(self):
+        return utils.DecoderCache(self.num_groups * len(self.layers))
+
+
+def _layer_call(grad_checkpoint, layer, *args, **kwargs):
+    """layer(*args, **kwargs), checkpointed if grad_checkpoint in training with grad, 
+    the RNG state is restored for the recompute, so dropout masks are the same
+    """
+    if grad_checkpoint and layer.training and torch.is_grad_enabled():
+        return torch_cp.checkpoint(layer, *args, use_reentrant=False, 
+                preserve_rng_state=True, **kwargs)
+    return layer(*args, **kwargs)
+
 
 class Generater(nn.Module):
     def __init__(
@@ -844,6 +982,75 @@ class Generater(nn.Module):
     def forward(self, enc):
         return self.out(enc)
 
+    def loss(self, enc, target, ignore_index, chunk_size):
+        """Same as CrossEntropyLoss(ignore_index) of forward(enc) and target, 
+        the logits are computed in chunks of chunk_size positions and not kept
+
+        Shape:
+            enc: seq_len X batch_size X d_model
+            target: seq_len X batch_size
+        """
+        return _ChunkedCrossEntropy.apply(enc.reshape(-1, enc.shape[-1]), 
+                self.out.weight, target.reshape(-1), ignore_index, chunk_size)
+
+
+class _ChunkedCrossEntropy(torch.autograd.Function):
+    """Mean cross entropy of linear(hidden, weight) logits, 
+    backward recomputes the logits of every chunk
+
+    Under autocast, the logits are computed in the autocast dtype, 
+    and backward uses the same dtype for the matmuls (backward is out of autocast).
+    """
+    @staticmethod
+    def forward(ctx, hidden, weight, target, ignore_index, chunk_size):
+        # dtype of the logits, bf16 under autocast
+        logits_dtype = F.linear(hidden[:1], weight[:1]).dtype
+        # float at least for logsumexp
+        dtype = torch.promote_types(logits_dtype, torch.float)
+        valid = target != ignore_index
+        lse = hidden.new_empty(hidden.shape[0], dtype=dtype)
+        total = hidden.new_zeros((), dtype=dtype)
+        for i in range(0, hidden.shape[0], chunk_size):
+            logits = F.linear(hidden[i:i+chunk_size], weight).to(dtype)
+            lse[i:i+chunk_size] = logits.logsumexp(-1)
+            t = target[i:i+chunk_size].clamp(min=0)
+            nll = lse[i:i+chunk_size] - logits.gather(1, t.unsqueeze(1)).squeeze(1)
+            total += nll.masked_fill(~valid[i:i+chunk_size], 0).sum()
+        n_valid = valid.sum()
+
+        ctx.save_for_backward(hidden, weight, target, lse, n_valid)
+        ctx.chunk_size = chunk_size
+        ctx.ignore_index = ignore_index
+        ctx.logits_dtype = logits_dtype
+        return total / n_valid
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        hidden, weight, target, lse, n_valid = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        scale = grad_output / n_valid
+        w = weight.to(ctx.logits_dtype)
+
+        grad_hidden = torch.empty_like(hidden) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros_like(weight, dtype=lse.dtype) if ctx.needs_input_grad[1] else None
+        for i in range(0, hidden.shape[0], chunk_size):
+            h = hidden[i:i+chunk_size].to(ctx.logits_dtype)
+            t = target[i:i+chunk_size]
+            # d nll / d logits = softmax - one_hot
+            grad_logits = (F.linear(h, w).to(lse.dtype) - lse[i:i+chunk_size].unsqueeze(1)).exp_()
+            grad_logits.scatter_add_(1, t.clamp(min=0).unsqueeze(1), 
+                    grad_logits.new_full((len(t), 1), -1))
+            grad_logits.mul_(((t != ctx.ignore_index) * scale).unsqueeze(1))
+            grad_logits = grad_logits.to(ctx.logits_dtype)
+            if grad_hidden is not None:
+                grad_hidden[i:i+chunk_size] = grad_logits @ w
+            if grad_weight is not None:
+                grad_weight += grad_logits.T @ h
+
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+        return grad_hidden, grad_weight, None, None, None
+
  
 class _MemInput(nn.Module):
     def __init__(
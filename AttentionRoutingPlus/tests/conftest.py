@@ -0,0 +1,8 @@
+import pytest
+
+import plus_testing
+
+
+@pytest.fixture(autouse=True)
+def package_modules():
+    plus_testing.use_modules()
@@ -0,0 +1,146 @@
+"""Shared helpers of the AttentionRoutingPlus tests
+
+AttentionRouting has modules of the same names (modules, models, datasets),
+the modules of this package are imported once here and put back into
+sys.modules by conftest before every test.
+"""
+import os
+import sys
+import random
+import types
+
+PKG_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOT = os.path.dirname(PKG_DIR)
+NAMES = ('utils', 'modules', 'models', 'datasets')
+
+
+def _import_modules():
+    for name in NAMES:
+        sys.modules.pop(name, None)
+    sys.path[:0] = [PKG_DIR, ROOT]
+    try:
+        import utils, modules, models, datasets
+    finally:
+        del sys.path[:2]
+    return {name: sys.modules[name] for name in NAMES}
+
+
+MODULES = _import_modules()
+utils = MODULES['utils']
+modules = MODULES['modules']
+models = MODULES['models']
+datasets = MODULES['datasets']
+
+
+def use_modules():
+    sys.modules.update(MODULES)
+
+
+def import_trainer():
+    """trainer of this package, with the modules of use_modules,
+    AttentionRouting has a trainer module too
+    """
+    sys.modules.pop('trainer', None)
+    sys.path[:0] = [PKG_DIR, ROOT]
+    try:
+        import trainer
+    finally:
+        del sys.path[:2]
+    return trainer
+
+
+class FakeVocab:
+    """n words and the special tokens, pad is utils.PAD"""
+    def __init__(self, n=50):
+        self.tokens = ['w%d' % i for i in range(n)] + utils.PRESET_SPECIAL_TOKENS
+        self.index = {k: i for i, k in enumerate(self.tokens)}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def stoi(self, s):
+        return self.index.get(s, self.index[utils.UNK])
+
+    def itos(self, i):
+        return self.tokens[i]
+
+
+def model_args(**kwargs):
+    """Small config of models.AR.build"""
+    args = types.SimpleNamespace(
+        emb_dim=32, emb_freeze=False, d_model=32, dropout=0.0, persona_vocab_size=None,
+        use_mem_n2n=False, mem_n2n_hops=3, mem_n2n_layer_share='adjacent',
+        num_layers=4, num_groups=2, n_head=4, d_ff=64, attn_alpha=1, factor_ff=True,
+        adapter_finetune=False, adapter_d_ff=64, use_rezero=True,
+        n_epochs_early_stage=0, share_encoder_decoder=True,
+        pretrain_feature_type='feature', auxiliary_task='MLM',
+        max_seq_length=8, max_context_size=4, grad_checkpoint=False,
+        persona_feature_version=2)
+    args.__dict__.update(kwargs)
+    return args
+
+
+def build_model(vocab, pretrain_feature_model=None, seed=0, **kwargs):
+    import torch
+    torch.manual_seed(seed)
+    model = models.AR.build(model_args(**kwargs), len(vocab), len(vocab), vocab,
+            None, pretrain_feature_model)
+    # rezero weights start at 0, the layers are skipped
+    for m in model.modules():
+        if hasattr(m, 'resweight'):
+            m.resweight.data.fill_(0.3)
+    return model
+
+
+def build_pretrain_feature_model(vocab):
+    """Tiny random bert as the pretrain feature model"""
+    import torch
+    from transformers import BertConfig, BertModel
+    torch.manual_seed(0)
+    model = BertModel(BertConfig(vocab_size=len(vocab), hidden_size=32,
+        num_hidden_layers=3, num_attention_heads=4, intermediate_size=64,
+        output_hidden_states=True)).eval()
+    model.requires_grad_(False)
+    return model
+
+
+def chat_examples(vocab, n, max_len=8, seed=0):
+    """Features of n random chat examples, as ChatDataProcesser.convert_examples_to_features"""
+    rnd = random.Random(seed)
+    words = range(40)
+    sep, spe1, spe2 = vocab.stoi(utils.SEP), vocab.stoi(utils.SPE1), vocab.stoi(utils.SPE2)
+    examples = []
+    for _ in range(n):
+        n_posts = rnd.choice([1, 3, 5])
+        posts = [[rnd.choice(words) for _ in range(rnd.randint(1, max_len))] + [sep]
+                for _ in range(n_posts)]
+        segs = []
+        for i in range(0, n_posts, 2):
+            segs += [spe1] * len(posts[i]) + ([spe2] * len(posts[i+1]) if i+1 < n_posts else [])
+        personas_no_tag = [[rnd.choice(words) for _ in range(rnd.randint(2, 3))] for _ in range(2)]
+        tags = [[rnd.choice(words) for _ in range(rnd.randint(1, 4))] for _ in range(2)]
+        resp = [vocab.stoi(utils.SOS)] + [rnd.choice(words)
+                for _ in range(rnd.randint(1, max_len))] + [vocab.stoi(utils.EOS)]
+        persona = [rnd.choice(words) for _ in range(rnd.randint(3, 7))]
+        examples.append((sum(posts, []), segs, personas_no_tag, tags, resp, persona, resp))
+    return examples
+
+
+def write_chat_data(data_path, mode, n_sessions, seed=0):
+    """n_sessions random sessions in the format of ChatDataProcesser.get_sessions,
+    words of FakeVocab, to data_path/mode.txt
+    """
+    import json
+    rnd = random.Random(seed)
+    sentence = lambda: ' '.join('w%d' % rnd.randrange(40) for _ in range(rnd.randint(1, 6)))
+    with open(os.path.join(data_path, mode + '.txt'), 'w') as f:
+        for _ in range(n_sessions):
+            profile = [dict(loc=sentence(), gender=rnd.choice(['male', 'female']), 
+                tag=[sentence().replace(' ', ';')]) for _ in range(2)]
+            dialog = [[sentence()] for _ in range(rnd.randint(2, 7))]
+            f.write(json.dumps(dict(dialog=dialog, profile=profile)) + '\n')
+
+
+def chat_processer(vocab, **kwargs):
+    return datasets.ChatDataProcesser(**dict(dict(max_seq_length=8, max_context_size=4,
+        vocab=vocab), **kwargs))
@@ -0,0 +1,57 @@
+import json
+import os
+import time
+
+from plus_testing import utils
+
+
+def _add_entry(cache_path, manifest, name, source):
+    for suffix in ('.a', '.b'):
+        open(os.path.join(cache_path, name + suffix), 'w').close()
+    manifest.add(name, dict(source=utils.fingerprint_file(source)), ('.a', '.b'))
+
+
+def _set_last_used(manifest, name, last_used):
+    with open(manifest.fname) as f:
+        entries = json.load(f)
+    entries[name]['last_used'] = last_used
+    with open(manifest.fname, 'w') as f:
+        json.dump(entries, f)
+
+
+def test_evict_stale_removes_entries_of_changed_sources(tmp_path):
+    source = str(tmp_path / 'train.txt')
+    with open(source, 'w') as f:
+        f.write('a\n')
+    manifest = utils.CacheManifest(str(tmp_path))
+    _add_entry(str(tmp_path), manifest, 'cached_train', source)
+
+    manifest.evict_stale()
+    assert os.path.exists(tmp_path / 'cached_train.a')
+
+    with open(source, 'a') as f:
+        f.write('more lines\n')
+    manifest.evict_stale()
+    assert not os.path.exists(tmp_path / 'cached_train.a')
+    assert not os.path.exists(tmp_path / 'cached_train.b')
+    assert manifest._load() == {}
+
+
+def test_evict_unused_removes_old_entries(tmp_path):
+    source = str(tmp_path / 'train.txt')
+    open(source, 'w').close()
+    manifest = utils.CacheManifest(str(tmp_path))
+    _add_entry(str(tmp_path), manifest, 'cached_old', source)
+    _add_entry(str(tmp_path), manifest, 'cached_new', source)
+    _set_last_used(manifest, 'cached_old', time.time() - 3 * 86400)
+
+    manifest.evict_unused(2 * 86400)
+    assert sorted(manifest._load()) == ['cached_new']
+    assert not os.path.exists(tmp_path / 'cached_old.a')
+    assert os.path.exists(tmp_path / 'cached_new.a')
+
+    # add refreshes last_used
+    _set_last_used(manifest, 'cached_new', time.time() - 3 * 86400)
+    _add_entry(str(tmp_path), manifest, 'cached_new', source)
+    manifest.evict_unused(2 * 86400)
+    assert sorted(manifest._load()) == ['cached_new']
@@ -0,0 +1,179 @@
+import os
+import types
+import logging
+
+import pytest
+import torch
+from torch.utils.data import BatchSampler, SequentialSampler
+
+import plus_testing
+from plus_testing import datasets, utils, FakeVocab
+
+
+def _save(writer, model_path, name, step, is_best=False):
+    dirname = os.path.join(model_path, name)
+    writer.save(dirname, {'model.pt': {'w': torch.full((2,), step)},
+        'checkpoint.pt': {'step': step}}, is_best=is_best)
+    writer.wait()
+    # mtime orders list_checkpoints, keep it apart on coarse clocks
+    os.utime(os.path.join(dirname, 'checkpoint.pt'), (step, step))
+    return dirname
+
+
+def test_checkpoint_writer_keeps_last_and_best(tmp_path):
+    writer = utils.CheckpointWriter(keep_last=2)
+    dirs = [_save(writer, str(tmp_path), 'model__epoch%d' % i, i, is_best=i == 1)
+            for i in range(1, 5)]
+    assert sorted(os.listdir(tmp_path)) == ['model__epoch1', 'model__epoch3', 'model__epoch4']
+    assert os.path.exists(os.path.join(dirs[0], 'best'))
+    assert torch.load(os.path.join(dirs[3], 'model.pt'))['w'].tolist() == [4, 4]
+    assert not [f for f in os.listdir(dirs[3]) if f.endswith('.tmp')]
+
+
+def test_checkpoint_writer_keep_all(tmp_path):
+    writer = utils.CheckpointWriter(keep_last=0)
+    for i in range(1, 4):
+        _save(writer, str(tmp_path), 'model__epoch%d' % i, i)
+    assert len(os.listdir(tmp_path)) == 3
+
+
+def test_list_checkpoints_rebuilds_retention_on_resume(tmp_path):
+    pattern = r'model_(lm)?_epoch\d+(_step\d+)?_exp'
+    writer = utils.CheckpointWriter(keep_last=0)
+    _save(writer, str(tmp_path), 'model__epoch1_exp', 1, is_best=True)
+    _save(writer, str(tmp_path), 'model__epoch2_exp', 2, is_best=True)
+    _save(writer, str(tmp_path), 'model__epoch3_step7_exp', 3)
+    _save(writer, str(tmp_path), 'model__epoch3_other', 4)
+    os.makedirs(os.path.join(tmp_path, 'model__epoch9_exp'))
+
+    saved, best = utils.list_checkpoints(str(tmp_path), pattern)
+    assert [os.path.basename(v) for v in saved] == \
+            ['model__epoch1_exp', 'model__epoch2_exp', 'model__epoch3_step7_exp']
+    assert os.path.basename(best) == 'model__epoch2_exp'
+
+    # the writer of the resumed run removes the checkpoints of the run before
+    writer = utils.CheckpointWriter(1, None, saved, best)
+    _save(writer, str(tmp_path), 'model__epoch3_exp', 5)
+    assert sorted(os.listdir(tmp_path)) == ['model__epoch2_exp', 'model__epoch3_exp',
+            'model__epoch3_other', 'model__epoch9_exp']
+    assert utils.list_checkpoints(str(tmp_path / 'missing'), pattern) == ([], None)
+
+
+def test_resave_as_not_best_removes_best_marker(tmp_path):
+    writer = utils.CheckpointWriter(keep_last=0)
+    dirname = _save(writer, str(tmp_path), 'model__epoch1', 1, is_best=True)
+    _save(writer, str(tmp_path), 'model__epoch1', 2)
+    assert not os.path.exists(os.path.join(dirname, 'best'))
+
+
+class _CountingDataset(torch.utils.data.Dataset):
+    def __init__(self, n):
+        self.n = n
+        self.loaded = []
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        self.loaded.append(i)
+        return i
+
+
+def _loader_args(**kwargs):
+    args = types.SimpleNamespace(seed=0, num_workers=0, prefetch_factor=2,
+            persistent_workers=False, background_prefetch=False)
+    args.__dict__.update(kwargs)
+    return args
+
+
+def test_skip_loader_batches_skips_in_sampler():
+    ds = _CountingDataset(10)
+    data_iter = utils.build_dataloader(ds, _loader_args(), batch_size=3,
+            collate_fn=list)
+    assert isinstance(data_iter.batch_sampler, utils.ResumableBatchSampler)
+    assert len(data_iter) == 4
+    assert utils.skip_loader_batches(data_iter, 2)
+    assert list(data_iter) == [[6, 7, 8], [9]]
+    # the skipped examples are never loaded
+    assert ds.loaded == [6, 7, 8, 9]
+    # only the next epoch is skipped
+    assert len(list(data_iter)) == 4
+
+
+def test_skip_loader_batches_keeps_shuffle_order():
+    ds = _CountingDataset(20)
+    data_iter = utils.build_dataloader(ds, _loader_args(), batch_size=4,
+            shuffle=True, collate_fn=list)
+    torch.manual_seed(3)
+    full = list(data_iter)
+    torch.manual_seed(3)
+    utils.skip_loader_batches(data_iter, 3)
+    assert list(data_iter) == full[3:]
+
+
+def test_resumable_batch_sampler_wraps_batch_sampler():
+    batch_sampler = BatchSampler(SequentialSampler(range(5)), 2, False)
+    data_iter = utils.build_dataloader(_CountingDataset(5), _loader_args(),
+            batch_sampler=batch_sampler, collate_fn=list)
+    assert data_iter.batch_sampler.batch_sampler is batch_sampler
+    utils.skip_loader_batches(data_iter, 1)
+    assert list(data_iter) == [[2, 3], [4]]
+
+
+def test_skip_loader_batches_of_stream_dataset():
+    class Stream(torch.utils.data.IterableDataset):
+        def __iter__(self):
+            return iter(range(4))
+
+    data_iter = utils.build_dataloader(Stream(), _loader_args(), batch_size=2)
+    assert not utils.skip_loader_batches(data_iter, 1)
+
+
+def _trainer(tmp_path, examples, resume=None, save_steps=0):
+    """Trainer of the chat examples without the vocab and pretrain files of __init__"""
+    pytest.importorskip('torch_optimizer')
+    trainer = plus_testing.import_trainer()
+    vocab = FakeVocab()
+    tr = object.__new__(trainer.Trainer)
+    tr.args = plus_testing.model_args(batch_size=4, gradient_accumulation=1, clip_grad=1.0,
+            use_scheduler=False, amp=False, loss_chunk_size=0, auxiliary_task=None, alpha=0.5,
+            seed=1, num_workers=0, prefetch_factor=2, persistent_workers=False,
+            background_prefetch=False, bucket_size=0, max_tokens=0, save_steps=save_steps,
+            resume=resume, model_path=str(tmp_path), experiment_name='exp',
+            config_file=str(tmp_path / 'config.yml'), vocab_fname=str(tmp_path / 'vocab'))
+    tr.rank, tr.local_rank, tr.world_size = 0, 0, 1
+    tr.device, tr.dist_device = torch.device('cpu'), 'cpu'
+    tr.best_valid_loss = float('inf')
+    tr.start_epoch, tr.global_step = 0, 0
+    tr.resume_batches, tr.resume_epoch_loss = 0, 0
+    tr.vocab, tr.persona_vocab, tr.pad_idx = vocab, None, vocab.stoi(utils.PAD)
+    tr.logger = logging.getLogger('trainer')
+    tr.checkpoint_writer = utils.CheckpointWriter(0, tr.logger)
+    utils.set_random_seed(1, 'cpu')
+    tr.train_iter = tr.build_dataloader(examples, datasets.ChatCollate(vocab, None, False), True)
+    tr.model = plus_testing.build_model(vocab, auxiliary_task=None)
+    tr.optimizer = torch.optim.AdamW(tr.model.parameters(), lr=0.01)
+    if resume is not None:
+        tr.resume()
+    tr.dist_model = tr.model
+    tr.build_loss_fns()
+    return tr
+
+
+def test_resume_from_checkpoint_at_the_end_of_epoch(tmp_path):
+    for fname in ('config.yml', 'vocab'):
+        (tmp_path / fname).write_text('')
+    examples = plus_testing.chat_examples(FakeVocab(), 16, seed=3)
+    tr = _trainer(tmp_path, examples, save_steps=2)
+    train_loss = tr.train(0)
+    tr.checkpoint_writer.wait()
+    params = [p.detach().clone() for p in tr.model.parameters()]
+
+    # saved on the last batch of the epoch, the resumed loader yields no batch
+    resume = str(tmp_path / 'model__epoch1_step4_exp')
+    tr = _trainer(tmp_path, examples, resume=resume)
+    assert (tr.start_epoch, tr.resume_batches) == (0, 4)
+    assert tr.train(tr.start_epoch) == pytest.approx(train_loss)
+    assert tr.global_step == 4
+    assert all(torch.equal(p, e) for p, e in zip(tr.model.parameters(), params))
+    assert len(list(tr.train_iter)) == 4
@@ -0,0 +1,138 @@
+import pickle
+import types
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+import plus_testing
+from plus_testing import datasets, utils, FakeVocab
+
+
+def _reference_batch(batch, vocab):
+    """The per example collate before vectorization, with_lm=False"""
+    pad_idx = vocab.stoi(utils.PAD)
+    context, segs, personas_no_tag, tags, resp, persona, _ = zip(*batch)
+    fn = lambda x: [torch.tensor(v, dtype=torch.long) for v in x]
+    pad = lambda x: pad_sequence(fn(x), padding_value=pad_idx)
+    # speaker pairs: batch_size X n X 2 --> 2 X n X batch_size
+    pairs = lambda x: pad_sequence([pad(v) for v in x], padding_value=pad_idx).permute(2, 0, 1)
+    return dict(
+            context=pad(context),
+            post=pad([v[:-1] for v in context]),
+            segs=pad(segs),
+            personas_no_tag=pairs(personas_no_tag),
+            tags=pairs(tags),
+            resp=pad(resp),
+            persona=pad(persona))
+
+
+def test_generate_batch_equals_reference():
+    vocab = FakeVocab()
+    pad_idx = vocab.stoi(utils.PAD)
+    examples = plus_testing.chat_examples(vocab, 9, seed=4)
+    feature = datasets.generate_batch(examples, vocab, None, False, with_lm=False)
+    for k, v in _reference_batch(examples, vocab).items():
+        assert torch.equal(getattr(feature, k), v), k
+    assert torch.equal(feature.post_pad_mask, (feature.post == pad_idx).T)
+    assert torch.equal(feature.tags_pad_mask, (feature.tags == pad_idx).T)
+    assert feature.lm is None
+
+
+def test_generate_batch_of_feature_arrays(tmp_path):
+    """Examples read from FeatureArrays are numpy slices"""
+    vocab = FakeVocab()
+    examples = plus_testing.chat_examples(vocab, 6, seed=5)
+    fname = str(tmp_path / 'train')
+    utils.FeatureArrays.save(fname, examples)
+    arrays = utils.FeatureArrays(fname)
+    assert isinstance(arrays[0][0], np.ndarray)
+
+    expected = datasets.generate_batch(examples, vocab, None, False, with_lm=False)
+    feature = datasets.generate_batch([arrays[i] for i in range(len(arrays))], vocab,
+            None, False, with_lm=False)
+    for k in ('context', 'post', 'segs', 'personas_no_tag', 'tags', 'resp', 'persona'):
+        assert torch.equal(getattr(feature, k), getattr(expected, k)), k
+
+
+def test_post_is_context_without_last_sep():
+    vocab = FakeVocab()
+    pad_idx, sep = vocab.stoi(utils.PAD), vocab.stoi(utils.SEP)
+    # a SEP inside the context, the post still keeps it
+    context = [[1, 2, sep, 3, sep], [4, sep], [5, 6, 7, sep]]
+    context_pad, lens = datasets.pad_seqs(context, pad_idx)
+    post = datasets._post_pad(context_pad, lens, vocab, pad_idx)
+    assert post.T.tolist() == [[1, 2, sep, 3],
+            [4, pad_idx, pad_idx, pad_idx], [5, 6, 7, pad_idx]]
+
+
+def test_collates_are_picklable():
+    vocab = FakeVocab()
+    examples = plus_testing.chat_examples(vocab, 3)
+    gb = pickle.loads(pickle.dumps(datasets.ChatCollate(vocab, None, False, False)))
+    feature = gb(examples)
+    assert torch.equal(feature.context,
+            datasets.generate_batch(examples, vocab, None, False, with_lm=False).context)
+
+
+def test_worker_batches_equal_main_process_batches(tmp_path):
+    vocab = FakeVocab()
+    plus_testing.write_chat_data(str(tmp_path), 'train', 8)
+    ds = utils.PersonaDataset(vocab, 8, None, data_path=str(tmp_path),
+            cache_path=str(tmp_path), data_processer=plus_testing.chat_processer(vocab),
+            mode='train')
+    args = types.SimpleNamespace(seed=0, num_workers=0, prefetch_factor=2,
+            persistent_workers=False, background_prefetch=False)
+    collate_fn = datasets.ChatCollate(vocab, None, False)
+    batches = list(utils.build_dataloader(ds, args, batch_size=4, collate_fn=collate_fn))
+    args.num_workers = 2
+    worker_batches = list(utils.build_dataloader(ds, args, batch_size=4, collate_fn=collate_fn))
+    assert len(worker_batches) == len(batches) > 1
+    for feature, expected in zip(worker_batches, batches):
+        for k in ('context', 'post', 'segs', 'personas_no_tag', 'tags', 'resp', 'persona'):
+            assert torch.equal(getattr(feature, k), getattr(expected, k)), k
+        assert torch.equal(feature.lm.x, expected.lm.x)
+        assert torch.equal(feature.lm.y, expected.lm.y)
+
+
+def _mask_spans(seq, masked, mask_idx):
+    """(start, n_mask) of every way masked can be seq with a span replaced by mask_idx"""
+    return [(start, n) for n in (0, 1, 2) for start in range(1, len(seq) - n)
+            if masked == seq[:start] + [mask_idx] + seq[start+n:]]
+
+
+def test_mask_span_replaces_one_span():
+    vocab = FakeVocab()
+    pad_idx, mask_idx = vocab.stoi(utils.PAD), vocab.stoi(utils.MASK)
+    rnd = np.random.RandomState(0)
+    seqs = [[1] + rnd.randint(2, 40, n).tolist() + [2] for n in (1, 2, 3, 4, 6, 9) * 50]
+    batch, lens = datasets.pad_seqs(seqs, pad_idx)
+    x_mlm = datasets.mask_span(batch, lens, mask_idx, pad_idx, torch.Generator().manual_seed(0))
+    assert x_mlm.shape[0] <= batch.shape[0] + 1
+    n_masks = []
+    for seq, masked in zip(seqs, x_mlm.T.tolist()):
+        masked = [v for v in masked if v != pad_idx]
+        if len(seq) <= 3:
+            assert masked == seq
+            continue
+        spans = _mask_spans(seq, masked, mask_idx)
+        assert spans, (seq, masked)
+        n = {n for _, n in spans}
+        n_masks += n
+        assert n <= ({1} if len(seq) < 6 else {0, 2})
+    # both span sizes of long seqs are drawn
+    assert {0, 2} <= set(n_masks)
+
+
+def test_mask_span_is_seeded_by_generator():
+    vocab = FakeVocab()
+    examples = plus_testing.chat_examples(vocab, 8, seed=6)
+    features = [datasets.generate_batch(examples, vocab, None, True,
+            generator=torch.Generator().manual_seed(seed)).lm for seed in (1, 1, 2)]
+    assert torch.equal(features[0].x_mlm, features[1].x_mlm)
+    assert not torch.equal(features[0].x_mlm, features[2].x_mlm)
+    lm = features[0]
+    assert torch.equal(lm.x_mlm_pad_mask, (lm.x_mlm == vocab.stoi(utils.PAD)).T)
+    lens = torch.tensor([len(v[6]) for v in examples])
+    n_masks = (lm.x_mlm == vocab.stoi(utils.MASK)).sum(0)
+    assert torch.equal(n_masks, (lens > 3).long())
@@ -0,0 +1,109 @@
+import itertools
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+import plus_testing
+from plus_testing import datasets, utils, FakeVocab
+
+
+def _as_lists(feature):
+    if isinstance(feature, (int, np.integer)):
+        return int(feature)
+    return [_as_lists(v) for v in feature]
+
+
+def _file_features(vocab, data_path, mode='train'):
+    dp = plus_testing.chat_processer(vocab)
+    return [_as_lists(v) for v in dp.convert_examples_to_features(vocab, 
+        dp.get_examples(data_path, mode), mode=mode)]
+
+
+def _stream(vocab, data_path, shuffle_buffer_size=0):
+    return utils.PersonaIterableDataset(vocab, str(data_path), 
+            plus_testing.chat_processer(vocab), mode='train',
+            shuffle_buffer_size=shuffle_buffer_size)
+
+
+def test_stream_dataset_in_file_order(tmp_path):
+    vocab = FakeVocab()
+    plus_testing.write_chat_data(str(tmp_path), 'train', 12)
+    expected = _file_features(vocab, str(tmp_path))
+    assert len(expected) > 12
+    assert [_as_lists(v) for v in _stream(vocab, tmp_path)] == expected
+
+
+def test_stream_dataset_shards_across_workers(tmp_path):
+    vocab = FakeVocab()
+    plus_testing.write_chat_data(str(tmp_path), 'train', 12)
+    expected = _file_features(vocab, str(tmp_path))
+    loader = DataLoader(_stream(vocab, tmp_path), batch_size=2, num_workers=3, 
+            collate_fn=list)
+    features = [_as_lists(v) for v in itertools.chain(*loader)]
+    # every example once
+    assert sorted(features) == sorted(expected)
+
+
+def test_stream_dataset_shuffle_buffer(tmp_path):
+    vocab = FakeVocab()
+    plus_testing.write_chat_data(str(tmp_path), 'train', 20)
+    expected = _file_features(vocab, str(tmp_path))
+    ds = _stream(vocab, tmp_path, shuffle_buffer_size=8)
+    torch.manual_seed(0)
+    first = [_as_lists(v) for v in ds]
+    torch.manual_seed(0)
+    again = [_as_lists(v) for v in ds]
+    assert sorted(first) == sorted(expected)
+    assert first != expected
+    assert again == first
+
+
+def test_split_file_at_line_starts(tmp_path):
+    fname = str(tmp_path / 'train.txt')
+    plus_testing.write_chat_data(str(tmp_path), 'train', 9)
+    with open(fname, 'rb') as f:
+        lines = f.readlines()
+    for n_shards, limit_length in ((4, None), (3, 5), (20, None)):
+        ranges = utils.split_file(fname, n_shards, limit_length)
+        assert len(ranges) == n_shards
+        assert ranges[0][0] == 0
+        assert all(a[1] == b[0] for a, b in zip(ranges[:-1], ranges[1:]))
+        shard_lines = []
+        with open(fname, 'rb') as f:
+            for r in ranges:
+                shard_lines += list(utils.read_lines(f, r))
+        assert shard_lines == lines[:limit_length]
+
+
+def _persona_dataset(vocab, data_path, cache_path, limit_length=None, n_build_workers=1):
+    return utils.PersonaDataset(vocab, 8, limit_length,
+            data_path=str(data_path), cache_path=str(cache_path),
+            data_processer=plus_testing.chat_processer(vocab), mode='train',
+            n_build_workers=n_build_workers)
+
+
+def test_parallel_build_equals_serial_build(tmp_path):
+    vocab = FakeVocab()
+    plus_testing.write_chat_data(str(tmp_path), 'train', 15)
+    for limit_length in (None, 6):
+        serial = _persona_dataset(vocab, tmp_path, tmp_path / 'serial',
+                limit_length=limit_length)
+        parallel = _persona_dataset(vocab, tmp_path, tmp_path / 'parallel',
+                limit_length=limit_length, n_build_workers=2)
+        assert len(serial) > 0
+        assert [_as_lists(v) for v in parallel] == [_as_lists(v) for v in serial]
+        # the shards are merged and removed
+        assert not [v for v in (tmp_path / 'parallel').iterdir() if '.shard' in v.name]
+
+
+def test_session_dataset_equals_example_dataset(tmp_path):
+    vocab = FakeVocab()
+    plus_testing.write_chat_data(str(tmp_path), 'train', 7)
+    dp = plus_testing.chat_processer(vocab)
+    examples = _persona_dataset(vocab, tmp_path, tmp_path / 'examples')
+    sessions = datasets.ChatSessionDataset(vocab, 8, None, data_path=str(tmp_path),
+            cache_path=str(tmp_path / 'sessions'), data_processer=dp, mode='train')
+    assert len(sessions) == len(examples) > 0
+    assert [_as_lists(v) for v in sessions] == [_as_lists(v) for v in examples]
+    assert np.array_equal(datasets.chat_lengths(sessions), datasets.chat_lengths(examples))
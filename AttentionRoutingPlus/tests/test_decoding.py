@@ -0,0 +1,289 @@
+import types
+
+import pytest
+import torch
+
+import plus_testing
+from plus_testing import datasets, utils, FakeVocab
+
+
+def _batch(vocab, n=5, seed=0, with_lm=True):
+    examples = plus_testing.chat_examples(vocab, n, seed=seed)
+    return datasets.generate_batch(examples, vocab, None, True, with_lm,
+            generator=torch.Generator().manual_seed(seed))
+
+
+def _assert_close_at_tokens(actual, expected, pad_mask):
+    mask = ~pad_mask.T.unsqueeze(2)
+    torch.testing.assert_close(actual * mask, expected * mask, rtol=1e-4, atol=1e-5)
+
+
+def _decode_steps(model, tgt, tgt_pad_mask, **kwargs):
+    """resp_decoder outputs of tgt, one position at a time with cache"""
+    cache = model.resp_decoder.init_cache()
+    steps = []
+    for t in range(tgt.shape[0]):
+        emb = model.output_emb(tgt[t:t+1], tgt_pad_mask[:, t:t+1], t)
+        steps.append(model.resp_decoder(emb, tgt_key_padding_mask=tgt_pad_mask[:, :t+1],
+                cache=cache, **kwargs))
+    assert cache.step == tgt.shape[0]
+    return torch.cat(steps)
+
+
+def test_cached_decoder_equals_full_decoder():
+    vocab = FakeVocab()
+    model = plus_testing.build_model(vocab).eval()
+    feature = _batch(vocab)
+    with torch.no_grad():
+        context_enc, persona_enc = model.encode(feature)
+        kwargs = dict(memory=context_enc, persona=persona_enc,
+                memory_key_padding_mask=feature.context_pad_mask,
+                persona_pad_mask=feature.persona_pad_mask)
+        full = model.resp_decoder(model.output_emb(feature.resp, feature.resp_pad_mask),
+                tgt_mask=feature.resp_mask, tgt_key_padding_mask=feature.resp_pad_mask,
+                **kwargs)
+        steps = _decode_steps(model, feature.resp, feature.resp_pad_mask, **kwargs)
+    _assert_close_at_tokens(steps, full, feature.resp_pad_mask)
+
+
+def test_cached_decoder_without_memory():
+    """The language model use of the decoder, only self attention is cached"""
+    vocab = FakeVocab()
+    model = plus_testing.build_model(vocab).eval()
+    lm = _batch(vocab).lm
+    with torch.no_grad():
+        full = model.resp_decoder(model.output_emb(lm.x, lm.x_pad_mask),
+                tgt_mask=lm.x_mask, tgt_key_padding_mask=lm.x_pad_mask)
+        steps = _decode_steps(model, lm.x, lm.x_pad_mask)
+    _assert_close_at_tokens(steps, full, lm.x_pad_mask)
+
+
+@pytest.mark.parametrize('use_mem_n2n', [False, True])
+def test_decode_step_equals_forward(use_mem_n2n):
+    vocab = FakeVocab()
+    model = plus_testing.build_model(vocab, use_mem_n2n=use_mem_n2n,
+            persona_vocab_size=len(vocab)).eval()
+    feature = _batch(vocab, with_lm=False)
+    resp, resp_pad_mask = feature.resp, feature.resp_pad_mask
+    with torch.no_grad():
+        full, _ = model(feature)
+        state = model.encode_state(feature)
+        assert torch.equal(model(feature, state)[0], full)
+
+        steps = [model.decode_step(state, resp[t:t+1], resp_pad_mask[:, :t+1])
+                for t in range(resp.shape[0])]
+        _assert_close_at_tokens(torch.cat(steps), full, resp_pad_mask)
+
+        # a prefix of several positions, then the rest
+        state = model.encode_state(feature)
+        head = model.decode_step(state, resp[:3], resp_pad_mask[:, :3], feature.resp_mask[:3, :3])
+        tail = model.decode_step(state, resp[3:], resp_pad_mask, feature.resp_mask[3:])
+    _assert_close_at_tokens(torch.cat([head, tail]), full, resp_pad_mask)
+
+
+def test_encoder_state_index_select():
+    vocab = FakeVocab()
+    model = plus_testing.build_model(vocab).eval()
+    feature = _batch(vocab, with_lm=False)
+    index = torch.tensor([3, 0])
+    with torch.no_grad():
+        state = model.encode_state(feature)
+        first = model.decode_step(state, feature.resp[:1], feature.resp_pad_mask[:, :1])
+        state.index_select(index)
+        second = model.decode_step(state, feature.resp[1:2].index_select(1, index),
+                feature.resp_pad_mask[:, :2].index_select(0, index))
+
+        full = model.encode_state(feature)
+        model.decode_step(full, feature.resp[:1], feature.resp_pad_mask[:, :1])
+        expected = model.decode_step(full, feature.resp[1:2], feature.resp_pad_mask[:, :2])
+    assert first.shape[1] == 5
+    torch.testing.assert_close(second, expected.index_select(1, index))
+
+
+def test_inference_batch_skips_lm():
+    vocab = FakeVocab()
+    model = plus_testing.build_model(vocab).eval()
+    feature = _batch(vocab)
+    inference = _batch(vocab, with_lm=False)
+    assert inference.lm is None
+    with torch.no_grad():
+        out, out_lm = model(feature)
+        out_inference, out_lm_inference = model(inference)
+        # no auxiliary task, the LM feature is not used
+        model.auxiliary_task = None
+        out_no_task, out_lm_no_task = model(feature)
+    assert out_lm is not None and out_lm_inference is None and out_lm_no_task is None
+    assert torch.equal(out_inference, out)
+    assert torch.equal(out_no_task, out)
+
+
+def _decoding_args(**kwargs):
+    args = types.SimpleNamespace(temperature=1.0, top_k=0, top_p=0.0, no_sample=True,
+            min_seq_length=2, max_seq_length=6, beam_size=1, length_penalty=0.0)
+    args.__dict__.update(kwargs)
+    return args
+
+
+def _next_logits(model, feature, rows, resp):
+    """Logits of the next token of the rows of feature after resp, without cache"""
+    state = model.encode_state(feature)
+    state.index_select(torch.tensor(rows))
+    resp = torch.tensor(resp).T
+    pad_mask = torch.zeros(resp.shape[1], resp.shape[0], dtype=torch.bool)
+    return model.decode_step(state, resp, pad_mask,
+            utils.generate_square_subsequent_mask(resp.shape[0]))[-1]
+
+
+def _greedy_reference(model, feature, vocab, args, prefix):
+    """Greedy responses decoded row by row, with the full decoder every step"""
+    eos = vocab.stoi(utils.EOS)
+    special = torch.tensor([vocab.stoi(k) for k in utils.PRESET_SPECIAL_TOKENS])
+    outputs = []
+    for i, vs in enumerate(prefix):
+        vs = list(vs)
+        for seq_i in range(args.max_seq_length):
+            if vs[-1] == eos:
+                break
+            logits = _next_logits(model, feature, [i], [vs])[0]
+            if seq_i < args.min_seq_length:
+                logits[special] = -float('Inf')
+            k = logits.argmax().item()
+            vs.append(eos if k in special.tolist() else k)
+        outputs.append(vs[1:] if vs[-1] == eos else vs[1:] + [eos])
+    return outputs
+
+
+def test_batched_greedy_sampling_equals_row_by_row():
+    vocab = FakeVocab()
+    model = plus_testing.build_model(vocab).eval()
+    feature = _batch(vocab, n=6, with_lm=False)
+    args = _decoding_args()
+    sos = vocab.stoi(utils.SOS)
+    with torch.no_grad():
+        output, padded = utils.sample_sequence(feature, vocab, model, args)
+        expected = _greedy_reference(model, feature, vocab, args, [[sos]] * 6)
+    assert output == expected
+    assert padded.shape == (args.max_seq_length + 1, 6)
+    assert padded.T.tolist()[0][:len(output[0])] == output[0]
+
+
+def _eos_prone_model(vocab, seed=2, scale=1.5):
+    """A model whose responses end at different steps"""
+    model = plus_testing.build_model(vocab, seed=seed).eval()
+    with torch.no_grad():
+        model.generater.out.weight[vocab.stoi(utils.EOS)] *= scale
+    return model
+
+
+def test_sampling_drops_finished_rows():
+    vocab = FakeVocab()
+    model = _eos_prone_model(vocab)
+    feature = _batch(vocab, n=6, with_lm=False)
+    args = _decoding_args(min_seq_length=1)
+    sos, eos = vocab.stoi(utils.SOS), vocab.stoi(utils.EOS)
+    with torch.no_grad():
+        output, _ = utils.sample_sequence(feature, vocab, model, args)
+        expected = _greedy_reference(model, feature, vocab, args, [[sos]] * 6)
+    assert output == expected
+    lengths = set(map(len, output))
+    assert min(lengths) < args.max_seq_length + 1 and len(lengths) > 1
+
+    # rows finished in the given prefixes are not decoded
+    prefix = [[sos, 3, eos], [sos, 4], [sos, 5, eos], [sos, 6], [sos, 7], [sos, 8]]
+    with torch.no_grad():
+        output, _ = utils.sample_sequence(feature, vocab, model, args,
+                current_output=[list(vs) for vs in prefix])
+        expected = _greedy_reference(model, feature, vocab, args, prefix)
+    assert output == expected
+    assert output[0] == [3, eos] and output[2] == [5, eos]
+
+
+def _beam_search_reference(model, feature, vocab, args):
+    """Beam search of every row on its own, every hypothesis with the full decoder"""
+    sos, eos = vocab.stoi(utils.SOS), vocab.stoi(utils.EOS)
+    special = [vocab.stoi(k) for k in utils.PRESET_SPECIAL_TOKENS]
+    penalty = lambda n: ((5 + n) / 6) ** args.length_penalty
+    outputs = []
+    for i in range(feature.context.shape[1]):
+        # tokens after SOS, log prob, finished
+        beams = [([], 0.0, False)]
+        for seq_i in range(args.max_seq_length):
+            if all(done for _, _, done in beams):
+                break
+            cands = [v for v in beams if v[2]]
+            for vs, score, done in beams:
+                if done:
+                    continue
+                log_probs = torch.log_softmax(
+                        _next_logits(model, feature, [i], [[sos] + vs])[0], dim=-1)
+                for k in range(len(vocab)):
+                    if k in special and (k != eos or seq_i < args.min_seq_length):
+                        continue
+                    cands.append((vs + [k], score + log_probs[k].item(), k == eos))
+            cands.sort(key=lambda v: v[1] / penalty(len(v[0])), reverse=True)
+            beams = cands[:args.beam_size]
+        vs = max(beams, key=lambda v: v[1] / penalty(len(v[0])))[0]
+        outputs.append(vs if vs and vs[-1] == eos else vs + [eos])
+    return outputs
+
+
+@pytest.mark.parametrize('length_penalty', [0.0, 1.0])
+def test_batched_beam_search_equals_reference(length_penalty):
+    vocab = FakeVocab()
+    model = _eos_prone_model(vocab, seed=1, scale=2.5)
+    feature = _batch(vocab, n=4, with_lm=False)
+    args = _decoding_args(beam_size=3, max_seq_length=4, min_seq_length=1,
+            length_penalty=length_penalty)
+    with torch.no_grad():
+        output, padded = utils.beam_search(feature, vocab, model, args)
+        expected = _beam_search_reference(model, feature, vocab, args)
+    assert output == expected
+    assert len(set(map(len, output))) > 1
+    assert padded.shape == (args.max_seq_length + 1, 4)
+
+
+def test_beam_search_reuses_state():
+    vocab = FakeVocab()
+    model = _eos_prone_model(vocab)
+    feature = _batch(vocab, n=3, with_lm=False)
+    args = _decoding_args(beam_size=2, max_seq_length=3)
+    with torch.no_grad():
+        expected, _ = utils.beam_search(feature, vocab, model, args)
+        output, _ = utils.beam_search(feature, vocab, model, args,
+                state=model.encode_state(feature))
+    assert output == expected
+
+
+def test_sample_tokens_on_device():
+    logits = torch.tensor([[0.0, 5.0, 1.0], [3.0, 0.0, 2.0]])
+    suppress = torch.tensor([False, True, False])
+    args = _decoding_args(no_sample=False, top_k=1)
+    assert utils.sample_tokens(logits.clone(), args).tolist() == [1, 0]
+    assert utils.sample_tokens(logits.clone(), args, suppress).tolist() == [2, 0]
+    args = _decoding_args(no_sample=False)
+    for _ in range(20):
+        assert utils.sample_tokens(logits.clone(), args, suppress)[0].item() != 1
+
+
+def test_response_buffer_appends_in_place():
+    buffer = utils.ResponseBuffer([[1, 2], [1, 3]], 3, 0, 'cpu')
+    assert buffer.resp.tolist() == [[1, 1], [2, 3]]
+    buffer.append(torch.tensor([4, 0]))
+    assert buffer.length == 3
+    assert buffer.resp.T.tolist() == [[1, 2, 4], [1, 3, 0]]
+    assert buffer.resp_pad_mask.tolist() == [[False] * 3, [False, False, True]]
+    assert torch.equal(buffer.resp_mask, utils.generate_square_subsequent_mask(3))
+
+    buffer.index_select(torch.tensor([1]))
+    assert buffer.resp.T.tolist() == [[1, 3, 0]]
+    assert buffer.resp_pad_mask.shape == (1, 3)
+
+
+def test_response_buffer_rejects_ragged_prefixes():
+    with pytest.raises(ValueError, match='different lengths'):
+        utils.ResponseBuffer([[1, 2], [1]], 3, 0, 'cpu')
+
+
+def test_response_buffer_of_no_rows():
+    buffer = utils.ResponseBuffer([], 2, 0, 'cpu')
+    assert buffer.length == 0 and buffer.tokens.shape == (2, 0)
@@ -0,0 +1,92 @@
+import os
+import queue
+import socket
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+import plus_testing
+from plus_testing import datasets, utils, FakeVocab
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _grads(model):
+    return [None if p.grad is None else p.grad.numpy().copy() for p in model.parameters()]
+
+
+def _chunked_loss_worker(rank, world_size, port, result_queue):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port),
+            RANK=str(rank), WORLD_SIZE=str(world_size), LOCAL_RANK=str(rank))
+    utils.init_distributed('gloo')
+    vocab = FakeVocab()
+    pad_idx = vocab.stoi(utils.PAD)
+    examples = plus_testing.chat_examples(vocab, 8, seed=rank)
+    # fixed MLM masks, the same in the DDP and local forward
+    feature = datasets.generate_batch(examples, vocab, None, True,
+            generator=torch.Generator().manual_seed(rank))
+
+    # the gradients of the local full logits loss
+    model = plus_testing.build_model(vocab)
+    out, out_lm = model(feature)
+    loss, loss_lm = model.loss('MLM', nn.CrossEntropyLoss(ignore_index=pad_idx),
+            out, out_lm, feature.resp, feature.lm.y)
+    (loss + 0.5 * loss_lm).backward()
+    local_grads = _grads(model)
+
+    model = plus_testing.build_model(vocab)
+    dist_model = nn.parallel.DistributedDataParallel(model,
+            broadcast_buffers=False, find_unused_parameters=True)
+    loss, loss_lm = dist_model(feature, loss_chunk=(pad_idx, 7))
+    (loss + 0.5 * loss_lm).backward()
+
+    result_queue.put((rank, local_grads, _grads(model)))
+    dist.destroy_process_group()
+
+
+def run_processes(worker, world_size):
+    """Results of worker(rank, world_size, port, result_queue) in world_size processes,
+    sorted by rank, fail if one of them fails
+    """
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.Queue()
+    port = _free_port()
+    procs = [ctx.Process(target=worker, args=(rank, world_size, port, result_queue))
+            for rank in range(world_size)]
+    for p in procs:
+        p.start()
+    results = []
+    try:
+        while len(results) < world_size:
+            try:
+                results.append(result_queue.get(timeout=1))
+            except queue.Empty:
+                # the others wait for the failed one forever
+                assert all(p.exitcode in (None, 0) for p in procs), 'worker process failed'
+    finally:
+        for p in procs:
+            if len(results) < world_size:
+                p.terminate()
+            p.join()
+    return sorted(results, key=lambda v: v[0])
+
+
+def test_chunked_loss_gradients_are_all_reduced():
+    (_, local0, dist0), (_, local1, dist1) = run_processes(_chunked_loss_worker, 2)
+    n_checked = 0
+    for l0, l1, d0, d1 in zip(local0, local1, dist0, dist1):
+        if l0 is None and l1 is None:
+            continue
+        # the same gradients in the processes, the mean of the local ones
+        assert np.array_equal(d0, d1)
+        mean = (np.zeros_like(d0) if l0 is None else l0) + (0 if l1 is None else l1)
+        np.testing.assert_allclose(d0, mean / 2, rtol=1e-4, atol=1e-6)
+        n_checked += 1
+    assert n_checked > 0
@@ -0,0 +1,79 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from plus_testing import utils
+
+
+def _chat_features():
+    return [
+        ([1, 2, 3], [5, 5, 5], [[7], [8, 9]], [[], [4]], [2, 6]),
+        ([4], [6], [[1, 1], [2]], [[3], [3, 3]], []),
+        ([9, 8], [5, 6], [[2], [2]], [[1, 2, 3], [4]], [1]),
+    ]
+
+
+def _as_lists(feature):
+    if isinstance(feature, np.ndarray):
+        return feature.tolist()
+    if isinstance(feature, int):
+        return feature
+    return [_as_lists(v) for v in feature]
+
+
+def test_round_trip_of_tuple_features(tmp_path):
+    fname = str(tmp_path / 'train')
+    features = _chat_features()
+    utils.FeatureArrays.save(fname, features)
+    assert utils.FeatureArrays.exists(fname)
+
+    arrays = utils.FeatureArrays(fname)
+    assert arrays.layout == [0, 0, 2, 2, 0]
+    assert len(arrays) == len(features)
+    for i, feature in enumerate(features):
+        assert _as_lists(arrays[i]) == _as_lists(tuple(feature))
+    assert arrays.lengths(0).tolist() == [3, 1, 2]
+    tokens, lens = arrays.field(4)
+    assert tokens.tolist() == [2, 6, 1] and lens.tolist() == [2, 0, 1]
+
+    # reopened by path in DataLoader workers
+    copied = pickle.loads(pickle.dumps(arrays))
+    assert _as_lists(copied[1]) == _as_lists(arrays[1])
+
+
+def test_round_trip_of_flat_features(tmp_path):
+    fname = str(tmp_path / 'lm')
+    features = [[1, 2], [3], [4, 5, 6]]
+    utils.FeatureArrays.save(fname, features)
+    arrays = utils.FeatureArrays(fname)
+    assert arrays.layout == [-1]
+    assert [v.tolist() for v in arrays] == features
+
+
+def test_concat_of_shards(tmp_path):
+    features = _chat_features()
+    shards = [str(tmp_path / ('shard%d' % i)) for i in range(3)]
+    utils.FeatureArrays.save(shards[0], features[:2])
+    utils.FeatureArrays.save(shards[1], [])
+    utils.FeatureArrays.save(shards[2], features[2:])
+    fname = str(tmp_path / 'train')
+    utils.FeatureArrays.concat(fname, shards)
+    assert not any(os.path.exists(v + '.tokens.npy') for v in shards)
+
+    arrays = utils.FeatureArrays(fname)
+    assert [_as_lists(v) for v in arrays] == [_as_lists(v) for v in features]
+
+
+def test_save_rejects_features_of_other_layouts(tmp_path):
+    fname = str(tmp_path / 'train')
+    features = _chat_features()
+    # 3 persona sentences instead of 2
+    features.append(([1], [5], [[1], [2], [3]], [[1], [2]], [1]))
+    with pytest.raises(ValueError, match='Feature 3'):
+        utils.FeatureArrays.save(fname, features)
+    assert not utils.FeatureArrays.exists(fname)
+
+    with pytest.raises(ValueError):
+        utils.FeatureArrays.save(fname, [[1, 2], ([1], [2])])
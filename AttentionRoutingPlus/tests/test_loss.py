@@ -0,0 +1,58 @@
+import pytest
+import torch
+from torch import nn
+
+import plus_testing
+from plus_testing import datasets, modules, utils, FakeVocab
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1000])
+def test_generater_loss_equals_cross_entropy(chunk_size):
+    torch.manual_seed(0)
+    generater = modules.Generater(16, 16, 30)
+    enc = torch.randn(9, 4, 16, requires_grad=True)
+    target = torch.randint(0, 30, (9, 4))
+    target[-3:, 1] = 0
+    target[5:, 2] = 0
+
+    loss = nn.CrossEntropyLoss(ignore_index=0)(generater(enc).view(-1, 30), target.view(-1))
+    loss.backward()
+    expected = [enc.grad.clone(), generater.out.weight.grad.clone()]
+    enc.grad = generater.out.weight.grad = None
+
+    chunked = generater.loss(enc, target, 0, chunk_size)
+    chunked.backward()
+    torch.testing.assert_close(chunked, loss)
+    torch.testing.assert_close(enc.grad, expected[0])
+    torch.testing.assert_close(generater.out.weight.grad, expected[1])
+
+
+def test_chunked_loss_equals_model_loss():
+    vocab = FakeVocab()
+    pad_idx = vocab.stoi(utils.PAD)
+    examples = plus_testing.chat_examples(vocab, 6, seed=7)
+    feature = datasets.generate_batch(examples, vocab, None, True,
+            generator=torch.Generator().manual_seed(0))
+
+    grads = []
+    for chunk_size in (None, 5):
+        model = plus_testing.build_model(vocab)
+        if chunk_size is None:
+            out, out_lm = model(feature)
+            loss, loss_lm = model.loss('MLM', nn.CrossEntropyLoss(ignore_index=pad_idx),
+                    out, out_lm, feature.resp, feature.lm.y)
+        else:
+            out, out_lm = model(feature, logits=False)
+            loss, loss_lm = model.chunked_loss('MLM', pad_idx, chunk_size,
+                    out, out_lm, feature.resp, feature.lm.y)
+        (loss + 0.5 * loss_lm).backward()
+        grads.append((loss.detach(), loss_lm.detach(),
+                [p.grad for p in model.parameters()]))
+
+    (loss, loss_lm, expected), (chunked, chunked_lm, actual) = grads
+    torch.testing.assert_close(chunked, loss)
+    torch.testing.assert_close(chunked_lm, loss_lm)
+    for g, e in zip(actual, expected):
+        assert (g is None) == (e is None)
+        if g is not None:
+            torch.testing.assert_close(g, e, rtol=1e-4, atol=1e-6)
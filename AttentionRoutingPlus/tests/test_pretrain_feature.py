@@ -0,0 +1,169 @@
+import pytest
+import torch
+
+import plus_testing
+from plus_testing import datasets, models, modules, utils, FakeVocab
+
+
+def _bert_inputs(vocab, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    x = torch.randint(0, 40, (3, 6), generator=g)
+    attention_mask = torch.ones(3, 6)
+    attention_mask[1, 4:] = 0
+    return x, attention_mask
+
+
+@pytest.mark.parametrize('n_layers', [0, 1, 2, 3])
+def test_truncated_model_equals_hidden_state(n_layers):
+    vocab = FakeVocab()
+    bert = plus_testing.build_pretrain_feature_model(vocab)
+    x, attention_mask = _bert_inputs(vocab)
+    truncated = modules.truncate_pretrain_feature_model(bert, n_layers)
+    with torch.no_grad():
+        expected = bert(x, attention_mask=attention_mask).hidden_states[n_layers]
+        out = truncated(x, attention_mask=attention_mask)[0]
+    torch.testing.assert_close(out, expected)
+    # the weights are shared, the full model is unchanged
+    assert truncated.embeddings is bert.embeddings
+    assert len(bert.encoder.layer) == bert.config.num_hidden_layers == 3
+    assert bert.config.output_hidden_states
+
+
+def test_pretrain_feature_fn_hidden_idx():
+    vocab = FakeVocab()
+    bert = plus_testing.build_pretrain_feature_model(vocab)
+    fn = models.pretrain_feature_fn(bert)
+    x, attention_mask = _bert_inputs(vocab, seed=1)
+    with torch.no_grad():
+        hidden_states = bert(x, attention_mask=attention_mask).hidden_states
+    for hidden_idx in (0, -2, -1):
+        torch.testing.assert_close(fn(x, attention_mask=attention_mask, hidden_idx=hidden_idx),
+                hidden_states[hidden_idx])
+
+
+def test_store_features_equal_online_features(tmp_path):
+    vocab = FakeVocab()
+    bert = plus_testing.build_pretrain_feature_model(vocab)
+    model = plus_testing.build_model(vocab, bert, auxiliary_task=None).eval()
+    # the personas and tags of the speakers and examples have different lengths
+    examples = plus_testing.chat_examples(vocab, 7)
+    store = datasets.PretrainFeatureStore.load_or_build(str(tmp_path / 'pf'), examples,
+            models.pretrain_feature_fn(bert), vocab, None, 3, 'cpu')
+    ds = datasets.PretrainFeatureDataset(examples, store)
+
+    online = datasets.generate_batch(examples, vocab, None, False, with_lm=False)
+    stored = datasets.generate_batch([ds[i] for i in range(len(ds))], vocab, None, False,
+            with_lm=False)
+    assert online.pretrain_hid is None
+    with torch.no_grad():
+        context_online, persona_online = model.context_emb(online, with_persona=True)
+        context_stored = model.context_emb(stored)
+    # the stored pad rows are 0, compare the tokens
+    mask = ~online.context_pad_mask.T.unsqueeze(2)
+    torch.testing.assert_close(context_stored * mask, context_online * mask,
+            rtol=1e-4, atol=1e-4)
+    mask = ~online.persona_pad_mask.T.unsqueeze(2)
+    torch.testing.assert_close(stored.pretrain_hid.persona * mask, persona_online * mask,
+            rtol=1e-4, atol=1e-4)
+
+
+def test_speakers_sum_excludes_pads():
+    hid = torch.arange(2 * 6 * 3, dtype=torch.float).view(2, 6, 3)
+    mask = torch.tensor([[1, 1, 0, 1, 0, 0], [1, 0, 0, 1, 1, 1]], dtype=torch.float)
+    out = utils.speakers_sum(hid, mask)
+    assert out.shape == (2, 2, 3)
+    torch.testing.assert_close(out[0, 0], hid[0, 0] + hid[0, 1])
+    torch.testing.assert_close(out[1, 0], hid[0, 3])
+    torch.testing.assert_close(out[0, 1], hid[1, 0])
+    torch.testing.assert_close(out[1, 1], hid[1, 3] + hid[1, 4] + hid[1, 5])
+
+
+def test_fused_emb1_equals_separate_calls():
+    vocab = FakeVocab()
+    emb1 = models.pretrain_feature_fn(plus_testing.build_pretrain_feature_model(vocab))
+    g = torch.Generator().manual_seed(2)
+    inputs = []
+    for batch_size, seq_len, with_pos in ((3, 7, False), (6, 3, True), (6, 5, True)):
+        x = torch.randint(0, 40, (batch_size, seq_len), generator=g)
+        mask = (torch.rand(batch_size, seq_len, generator=g) > 0.3).float()
+        mask[:, 0] = 1
+        inputs.append((x, torch.zeros_like(x) if with_pos else None, mask))
+
+    with torch.no_grad():
+        hids = modules.fused_emb1(emb1, inputs, hidden_idx=-2)
+        for (x, pos, mask), hid in zip(inputs, hids):
+            expected = emb1(x, position_ids=pos, attention_mask=mask, hidden_idx=-2)
+            assert hid.shape == expected.shape
+            m = mask.unsqueeze(2)
+            torch.testing.assert_close(hid * m, expected * m, rtol=1e-4, atol=1e-5)
+
+
+def test_persona_hid_of_context_emb_equals_persona_emb():
+    vocab = FakeVocab()
+    bert = plus_testing.build_pretrain_feature_model(vocab)
+    model = plus_testing.build_model(vocab, bert, auxiliary_task=None).eval()
+    feature = datasets.generate_batch(plus_testing.chat_examples(vocab, 4), vocab, None,
+            False, with_lm=False)
+    with torch.no_grad():
+        _, persona_hid = model.context_emb(feature, with_persona=True)
+        fused = model.persona_emb(feature.persona, feature.persona_pad_mask, persona_hid)
+        separate = model.persona_emb(feature.persona, feature.persona_pad_mask)
+    mask = ~feature.persona_pad_mask.T.unsqueeze(2)
+    torch.testing.assert_close(fused * mask, separate * mask, rtol=1e-4, atol=1e-5)
+
+
+def _version1_context_emb(model, feature):
+    """ContextEmb pretrain feature of the models trained before persona_feature_version 2:
+    the pad masks are in the (n, 2) order and the pads are summed
+    """
+    emb1 = model.context_emb.emb1
+    batch_size = feature.context.shape[1]
+    speakers = 0
+    for x, pad_mask in ((feature.personas_no_tag, feature.personas_no_tag_pad_mask),
+            (feature.tags, feature.tags_pad_mask)):
+        x = x.permute(2, 0, 1).reshape(batch_size, -1)
+        attention_mask = (pad_mask.reshape(batch_size, -1) != 1).float()
+        hid = emb1(x, position_ids=torch.zeros_like(x), attention_mask=attention_mask,
+                hidden_idx=-2)
+        speakers = speakers + hid.view(batch_size, 2, -1, hid.shape[2]).sum(2)
+    emb = emb1(feature.context.T, attention_mask=(feature.context_pad_mask != 1).float(),
+            hidden_idx=-2).transpose(0, 1)
+    for i, idx in enumerate((model.context_emb.spe1_idx, model.context_emb.spe2_idx)):
+        emb = torch.where((feature.segs == idx).unsqueeze(2), emb + speakers[:, i], emb)
+    return emb
+
+
+def test_persona_feature_version1_keeps_old_features():
+    vocab = FakeVocab()
+    bert = plus_testing.build_pretrain_feature_model(vocab)
+    examples = plus_testing.chat_examples(vocab, 5, seed=2)
+    features = {version: datasets.generate_batch(examples, vocab, None, False, with_lm=False,
+            persona_feature_version=version) for version in (1, 2)}
+
+    # the old collate viewed the tags of all examples as one row
+    tags_pad = torch.nn.utils.rnn.pad_sequence([torch.tensor(v) for ex in examples
+            for v in ex[3]], padding_value=vocab.stoi(utils.PAD))
+    assert torch.equal(features[1].tags,
+            tags_pad.view(-1, 2, int(tags_pad.shape[1]/2)).transpose(1, 0))
+    assert not torch.equal(features[1].tags, features[2].tags)
+
+    embs = {}
+    for version, feature in features.items():
+        model = plus_testing.build_model(vocab, bert, auxiliary_task=None,
+                persona_feature_version=version).eval()
+        assert model.context_emb.persona_feature_version == version
+        with torch.no_grad():
+            embs[version] = model.context_emb(feature)
+    with torch.no_grad():
+        expected = _version1_context_emb(model, features[1])
+    mask = ~features[1].context_pad_mask.T.unsqueeze(2)
+    torch.testing.assert_close(embs[1] * mask, expected * mask, rtol=1e-4, atol=1e-4)
+    assert not torch.allclose(embs[1] * mask, embs[2] * mask, atol=1e-3)
+
+
+def test_model_configs_without_version_are_version1():
+    vocab = FakeVocab()
+    args = plus_testing.model_args()
+    del args.persona_feature_version
+    model = models.AR.build(args, len(vocab), len(vocab), vocab)
+    assert model.context_emb.persona_feature_version == 1
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+import plus_testing
+from plus_testing import datasets, utils, FakeVocab
+
+
+def _lengths(n=230, seed=0):
+    rnd = np.random.RandomState(seed)
+    return np.stack([rnd.randint(1, 40, n), rnd.randint(2, 12, n), rnd.randint(2, 12, n)], axis=1)
+
+
+@pytest.mark.parametrize('shuffle', [True, False])
+def test_bucket_batches_cover_examples_once(shuffle):
+    lengths = _lengths()
+    sampler = utils.BucketBatchSampler(lengths, 8, shuffle, bucket_size=5)
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert sorted(sum(batches, [])) == list(range(len(lengths)))
+    assert all(len(b) <= 8 for b in batches)
+    assert sum(len(b) < 8 for b in batches) <= len(lengths) // 40 + 1
+
+
+def test_bucket_batches_are_sorted_by_lengths():
+    lengths = _lengths()
+    sampler = utils.BucketBatchSampler(lengths, 8, False, bucket_size=5)
+    batches = list(sampler)
+    # without shuffle, buckets are in order of examples, sorted in each bucket
+    for start in range(0, len(batches), 5):
+        bucket = sum(batches[start:start+5], [])
+        assert sorted(bucket) == list(range(start * 8, start * 8 + len(bucket)))
+        keys = [tuple(lengths[i]) for i in bucket]
+        assert keys == sorted(keys)
+    padded = sum(len(b) * lengths[b, 0].max() for b in batches)
+    unbucketed = sum(8 * lengths[i:i+8, 0].max() for i in range(0, len(lengths), 8))
+    assert padded < unbucketed
+
+
+def test_bucket_set_epoch_changes_order():
+    sampler = utils.BucketBatchSampler(_lengths(), 8, bucket_size=5, num_replicas=2, seed=3)
+    first = list(sampler)
+    assert list(sampler) == first
+    sampler.set_epoch(1)
+    assert list(sampler) != first
+
+
+def test_bucket_replicas_split_batches():
+    lengths = _lengths()
+    replicas = [utils.BucketBatchSampler(lengths, 8, bucket_size=5, num_replicas=3, rank=rank)
+            for rank in range(3)]
+    for epoch in (0, 1):
+        for sampler in replicas:
+            sampler.set_epoch(epoch)
+        batches = [list(sampler) for sampler in replicas]
+        assert len({len(b) for b in batches}) == 1
+        assert len(batches[0]) == len(replicas[0])
+        # every batch is in exactly one replica, but for the padding
+        assert set(sum(sum(batches, []), [])) == set(range(len(lengths)))
+        n_batches = len(list(utils.BucketBatchSampler(lengths, 8, bucket_size=5)))
+        assert sum(map(len, batches)) - n_batches < 3
+
+
+def test_chat_lengths(tmp_path):
+    vocab = FakeVocab()
+    plus_testing.write_chat_data(str(tmp_path), 'train', 6)
+    ds = utils.PersonaDataset(vocab, 8, None, data_path=str(tmp_path),
+            cache_path=str(tmp_path), data_processer=plus_testing.chat_processer(vocab),
+            mode='train')
+    lengths = datasets.chat_lengths(ds)
+    assert lengths.shape == (len(ds), 3)
+    for (context, _, _, _, resp, _, lm), lens in zip(ds, lengths):
+        assert lens.tolist() == [len(context), len(resp), len(lm)]
+
+
+@pytest.mark.parametrize('shuffle', [True, False])
+def test_token_budget_batches(shuffle):
+    lengths = _lengths()
+    sampler = utils.BucketBatchSampler(lengths, 16, shuffle, bucket_size=5, max_tokens=200)
+    batches = list(sampler)
+    assert sorted(sum(batches, [])) == list(range(len(lengths)))
+    if not shuffle:
+        assert len(sampler) == len(batches)
+    for batch in batches:
+        assert len(batch) <= 16
+        assert len(batch) == 1 or len(batch) * lengths[batch].max(0).sum() <= 200
+    assert {len(b) for b in batches} - {1, 16}
+
+
+def test_token_budget_keeps_long_examples():
+    lengths = np.array([[3, 2, 2]] * 4 + [[100, 2, 2]] + [[3, 2, 2]] * 4)
+    batches = list(utils.BucketBatchSampler(lengths, 8, False, max_tokens=30))
+    assert [4] in batches
+    assert sorted(sum(batches, [])) == list(range(9))
@@ -0,0 +1,122 @@
+import contextlib
+
+import torch
+from torch import nn
+
+import plus_testing
+from plus_testing import datasets, utils, FakeVocab
+
+
+def _feature(vocab, n=6, seed=7):
+    examples = plus_testing.chat_examples(vocab, n, seed=seed)
+    return datasets.generate_batch(examples, vocab, None, True,
+            generator=torch.Generator().manual_seed(0))
+
+
+def _autocast(amp):
+    """utils.autocast of cpu, no autocast context if amp is None"""
+    if amp is None:
+        return contextlib.nullcontext()
+    return utils.autocast(torch.device('cpu'), amp)
+
+
+def _loss_and_grads(model, feature, pad_idx, amp=None, chunk_size=None):
+    model.zero_grad()
+    with _autocast(amp):
+        if chunk_size is None:
+            out, out_lm = model(feature)
+            loss, loss_lm = model.loss('MLM', nn.CrossEntropyLoss(ignore_index=pad_idx),
+                    out, out_lm, feature.resp, feature.lm.y)
+        else:
+            out, out_lm = model(feature, logits=False)
+            loss, loss_lm = model.chunked_loss('MLM', pad_idx, chunk_size,
+                    out, out_lm, feature.resp, feature.lm.y)
+        loss = loss + 0.5 * loss_lm
+    loss.backward()
+    return loss.detach(), [None if p.grad is None else p.grad.clone()
+            for p in model.parameters()]
+
+
+def test_autocast_disabled_is_fp32():
+    vocab = FakeVocab()
+    pad_idx = vocab.stoi(utils.PAD)
+    feature = _feature(vocab)
+    model = plus_testing.build_model(vocab)
+    with torch.no_grad():
+        out, out_lm = model(feature)
+        with _autocast(False):
+            amp_off_out, amp_off_out_lm = model(feature)
+    assert amp_off_out.dtype == amp_off_out_lm.dtype == torch.float32
+    assert torch.equal(amp_off_out, out) and torch.equal(amp_off_out_lm, out_lm)
+
+    loss, grads = _loss_and_grads(model, feature, pad_idx)
+    amp_off, amp_off_grads = _loss_and_grads(model, feature, pad_idx, amp=False)
+    assert amp_off.dtype == torch.float32
+    assert torch.equal(amp_off, loss)
+    for g, e in zip(amp_off_grads, grads):
+        assert (g is None) == (e is None)
+        if g is not None:
+            assert g.dtype == torch.float32
+            assert torch.equal(g, e)
+
+
+def test_bf16_autocast_keeps_fp32_parameters():
+    vocab = FakeVocab()
+    pad_idx = vocab.stoi(utils.PAD)
+    feature = _feature(vocab)
+    model = plus_testing.build_model(vocab)
+    loss, grads = _loss_and_grads(model, feature, pad_idx)
+
+    with utils.autocast(torch.device('cpu'), True):
+        out, _ = model(feature)
+    assert out.dtype == torch.bfloat16
+
+    for chunk_size in (None, 5):
+        amp_loss, amp_grads = _loss_and_grads(model, feature, pad_idx, True, chunk_size)
+        assert amp_loss.dtype == torch.float
+        torch.testing.assert_close(amp_loss, loss, rtol=2e-2, atol=0)
+        assert all(p.dtype == torch.float for p in model.parameters())
+        for g, e in zip(amp_grads, grads):
+            if g is None:
+                continue
+            assert g.dtype == torch.float
+            assert torch.isfinite(g).all()
+        # bf16 gradients are close to the fp32 ones as a whole
+        cos = nn.functional.cosine_similarity(
+                torch.cat([g.flatten() for g in amp_grads if g is not None]),
+                torch.cat([g.flatten() for g in grads if g is not None]), 0)
+        assert cos > 0.99
+
+
+def test_grad_checkpoint_keeps_loss_and_grads():
+    vocab = FakeVocab()
+    pad_idx = vocab.stoi(utils.PAD)
+    feature = _feature(vocab)
+    results = []
+    for grad_checkpoint in (False, True):
+        # dropout masks of the recompute are the same as in forward
+        model = plus_testing.build_model(vocab, dropout=0.1, grad_checkpoint=grad_checkpoint)
+        model.train()
+        calls = []
+        layer = model.resp_decoder.layers[0]
+        layer.register_forward_pre_hook(lambda *_: calls.append(1))
+        torch.manual_seed(5)
+        results.append(_loss_and_grads(model, feature, pad_idx) + (len(calls),))
+
+    (loss, grads, n_calls), (cp_loss, cp_grads, cp_n_calls) = results
+    torch.testing.assert_close(cp_loss, loss)
+    for g, e in zip(cp_grads, grads):
+        assert (g is None) == (e is None)
+        if g is not None:
+            torch.testing.assert_close(g, e)
+    # the checkpointed layer runs again in backward
+    assert cp_n_calls > n_calls
+
+
+def test_grad_checkpoint_off_without_grad():
+    vocab = FakeVocab()
+    feature = _feature(vocab)
+    model = plus_testing.build_model(vocab, grad_checkpoint=True)
+    expected = plus_testing.build_model(vocab)
+    with torch.no_grad():
+        assert torch.equal(model(feature)[0], expected(feature)[0])
@@ -1,9 +1,12 @@
 
 import os
+import re
 import shutil
+import contextlib
 import random
 import math
 import time
+import logging
 import argparse
 import yaml
 from collections import OrderedDict
@@ -50,10 +53,30 @@ class Trainer:
         args = self.parse_args()
         self.args = args
         self.best_valid_loss = float('inf')
+        # training position, restored by resume
+        self.start_epoch = 0
+        self.global_step = 0
+        self.resume_batches = 0
+        self.resume_epoch_loss = 0
+        # distributed if launched by torchrun
+        self.rank, self.local_rank, self.world_size = utils.init_distributed(args.dist_backend)
         self.device = utils.get_device(args.device)
-        utils.set_random_seed(self.args.seed, self.device)
+        if self.device.type == 'cuda' and self.world_size > 1:
+            self.device = torch.device('cuda', self.local_rank)
+            torch.cuda.set_device(self.device)
+        # tensors of utils.all_reduce_sum, cpu for gloo
+        self.dist_device = self.device if args.dist_backend == 'nccl' else 'cpu'
+        # different dropout and masks in processes, DDP broadcasts the model of rank 0
+        utils.set_random_seed(self.args.seed + self.rank, self.device)
 
         self.logger = utils.create_logger(self.args.log_path, 'trainer')
+        if not utils.is_main_process():
+            self.logger.setLevel(logging.WARNING)
+        # the checkpoints of the runs before count in keep_checkpoints
+        saved, best = utils.list_checkpoints(args.model_path, 
+                r'model_(lm)?_epoch\d+(_step\d+)?_' + re.escape(args.experiment_name))
+        self.checkpoint_writer = utils.CheckpointWriter(args.keep_checkpoints, self.logger,
+                saved, best)
 
         self.ensure_deps()
 
@@ -93,12 +116,45 @@ class Trainer:
         parser.add_argument('--max_seq_length', default=300, type=int, required=False, help='')
         parser.add_argument('--max_context_size', default=10, type=int, required=False, help='')
         parser.add_argument('--shuffle_data', action='store_true', required=False, help='')
+        parser.add_argument('--stream_data', action='store_true', required=False, 
+                help='Stream train examples from data_path without feature cache')
+        parser.add_argument('--shuffle_buffer_size', default=10000, type=int, required=False, 
+                help='Shuffle buffer of stream_data, 0 for no shuffle')
+        parser.add_argument('--bucket_size', default=0, type=int, required=False, 
+                help='Batch chat examples of similar lengths in buckets of bucket_size batches, 0 for no bucket')
+        parser.add_argument('--max_tokens', default=0, type=int, required=False, 
+                help='Token budget of chat batches, counting padded context, resp and lm tokens, 0 for fixed batch_size')
+        parser.add_argument('--num_workers', default=0, type=int, required=False, 
+                help='DataLoader worker processes')
+        parser.add_argument('--prefetch_factor', default=2, type=int, required=False, 
+                help='Batches loaded in advance by each worker')
+        parser.add_argument('--persistent_workers', action='store_true', required=False, 
+                help='Keep DataLoader workers between epochs')
+        parser.add_argument('--background_prefetch', action='store_true', required=False, 
+                help='Load batches in a background thread with utils.DataLoaderX')
+        parser.add_argument('--n_build_workers', default=1, type=int, required=False, 
+                help='Processes to build features of chat datasets when not in cache_path')
+        parser.add_argument('--session_data', action='store_true', required=False, 
+                help='Store chat features once per session, examples are expanded when loaded')
+        parser.add_argument('--dist_backend', default='gloo', type=str, required=False, 
+                help='torch.distributed backend when launched by torchrun, gloo for cpu')
+        parser.add_argument('--amp', action='store_true', required=False, 
+                help='bf16 autocast of forward and loss in train and eval, weights and optimizer state stay fp32')
+        parser.add_argument('--grad_checkpoint', action='store_true', required=False, 
+                help='Checkpoint every encoder and decoder layer call, recompute activations in backward')
+        parser.add_argument('--loss_chunk_size', default=0, type=int, required=False, 
+                help='Positions of the vocab logits computed at once in the loss, 0 for all logits')
         parser.add_argument('--max_vocab_size', default=40000, type=int, required=False, help='')
         parser.add_argument('--pretrain_emb', action='store_true', required=False, help='')
         parser.add_argument('--share_encoder_decoder', action='store_true', required=False, help='')
         parser.add_argument('--pretrain_feature', action='store_true', required=False, help='')
         parser.add_argument('--pretrain_feature_model_name', default='', type=str, required=False, help='')
         parser.add_argument('--pretrain_feature_type', default='emb', type=str, required=False, help='')
+        parser.add_argument('--pretrain_feature_store', action='store_true', required=False, 
+                help='Precompute pretrain features to cache_path once, and train with them')
+        parser.add_argument('--persona_feature_version', default=1, type=int, required=False, 
+                help='2: speaker features of only the persona and tag tokens, tags of '
+                'their own example, 1: as the models trained before it, absent in their configs')
 
         parser.add_argument('--emb_freeze', action='store_true', required=False, help='')
         parser.add_argument('--emb_dim', default=200, type=int, required=False, help='')
@@ -129,8 +185,16 @@ class Trainer:
 
         parser.add_argument('--model_path', default='models/', type=str, required=False, help='')
         parser.add_argument('--pretrained_fname', type=str, required=False, help='')
+        parser.add_argument('--resume', type=str, required=False, 
+                help='Checkpoint dir of save_model, resume the model, optimizer, scheduler, rng, epoch and step')
+        parser.add_argument('--save_steps', default=0, type=int, required=False, 
+                help='Also save a checkpoint every save_steps optimizer steps, 0 for only at epoch end')
+        parser.add_argument('--keep_checkpoints', default=1, type=int, required=False, 
+                help='Keep the last keep_checkpoints checkpoints and the best one, 0 to keep all')
         parser.add_argument('--data_path', default='datas/', type=str, required=False, help='')
         parser.add_argument('--cache_path', default='caches/', type=str, required=False, help='')
+        parser.add_argument('--cache_max_age_days', default=0, type=float, required=False, 
+                help='Remove the caches in cache_path not used for that many days, 0 to keep them')
         parser.add_argument('--log_path', default='logs/', type=str, required=False, help='')
         parser.add_argument('--corpus_fname', default='datas/corpus.txt', type=str, required=False, help='')
         parser.add_argument('--vec_fname', default='models/vec.txt', type=str, required=False, help='')
@@ -208,7 +272,6 @@ class Trainer:
         # self.pretrain_feature_pipeline = Pipeline('feature-extraction', 
         #        model=self.pretrain_feature_model, tokenizer=pretrain_feature_tokenizer)
 
-        # TODO: pre calc feature and save to file, it use less memory for train and faster 
         # XXX: only used this tokenizer vocab, did not used for byte pair split, now just split by space
         utils.add_special_tokens_(self.pretrain_feature_model, pretrain_feature_tokenizer)
         # FIXME: this changed args should saved to checkpoint file
@@ -244,9 +307,9 @@ class Trainer:
     def build_dataloaders(self):
         args = self.args
         is_mlm = self.args.auxiliary_task == 'MLM'
-        gb = lambda batch: datasets.generate_batch(batch, 
-                self.vocab, self.persona_vocab, is_mlm)
-        gb_lm = lambda batch: datasets.generate_lm_batch(batch, self.vocab, is_mlm)
+        gb = datasets.ChatCollate(self.vocab, self.persona_vocab, is_mlm, 
+                persona_feature_version=args.persona_feature_version)
+        gb_lm = datasets.LMCollate(self.vocab, is_mlm)
 
         if args.n_epochs_early_stage > 0:
             dp = datasets.LMDataProcesser(limit_length=args.limit_example_length, 
@@ -258,44 +321,100 @@ class Trainer:
                     data_processer=dp, mode='train_lm')
             self.logger.info('---------------------------------')
             self.logger.info('datasets len: %s' % len(ds))
-            self.train_iter = DataLoader(ds, batch_size=args.batch_size, 
+            self.train_iter = utils.build_dataloader(ds, args, batch_size=args.batch_size, 
                     collate_fn=gb_lm, shuffle=True) 
         else:
             dp = datasets.ChatDataProcesser(limit_length=args.limit_example_length, 
                     max_seq_length=args.max_seq_length, max_context_size=args.max_context_size,
                     vocab=self.vocab, persona_vocab=self.persona_vocab,
                     tokenizer=self.tokenizer)
-            ds = utils.PersonaDataset(
-                    self.vocab, args.max_seq_length, args.limit_example_length, 
-                    data_path=args.data_path, cache_path=args.cache_path, 
-                    data_processer=dp, mode='train_char')
-            self.logger.info('---------------------------------')
-            self.logger.info('datasets len: %s' % len(ds))
-            # when Dataset is stream, try utils.DataLoaderX (prefetch_generator), https://github.com/IgorSusmelj/pytorch-styleguide/issues/5
-            self.train_iter = DataLoader(ds, batch_size=args.batch_size, 
-                    collate_fn=gb, shuffle=args.shuffle_data) 
+            if args.stream_data:
+                ds = utils.PersonaIterableDataset(self.vocab, 
+                        data_path=args.data_path, data_processer=dp, mode='train_char',
+                        shuffle_buffer_size=args.shuffle_buffer_size if args.shuffle_data else 0)
+                # when Dataset is stream, try background_prefetch (prefetch_generator), https://github.com/IgorSusmelj/pytorch-styleguide/issues/5
+                self.train_iter = utils.build_dataloader(ds, args, batch_size=args.batch_size, 
+                        collate_fn=gb) 
+            else:
+                ds = self.build_chat_dataset(dp, 'train_char')
+                ds = self.wrap_pretrain_feature_store(ds)
+                self.logger.info('---------------------------------')
+                self.logger.info('datasets len: %s' % len(ds))
+                self.train_iter = self.build_dataloader(ds, gb, args.shuffle_data)
 
             dp = datasets.ChatDataProcesser(limit_length=args.limit_example_length, 
                         max_seq_length=args.max_seq_length, max_context_size=args.max_context_size,
                         vocab=self.vocab, persona_vocab=self.persona_vocab,
                         tokenizer=self.tokenizer)
-            ds = utils.PersonaDataset(
-                    self.vocab, args.max_seq_length, args.limit_example_length, 
-                    data_path=args.data_path, cache_path=args.cache_path, 
-                    data_processer=dp, mode='valid_char')
-            self.valid_iter = DataLoader(ds, batch_size=args.batch_size,
-                    collate_fn=gb, shuffle=False) 
+            ds = self.build_chat_dataset(dp, 'valid_char')
+            ds = self.wrap_pretrain_feature_store(ds)
+            self.valid_iter = self.build_dataloader(ds, gb, False)
 
             dp = datasets.ChatDataProcesser(limit_length=args.limit_example_length, 
                         max_seq_length=args.max_seq_length, max_context_size=args.max_context_size,
                         vocab=self.vocab, persona_vocab=self.persona_vocab,
                         tokenizer=self.tokenizer)
-            ds = utils.PersonaDataset(
-                    self.vocab, args.max_seq_length, args.limit_example_length, 
-                    data_path=args.data_path, cache_path=args.cache_path, 
-                    data_processer=dp, mode='test_char')
-            self.test_iter = DataLoader(ds, batch_size=args.batch_size,
-                    collate_fn=gb, shuffle=False)
+            ds = self.build_chat_dataset(dp, 'test_char')
+            ds = self.wrap_pretrain_feature_store(ds)
+            self.test_iter = self.build_dataloader(ds, gb, False)
+
+        if args.cache_max_age_days > 0:
+            # after the datasets above are loaded, their caches are just used
+            utils.CacheManifest(args.cache_path).evict_unused(args.cache_max_age_days * 86400)
+
+    def build_chat_dataset(self, dp, mode):
+        """datasets.ChatSessionDataset if session_data, else utils.PersonaDataset"""
+        args = self.args
+        if args.session_data:
+            dataset_cls = datasets.ChatSessionDataset
+        else:
+            dataset_cls = utils.PersonaDataset
+        return dataset_cls(
+                self.vocab, args.max_seq_length, args.limit_example_length, 
+                data_path=args.data_path, cache_path=args.cache_path, 
+                data_processer=dp, mode=mode,
+                n_build_workers=args.n_build_workers)
+
+    def build_dataloader(self, ds, collate_fn, shuffle):
+        """DataLoader of chat dataset, with utils.BucketBatchSampler 
+        if bucket_size > 0 or max_tokens > 0
+        """
+        args = self.args
+        if args.bucket_size <= 0 and args.max_tokens <= 0:
+            return utils.build_dataloader(ds, args, batch_size=args.batch_size,
+                    collate_fn=collate_fn, shuffle=shuffle) 
+
+        batch_sampler = utils.BucketBatchSampler(datasets.chat_lengths(ds), 
+                args.batch_size, shuffle, max(args.bucket_size, 1), 
+                args.max_tokens if args.max_tokens > 0 else None,
+                num_replicas=self.world_size, rank=self.rank, seed=args.seed)
+        return utils.build_dataloader(ds, args, batch_sampler=batch_sampler, 
+                collate_fn=collate_fn)
+
+    def wrap_pretrain_feature_store(self, ds):
+        """Read the pretrain features of ds from datasets.PretrainFeatureStore,
+        it is computed once if not in cache_path
+        """
+        args = self.args
+        if not args.pretrain_feature or not args.pretrain_feature_store \
+                or args.pretrain_feature_type in ('weight', 'mem_n2n'):
+            return ds
+
+        assert args.persona_feature_version == datasets.PretrainFeatureStore.VERSION, \
+                'pretrain_feature_store has the features of persona_feature_version %d' \
+                % datasets.PretrainFeatureStore.VERSION
+        # keyed by the dataset cache, evicted with it when the data file changes
+        name = 'pretrain_feature_v{}_{}_{}'.format(datasets.PretrainFeatureStore.VERSION, 
+                ds.cache_name, args.pretrain_feature_model_name.replace('/', '_'))
+        store = datasets.PretrainFeatureStore.load_or_build(
+                os.path.join(args.cache_path, name), ds, 
+                models.pretrain_feature_fn(self.pretrain_feature_model),
+                self.vocab, self.persona_vocab, args.batch_size, self.device)
+        utils.CacheManifest(args.cache_path).add(name, 
+                dict(ds.cache_config, pretrain_feature_model_name=args.pretrain_feature_model_name,
+                    version=datasets.PretrainFeatureStore.VERSION),
+                ('.idx.npz', '.bin'))
+        return datasets.PretrainFeatureDataset(ds, store)
 
     def build_model(self):
         args = self.args
@@ -324,8 +443,11 @@ class Trainer:
                         mode='min', factor=0.5, min_lr=1.5e-4, patience=60, verbose=True)
             else:
                 # XXX: scheduler will run once at start, even if has no scheduler.step()
-                total_steps = int(len(self.train_iter.dataset) * args.n_epochs 
-                        / args.batch_size / args.gradient_accumulation)
+                assert not args.stream_data, 'stream_data has no dataset length for warmup schedule'
+                # batches of this process, BucketBatchSampler batches with max_tokens 
+                # are not batch_size examples, the last micro batches of an epoch 
+                # short of gradient_accumulation are no step
+                total_steps = len(self.train_iter) // args.gradient_accumulation * args.n_epochs
                 self.scheduler = transformers.get_linear_schedule_with_warmup(self.optimizer, 
                         num_warmup_steps=args.warmup_steps, num_training_steps=total_steps)
  
@@ -338,11 +460,23 @@ class Trainer:
             self.logger.info(f'Load pretrained model {args.pretrained_fname}...')
             self.load_model()
 
+        if args.resume is not None:
+            self.logger.info(f'Resume from checkpoint {args.resume}...')
+            self.resume()
+
+        # forward of training and eval, self.model is for the state and methods
+        self.dist_model = self.model
+        if self.world_size > 1:
+            # some parameters are not used by a config, e.g. seq_emb without MLM
+            self.dist_model = nn.parallel.DistributedDataParallel(self.model, 
+                    device_ids=[self.device.index] if self.device.type == 'cuda' else None,
+                    broadcast_buffers=False, find_unused_parameters=True)
+
     def build_loss_fns(self):
         self.out_loss_fn = nn.CrossEntropyLoss(ignore_index=self.pad_idx)
 
     def run_early_stage(self):
-        for epoch in range(self.args.n_epochs_early_stage):
+        for epoch in range(self.start_epoch, self.args.n_epochs_early_stage):
             start_time = time.time()
 
             train_loss = self.train_lm(epoch)
@@ -360,23 +494,24 @@ class Trainer:
         if self.args.n_epochs_early_stage > 0:
             self.logger.info('Run early stage...')
             trainer.run_early_stage()
+            self.checkpoint_writer.wait()
             # after fin, rerun with pretrained model 
             return
 
         self.logger.info('Run main stage...')
 
-        best_val_loss = float("inf")
-
-        for epoch in range(self.args.n_epochs):
+        for epoch in range(self.start_epoch, self.args.n_epochs):
             start_time = time.time()
 
             train_loss = self.train(epoch)
             valid_loss = self.eval(self.valid_iter)
  
-            if valid_loss < best_val_loss:
-                best_val_loss = valid_loss
+            is_best = valid_loss < self.best_valid_loss
+            if is_best:
+                self.best_valid_loss = valid_loss
                 self.best_model = self.model
-                self.save_model(epoch)
+            # written in background, keep_checkpoints removes the old ones
+            self.save_model(epoch, is_best=is_best)
 
             # scheduler.step()
 
@@ -392,19 +527,23 @@ class Trainer:
         test_loss = self.eval(self.test_iter)
         self.logger.info(f'| Test Loss: {test_loss:.3f} | Test PPL: {math.exp(test_loss):7.3f} |')
 
+        self.checkpoint_writer.wait()
         # self.grad_util.plot()
 
     def train_lm(self, epoch):
         self.model.train()
 
-        epoch_loss = 0
-        for batch_idx, feature in enumerate(self.train_iter):
+        epoch_loss, n_batches = 0, 0
+        utils.set_loader_epoch(self.train_iter, epoch)
+        for batch_idx, feature in enumerate(
+                utils.distributed_batches(self.train_iter, self.dist_device)):
+            n_batches += 1
             start_time = time.time()
             self.optimizer.zero_grad()
 
             utils.feature_to_device(feature, self.device)
 
-            out = self.model(feature)
+            out = self.dist_model(feature)
             loss = self.out_loss_fn(out.view(-1, out.shape[-1]), 
                     feature.y.view(-1))
             # utils.self.logger.info_backward_graph(loss)
@@ -413,6 +552,7 @@ class Trainer:
             if self.args.clip_grad is not None:
                 nn.utils.clip_grad_norm_(self.model.parameters(), self.args.clip_grad)
             self.optimizer.step()
+            self.global_step += 1
 
             iloss = loss.item()
             epoch_loss += iloss
@@ -421,7 +561,8 @@ class Trainer:
             secs = end_time - start_time
             self.logger.info(f'Step {batch_idx+1}/{epoch+1:02} | Train Loss: {iloss:.3f} | Train PPL: {math.exp(iloss):7.3f} | Time: {secs:.3f}s\n')
 
-        return epoch_loss / len(self.train_iter)
+        epoch_loss, n_batches = utils.all_reduce_sum([epoch_loss, n_batches], self.dist_device)
+        return epoch_loss / n_batches
  
 
     def train(self, epoch, data_iter=None):
@@ -430,44 +571,106 @@ class Trainer:
         if data_iter is None:
             data_iter = self.train_iter
 
-        epoch_loss = 0
-        for batch_idx, feature in enumerate(data_iter):
-            start_time = time.time()
+        # the shuffle order of the epoch is drawn from it, saved by mid epoch checkpoints
+        self.epoch_rng_state = utils.get_rng_state()
+        # skip the batches trained before the resumed checkpoint
+        skip_batches, self.resume_batches = self.resume_batches, 0
+        epoch_loss, self.resume_epoch_loss = self.resume_epoch_loss, 0
+        n_pad, n_tokens = 0, 0
+        n_step_tokens = 0
+        start_time = time.time()
+        utils.set_loader_epoch(data_iter, epoch)
+        # the sampler skips them unless the data is a stream, which is read and dropped
+        start = skip_batches if utils.skip_loader_batches(data_iter, skip_batches) else 0
+        # batches of the epoch with the skipped ones,
+        # the loader yields none if resumed at the end of the epoch
+        n_batches = start
+        for batch_idx, feature in enumerate(
+                utils.distributed_batches(data_iter, self.dist_device), start):
+            n_batches += 1
+            if batch_idx < skip_batches:
+                continue
+            for pad_mask in (feature.context_pad_mask, feature.resp_pad_mask):
+                n_pad += pad_mask.sum().item()
+                n_tokens += pad_mask.numel()
+                n_step_tokens += pad_mask.numel() - pad_mask.sum().item()
 
             utils.feature_to_device(feature, self.device)
 
             # out, out_lm = torch_cp.checkpoint(self.model, feature)
-            out, out_lm = self.model(feature)
-            loss, loss_lm = models.AR.loss(self.args.auxiliary_task, 
-                    self.out_loss_fn, out, out_lm, feature.resp, feature.lm.y)
-            if self.args.auxiliary_task is not None:
-                loss = loss + self.args.alpha * loss_lm
-            if self.args.gradient_accumulation > 1:
-                loss = loss / self.args.gradient_accumulation
-                # accuracy = accuracy / self.args.gradient_accumulation
-            # utils.self.logger.info_backward_graph(loss)
-            loss.backward()
+            is_step = (batch_idx + 1) % self.args.gradient_accumulation == 0
+            # no gradient all-reduce of DDP before the last micro step of gradient_accumulation
+            with self.grad_sync(is_step):
+                # backward is out of autocast, grads are fp32 as the parameters, 
+                # no loss scaling for bf16, so clip_grad_norm_ clips the real grads
+                with utils.autocast(self.device, self.args.amp):
+                    loss, loss_lm = self.model_loss(feature)
+                    if self.args.auxiliary_task is not None:
+                        loss = loss + self.args.alpha * loss_lm
+                if self.args.gradient_accumulation > 1:
+                    loss = loss / self.args.gradient_accumulation
+                    # accuracy = accuracy / self.args.gradient_accumulation
+                # utils.self.logger.info_backward_graph(loss)
+                loss.backward()
 
             iloss = loss.item()
             epoch_loss += iloss
 
-            if self.args.clip_grad is not None:
-                nn.utils.clip_grad_norm_(self.model.parameters(), self.args.clip_grad)
-
             # self.grad_util.collect(self.model)
 
-            if (batch_idx + 1) % self.args.gradient_accumulation == 0:
+            if is_step:
+                # clip the accumulated (and all-reduced) grads
+                if self.args.clip_grad is not None:
+                    nn.utils.clip_grad_norm_(self.model.parameters(), self.args.clip_grad)
+
                 self.optimizer.step()
                 self.optimizer.zero_grad()
+                self.global_step += 1
 
+                # the same loss for the scheduler of all processes
+                iloss, n_step_tokens = utils.all_reduce_sum(
+                        [iloss / self.world_size, n_step_tokens], self.dist_device)
                 if self.args.use_scheduler:
                     self.scheduler.step(iloss)
 
                 end_time = time.time()
                 secs = end_time - start_time
-                self.logger.info(f'Step {batch_idx+1}/{epoch+1:02} | Train Loss: {iloss:.3f} | Train PPL: {math.exp(iloss):7.3f} | Time: {secs:.3f}s\n')
-
-        return epoch_loss / len(data_iter)
+                # non pad context and resp tokens of the step of all processes, with data loading time
+                tokens_per_sec = n_step_tokens / max(secs, 1e-6)
+                mem = utils.peak_memory(self.device)
+                self.logger.info(f'Step {batch_idx+1}/{epoch+1:02} | Train Loss: {iloss:.3f} | Train PPL: {math.exp(iloss):7.3f} | Time: {secs:.3f}s | Tokens/s: {tokens_per_sec:.0f} | Peak Mem: {mem:.0f}MB | AMP: {self.args.amp}\n')
+                n_step_tokens = 0
+
+                if self.args.save_steps > 0 and self.global_step % self.args.save_steps == 0:
+                    # all processes are at the step, the loss of all shards for resume
+                    saved_loss, = utils.all_reduce_sum([epoch_loss], self.dist_device)
+                    self.save_model(epoch, batches=batch_idx + 1, epoch_loss=saved_loss)
+                start_time = time.time()
+
+        self.logger.info(f'Epoch: {epoch+1:02} | Train Pad Ratio of context and resp: {n_pad / max(n_tokens, 1):.3f}')
+
+        # stream data has no len
+        epoch_loss, n_batches = utils.all_reduce_sum([epoch_loss, n_batches], self.dist_device)
+        return epoch_loss / n_batches
+
+    def grad_sync(self, enabled):
+        """No gradient all-reduce in the context if not enabled and distributed"""
+        if enabled or self.world_size == 1:
+            return contextlib.nullcontext()
+        return self.dist_model.no_sync()
+
+    def model_loss(self, feature):
+        """models.AR.loss of the chat feature, 
+        with AR.chunked_loss if loss_chunk_size > 0, the full vocab logits are not kept
+        """
+        if self.args.loss_chunk_size > 0:
+            # in the forward of DDP, or the generater weight gradient is not all-reduced
+            return self.dist_model(feature, 
+                    loss_chunk=(self.pad_idx, self.args.loss_chunk_size))
+
+        out, out_lm = self.dist_model(feature)
+        return models.AR.loss(self.args.auxiliary_task, 
+                self.out_loss_fn, out, out_lm, feature.resp, feature.lm.y)
 
     def eval(self, data_iter):
         self.model.eval()
@@ -478,29 +681,78 @@ class Trainer:
 
                 utils.feature_to_device(feature, self.device)
 
-                out, out_lm = self.model(feature)
-                loss, loss_lm = models.AR.loss(self.args.auxiliary_task,
-                        self.out_loss_fn, out, out_lm, feature.resp, feature.lm.y)
-                if self.args.auxiliary_task is not None:
-                    loss = loss + self.args.alpha * loss_lm
+                with utils.autocast(self.device, self.args.amp):
+                    loss, loss_lm = self.model_loss(feature)
+                    if self.args.auxiliary_task is not None:
+                        loss = loss + self.args.alpha * loss_lm
 
                 epoch_loss += loss.item()
 
-        return epoch_loss / len(data_iter)
+        # the losses of the shards of all processes
+        epoch_loss, n_batches = utils.all_reduce_sum([epoch_loss, len(data_iter)], self.dist_device)
+        return epoch_loss / n_batches
 
     # resuming vs Warmstarting(transfer learning)?
     # it just have difference of optimizer state_dict
     # https://pytorch.org/tutorials/beginner/saving_loading_models.html#saving-loading-a-general-checkpoint-for-inference-and-or-resuming-training
-    def save_model(self, epoch, stage=''):
-        model_path = os.path.join(self.args.model_path, 
-                'model_{}_epoch{}_{}'.format(stage, epoch + 1, self.args.experiment_name))
-        if not os.path.exists(model_path):
-            os.mkdir(model_path)
-        torch.save(self.model.state_dict(), model_path + '/model.pt')
-        shutil.copyfile(self.args.config_file, model_path + '/config.yml')
-        shutil.copyfile(self.args.vocab_fname, model_path + '/vocab')
+    def save_model(self, epoch, stage='', batches=0, epoch_loss=0, is_best=False):
+        """Save model.pt and the training state checkpoint.pt for resume,
+        the states are copied to cpu and written by self.checkpoint_writer in background
+
+        batches: batches trained of epoch for mid epoch checkpoints, 0 if epoch is finished
+        epoch_loss: sum of the train loss of the batches of all processes
+        """
+        if not utils.is_main_process():
+            return
+        name = 'model_{}_epoch{}_{}'.format(stage, epoch + 1, self.args.experiment_name)
+        if batches > 0:
+            name = 'model_{}_epoch{}_step{}_{}'.format(stage, epoch + 1, 
+                    self.global_step, self.args.experiment_name)
+        checkpoint = {
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict() if self.args.use_scheduler else None,
+            # replay the shuffle of a unfinished epoch
+            'rng': self.epoch_rng_state if batches > 0 else utils.get_rng_state(),
+            'epoch': epoch,
+            'batches': batches,
+            'epoch_loss': epoch_loss,
+            'global_step': self.global_step,
+            'best_valid_loss': self.best_valid_loss,
+        }
+        copies = {'config.yml': self.args.config_file, 'vocab': self.args.vocab_fname}
         if self.args.use_mem_n2n:
-            shutil.copyfile(self.args.persona_vocab_fname, model_path + '/vocab_persona')
+            copies['vocab_persona'] = self.args.persona_vocab_fname
+        self.checkpoint_writer.save(os.path.join(self.args.model_path, name), 
+                {'model.pt': self.model.state_dict(), 'checkpoint.pt': checkpoint},
+                copies, is_best=is_best)
+
+    def resume(self):
+        """Restore the training state of the save_model dir args.resume,
+        run continues from the end of its step, skipping the trained batches of the epoch
+        in the sampler, they are not collated again (so the MLM masks after it differ)
+        """
+        path = self.args.resume
+        self.model.load_state_dict(torch.load(os.path.join(path, 'model.pt'), map_location='cpu'))
+        checkpoint = torch.load(os.path.join(path, 'checkpoint.pt'), map_location='cpu')
+        self.optimizer.load_state_dict(checkpoint['optimizer'])
+        if self.args.use_scheduler and checkpoint['scheduler'] is not None:
+            self.scheduler.load_state_dict(checkpoint['scheduler'])
+
+        self.global_step = checkpoint['global_step']
+        self.best_valid_loss = checkpoint['best_valid_loss']
+        self.resume_batches = checkpoint['batches']
+        if self.resume_batches > 0:
+            self.start_epoch = checkpoint['epoch']
+            # train sums epoch_loss of all processes
+            self.resume_epoch_loss = checkpoint['epoch_loss'] / self.world_size
+        else:
+            self.start_epoch = checkpoint['epoch'] + 1
+
+        if self.world_size > 1:
+            # the rng state is of rank 0, the data order of distributed samplers is by epoch
+            utils.set_random_seed(self.args.seed + self.rank + self.global_step, self.device)
+        else:
+            utils.set_rng_state(checkpoint['rng'])
 
     def load_model(self):
         # tmp for load pretrain LM model before factor ff
@@ -1,11 +1,18 @@
 
 import os
+import re
 import json
+import array
+import hashlib
 import math
 import random
+import shutil
 import time
+import threading
 import logging
 import itertools
+import multiprocessing
+from dataclasses import dataclass
 from filelock import FileLock
 
 import numpy as np
@@ -13,8 +20,10 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data.dataset import Dataset
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from torch.utils.data.dataset import Dataset, IterableDataset
+from torch.utils.data import DataLoader, Sampler, DistributedSampler, \
+        BatchSampler, RandomSampler, SequentialSampler
 from torch.nn.utils.rnn import pad_sequence
 
 from prefetch_generator import BackgroundGenerator
@@ -33,6 +42,45 @@ def set_random_seed(seed, device):
         torch.backends.cudnn.deterministic = True
         torch.backends.cudnn.benchmark = False
 
+
+def get_rng_state():
+    """States of python, numpy and torch random generators, for checkpoints
+
+    numpy state array is kept as tensor, torch.load with weights_only can read it
+    """
+    np_state = np.random.get_state()
+    return {
+        'python': random.getstate(),
+        'numpy': (np_state[0], torch.from_numpy(np_state[1].copy())) + tuple(np_state[2:]),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np_state = state['numpy']
+    np.random.set_state((np_state[0], np_state[1].numpy()) + tuple(np_state[2:]))
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and state['cuda']:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def autocast(device, enabled):
+    """bf16 autocast on device if enabled, 
+    parameters, their grads and the optimizer state stay fp32
+    """
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=enabled)
+
+
+def peak_memory(device):
+    """Peak allocated MB of cuda device, or peak RSS MB of the process on cpu"""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    import resource
+    # KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
  
 class PositionalEncoding(nn.Module):
     def __init__(self, d_model, max_len=5000):
@@ -46,8 +94,8 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0).transpose(0, 1)
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
-        x = self.pe[:x.size(0), :]
+    def forward(self, x, start_pos=0):
+        x = self.pe[start_pos:start_pos+x.size(0), :]
         return x
        
                                 
@@ -113,6 +161,18 @@ def embedding(
     return nn.Embedding.from_pretrained(embeddings, freeze=emb_freeze, padding_idx=pad_idx)
  
 
+def speakers_sum(hid, attention_mask):
+    """Sum of the token hidden states of each of the 2 speakers, pads excluded
+
+    Shape:
+        hid: batch_size X (2 * seq_len) X hid_dim, speaker 1 tokens then speaker 2 tokens
+        attention_mask: batch_size X (2 * seq_len), 1 for tokens, 0 for pads
+        output: 2 X batch_size X hid_dim
+    """
+    hid = hid * attention_mask.unsqueeze(2).to(hid.dtype)
+    return hid.view(hid.shape[0], 2, -1, hid.shape[2]).sum(dim=2).transpose(0, 1)
+
+
 def mask_seq_batch(seq, mask):
     return seq[:, mask]
 
@@ -367,11 +427,263 @@ def add_special_tokens_(model, tokenizer):
         model.resize_token_embeddings(new_num_tokens=orig_num_tokens + num_added_tokens)
                                                      
 
+def read_lines(f, byte_range=None):
+    """Lines of binary file f, only the lines in byte_range (start, end) if given"""
+    if byte_range is None:
+        yield from f
+        return
+
+    start, end = byte_range
+    f.seek(start)
+    for line in f:
+        if start >= end:
+            break
+        start += len(line)
+        yield line
+
+
+def split_file(fname, n_shards, limit_length=None):
+    """Split fname to n_shards byte ranges (start, end) at line starts, 
+    only the first limit_length lines if given
+    """
+    with open(fname, 'rb') as f:
+        if limit_length is None:
+            size = os.path.getsize(fname)
+        else:
+            size = sum(len(line) for line in itertools.islice(f, limit_length))
+
+        bounds = [0]
+        for i in range(1, n_shards):
+            pos = size * i // n_shards
+            if pos > bounds[-1]:
+                # next line start
+                f.seek(pos - 1)
+                f.readline()
+                pos = min(f.tell(), size)
+            bounds.append(max(pos, bounds[-1]))
+        bounds.append(size)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class FeatureArrays:
+    """Features stored as one flat int32 token array plus offsets, memory-mapped on load
+
+    Every feature has the same layout, a flat list of token ids (lm) or a tuple of
+    fields where each field is a list of ids or a list of n lists of ids
+    (personas_no_tag and tags). layout saves the number of sub-lists per field,
+    0 for flat fields, or is [-1] if the feature itself is a flat list.
+    __getitem__ returns the feature with zero-copy numpy slices in place of lists.
+    """
+    SUFFIXES = ('.tokens.npy', '.offsets.npy', '.layout.npy')
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.tokens = np.load(fname + '.tokens.npy', mmap_mode='r')
+        self.offsets = np.load(fname + '.offsets.npy', mmap_mode='r')
+        self.layout = np.load(fname + '.layout.npy').tolist()
+        self.n_seqs = sum(max(n, 1) for n in self.layout)
+
+    def __reduce__(self):
+        # reopen in DataLoader workers, not pickle the memory maps
+        return (self.__class__, (self.fname,))
+
+    @staticmethod
+    def exists(fname):
+        # layout is saved last
+        return os.path.exists(fname + '.layout.npy')
+
+    @staticmethod
+    def feature_layout(feature):
+        if not isinstance(feature, tuple):
+            return [-1]
+        return [len(v) if len(v) > 0 and isinstance(v[0], list) else 0 for v in feature]
+
+    @staticmethod
+    def save(fname, features):
+        """Raises ValueError if the features have different layouts"""
+        tokens = array.array('i')
+        offsets = array.array('q', [0])
+        layout = None
+        for i, feature in enumerate(features):
+            feature_layout = FeatureArrays.feature_layout(feature)
+            if layout is None:
+                layout = feature_layout
+            elif feature_layout != layout:
+                raise ValueError('Feature %d of %s has layout %s, not %s as the first one' 
+                        % (i, fname, feature_layout, layout))
+            fields = [feature] if layout == [-1] else feature
+            for n, v in zip(layout, fields):
+                for seq in (v if n > 0 else [v]):
+                    tokens.extend(seq)
+                    offsets.append(len(tokens))
+
+        np.save(fname + '.tokens.npy', np.frombuffer(tokens, dtype=np.int32))
+        np.save(fname + '.offsets.npy', np.frombuffer(offsets, dtype=np.int64))
+        np.save(fname + '.layout.npy', np.array(layout or [-1], dtype=np.int64))
+
+    @staticmethod
+    def concat(fname, shard_fnames):
+        """Save the features of shard_fnames in order to fname, and remove the shards"""
+        shards = [v for v in map(FeatureArrays, shard_fnames) if len(v) > 0]
+        layouts = set(tuple(v.layout) for v in shards)
+        assert len(layouts) <= 1, 'Shards have different layouts %s' % layouts
+
+        n_tokens = sum(len(v.tokens) for v in shards)
+        n_offsets = sum(len(v.offsets) - 1 for v in shards) + 1
+        tokens = np.lib.format.open_memmap(fname + '.tokens.npy', mode='w+', 
+                dtype=np.int32, shape=(n_tokens,))
+        offsets = np.lib.format.open_memmap(fname + '.offsets.npy', mode='w+', 
+                dtype=np.int64, shape=(n_offsets,))
+        offsets[0] = 0
+        i, j = 0, 1
+        for v in shards:
+            tokens[i:i+len(v.tokens)] = v.tokens
+            offsets[j:j+len(v.offsets)-1] = v.offsets[1:] + i
+            i += len(v.tokens)
+            j += len(v.offsets) - 1
+        tokens.flush()
+        offsets.flush()
+        del tokens, offsets, shards
+        np.save(fname + '.layout.npy', np.array(layouts.pop() if layouts else [-1], dtype=np.int64))
+
+        for v in shard_fnames:
+            for suffix in FeatureArrays.SUFFIXES:
+                os.remove(v + suffix)
+
+    def __len__(self):
+        return (len(self.offsets) - 1) // self.n_seqs
+
+    def _bounds(self, field):
+        assert self.layout == [-1] or self.layout[field] == 0, 'field must be a flat list'
+        k = sum(max(n, 1) for n in self.layout[:field])
+        offsets = np.asarray(self.offsets)
+        return offsets[k::self.n_seqs][:len(self)], offsets[k+1::self.n_seqs][:len(self)]
+
+    def lengths(self, field=0):
+        """Lengths of field of all features from offsets, without reading tokens"""
+        starts, ends = self._bounds(field)
+        return ends - starts
+
+    def field(self, field=0):
+        """Tokens of field of all features in one array, and the lengths"""
+        starts, ends = self._bounds(field)
+        lens = ends - starts
+        shift = starts - (np.cumsum(lens) - lens)
+        idx = np.repeat(shift, lens) + np.arange(lens.sum())
+        return np.asarray(self.tokens[idx]), lens
+
+    def __getitem__(self, i):
+        offsets = self.offsets[i*self.n_seqs:(i+1)*self.n_seqs+1]
+        seqs = [self.tokens[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+        if self.layout == [-1]:
+            return seqs[0]
+
+        feature = []
+        for n in self.layout:
+            feature.append(seqs[0] if n == 0 else seqs[:n])
+            seqs = seqs[max(n, 1):]
+        return tuple(feature)
+
+
+def fingerprint_vocab(vocab):
+    """Hash of the tokens of vocab, Vocab, ChatVocab or PersonaVocab"""
+    h = hashlib.sha1()
+    for i in range(len(vocab)):
+        h.update(str(vocab.itos(i)).encode('utf-8') + b'\n')
+    return h.hexdigest()
+
+
+def fingerprint_file(fname):
+    st = os.stat(fname)
+    return dict(path=os.path.abspath(fname), size=st.st_size, mtime_ns=st.st_mtime_ns)
+
+
+def fingerprint_processer(data_processer):
+    """Config of data_processer, vocabs are replaced by their fingerprints"""
+    config = dict(cls=type(data_processer).__name__)
+    for k, v in sorted(vars(data_processer).items()):
+        if hasattr(v, 'itos') and hasattr(v, '__len__'):
+            v = fingerprint_vocab(v)
+        elif hasattr(v, 'get_examples'):
+            v = fingerprint_processer(v)
+        elif callable(v):
+            v = getattr(v, '__qualname__', type(v).__name__)
+        elif not isinstance(v, (type(None), bool, int, float, str)):
+            v = type(v).__name__
+        config[k] = v
+    return config
+
+
+class CacheManifest:
+    """manifest.json of cache_path, the config of every cache entry
+
+    Entries are the file name prefix in cache_path, with the config including the
+    fingerprint of its source file. Entries of changed or removed source files are stale.
+    last_used is the time of the last add, evict_unused removes the entries not used for long.
+    """
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.fname = os.path.join(cache_path, 'manifest.json')
+
+    def _load(self):
+        if not os.path.exists(self.fname):
+            return {}
+        with open(self.fname) as f:
+            return json.load(f)
+
+    def _save(self, entries):
+        tmp_fname = self.fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(entries, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_fname, self.fname)
+
+    def add(self, name, config, suffixes):
+        with FileLock(self.fname + '.lock'):
+            entries = self._load()
+            entries[name] = dict(config=config, suffixes=list(suffixes), 
+                    last_used=time.time())
+            self._save(entries)
+
+    def _evict(self, is_evicted, reason):
+        with FileLock(self.fname + '.lock'):
+            entries = self._load()
+            for name, entry in list(entries.items()):
+                if not is_evicted(entry):
+                    continue
+                print("Evicting %s cache %s" % (reason, name))
+                for suffix in entry['suffixes']:
+                    fname = os.path.join(self.cache_path, name + suffix)
+                    if os.path.exists(fname):
+                        os.remove(fname)
+                del entries[name]
+            self._save(entries)
+
+    def evict_stale(self):
+        """Remove the files of entries with changed or removed source file"""
+        def is_stale(entry):
+            source = entry['config']['source']
+            return not os.path.exists(source['path']) or fingerprint_file(source['path']) != source
+        self._evict(is_stale, 'stale')
+
+    def evict_unused(self, max_age):
+        """Remove the files of entries not used in the last max_age seconds"""
+        now = time.time()
+        self._evict(lambda entry: now - entry['last_used'] > max_age, 'unused')
+
+
+def _save_feature_shard(vocab, data_path, data_processer, mode, byte_range, fname):
+    examples = data_processer.get_examples(data_path, mode, byte_range=byte_range)
+    features = data_processer.convert_examples_to_features(vocab, examples, mode=mode)
+    FeatureArrays.save(fname, features)
+
+
 # TODO: move vocab arg to ChatDataProcesser
-# use IterableDataset for lazy load
-# shuffle and sort can't work for lazy 
-# __len__ is useless for lazy load
+# for lazy load, use PersonaIterableDataset
 class PersonaDataset(Dataset):
+    """n_build_workers: build features of byte range shards of the data file in
+    processes if > 1, data_processer.get_examples must accept byte_range
+    """
     def __init__(
         self,
         vocab,
@@ -382,40 +694,64 @@ class PersonaDataset(Dataset):
         data_processer,
         mode='train',
         overwrite_cache=False,
+        n_build_workers=1,
     ):
-        # Load data features from cache or dataset file
-        cached_features_file = os.path.join(
-            cache_path,
-            "cached_{}_{}_{}".format(
+        # Load data features from cache or dataset file,
+        # the cache is keyed by the hash of all that changes the features
+        source_fname = os.path.join(data_path, mode + '.txt')
+        self.cache_config = dict(
+                mode=mode,
+                max_seq_length=max_seq_length,
+                limit_example_length=limit_example_length,
+                vocab=fingerprint_vocab(vocab),
+                data_processer=fingerprint_processer(data_processer),
+                source=fingerprint_file(source_fname),
+                format='FeatureArrays',
+                )
+        key = hashlib.sha1(json.dumps(self.cache_config, sort_keys=True).encode()).hexdigest()
+        self.cache_name = "cached_{}_{}_{}_{}".format(
                 mode, str(max_seq_length),
-                str(limit_example_length or 'all'),
-            ),
-        )
+                str(limit_example_length or 'all'), key[:16],
+                )
+        cached_features_file = os.path.join(cache_path, self.cache_name)
+        manifest = CacheManifest(cache_path)
+        manifest.evict_stale()
         
         # Make sure only the first process in distributed training processes the dataset,
         # and the others will use the cache.
         lock_path = cached_features_file + ".lock"
         with FileLock(lock_path):
-            if os.path.exists(cached_features_file) and not overwrite_cache:
-                start = time.time()
-                self.features = torch.load(cached_features_file)
-                print(
-                    f"Loading features from cached file {cached_features_file} [took %.3f s]", time.time() - start
-                )
-            else:
+            if not FeatureArrays.exists(cached_features_file) or overwrite_cache:
                 print(f"Creating features from dataset file at {data_path}")
 
-                examples = list(data_processer.get_examples(data_path, mode))
-                self.features = list(data_processer.convert_examples_to_features(
-                    vocab,
-                    examples,
-                    mode=mode,
-                ))
                 start = time.time()
-                torch.save(self.features, cached_features_file)
-                # ^ This seems to take a lot of time so I want to investigate why and how we can improve.
+                if n_build_workers > 1:
+                    # more shards than workers for balance, merged in file order
+                    byte_ranges = split_file(source_fname,
+                            n_build_workers * 4, data_processer.limit_length)
+                    shard_fnames = ['%s.shard%d' % (cached_features_file, i) 
+                            for i in range(len(byte_ranges))]
+                    with multiprocessing.Pool(n_build_workers) as pool:
+                        pool.starmap(_save_feature_shard, 
+                                [(vocab, data_path, data_processer, mode, r, fname) 
+                                 for r, fname in zip(byte_ranges, shard_fnames)],
+                                chunksize=1)
+                    FeatureArrays.concat(cached_features_file, shard_fnames)
+                else:
+                    examples = data_processer.get_examples(data_path, mode)
+                    features = data_processer.convert_examples_to_features(
+                        vocab,
+                        examples,
+                        mode=mode,
+                    )
+                    FeatureArrays.save(cached_features_file, features)
                 print("Saving features into cached file %s [took %.3f s]" % (cached_features_file, time.time() - start))
 
+            start = time.time()
+            self.features = FeatureArrays(cached_features_file)
+            print("Loading features from cached file %s [took %.3f s]" % (cached_features_file, time.time() - start))
+        manifest.add(self.cache_name, self.cache_config, FeatureArrays.SUFFIXES)
+
     def __len__(self):
         return len(self.features)
 
@@ -423,17 +759,557 @@ class PersonaDataset(Dataset):
         return self.features[i]
        
  
+class PersonaIterableDataset(IterableDataset):
+    """Stream features from data_processer without cache, for corpora larger than RAM
+
+    data_processer.get_examples must accept shard_id and num_shards, the input file
+    is sharded by lines across DataLoader workers of all distributed processes. Features are shuffled in a buffer
+    of shuffle_buffer_size, 0 for the file order.
+    """
+    def __init__(
+        self,
+        vocab,
+        data_path,
+        data_processer,
+        mode='train',
+        shuffle_buffer_size=0,
+    ):
+        self.vocab = vocab
+        self.data_path = data_path
+        self.data_processer = data_processer
+        self.mode = mode
+        self.shuffle_buffer_size = shuffle_buffer_size
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        shard_id, num_shards = 0, 1
+        if worker_info is not None:
+            shard_id, num_shards = worker_info.id, worker_info.num_workers
+        if dist.is_initialized():
+            # the workers of every process
+            shard_id += dist.get_rank() * num_shards
+            num_shards *= dist.get_world_size()
+
+        examples = self.data_processer.get_examples(self.data_path, self.mode,
+                shard_id=shard_id, num_shards=num_shards)
+        features = self.data_processer.convert_examples_to_features(
+                self.vocab, examples, mode=self.mode)
+        if self.shuffle_buffer_size <= 0:
+            yield from features
+            return
+
+        # seeded by torch, new order every epoch and reproducible with torch.manual_seed,
+        # the torch seed of a worker is also different
+        rng = random.Random(torch.empty((), dtype=torch.int64).random_().item())
+        buf = []
+        for feature in features:
+            if len(buf) < self.shuffle_buffer_size:
+                buf.append(feature)
+                continue
+            i = rng.randrange(len(buf))
+            yield buf[i]
+            buf[i] = feature
+        rng.shuffle(buf)
+        yield from buf
+       
+ 
+class BucketBatchSampler(Sampler):
+    """Batches of examples with similar lengths, to cut padding
+
+    Shuffled examples are split to buckets of bucket_size batches, and sorted by 
+    lengths in each bucket, then the batches of all buckets are shuffled. 
+    Without shuffle, buckets are in order of examples.
+
+    max_tokens: if given, a batch is cut when its padded tokens of all keys would be
+        over max_tokens, batch_size is still the max number of examples.
+        __len__ is the number of batches without shuffle then.
+    num_replicas, rank: for distributed training, every process gets every 
+        num_replicas-th batch from rank, padded with the first batches to the same 
+        number in all processes. The order is seeded by seed + epoch (set_epoch), 
+        so it is the same in all processes.
+
+    Shape:
+        lengths: n_examples X n_keys, sorted by keys in order
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100, max_tokens=None,
+            num_replicas=1, rank=0, seed=0):
+        lengths = np.asarray(lengths)
+        self.lengths = lengths[:, None] if lengths.ndim == 1 else lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.max_tokens = max_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = None
+        if self.num_replicas > 1:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+
+        n = len(self.lengths)
+        if self.shuffle:
+            idx = torch.randperm(n, generator=generator).numpy()
+        else:
+            idx = np.arange(n)
+
+        batches = self._batches(idx)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        if self.num_replicas > 1:
+            n_padded = math.ceil(len(batches) / self.num_replicas) * self.num_replicas
+            batches = list(itertools.islice(itertools.cycle(batches), n_padded))
+            batches = batches[self.rank::self.num_replicas]
+        return iter(batches)
+
+    def __len__(self):
+        n = len(self.lengths)
+        if self.max_tokens is not None:
+            n_batches = len(self._batches(np.arange(n)))
+        else:
+            step = self.bucket_size * self.batch_size
+            n_batches = (n // step) * self.bucket_size + math.ceil((n % step) / self.batch_size)
+        return math.ceil(n_batches / self.num_replicas)
+
+    def _batches(self, idx):
+        batches = []
+        step = self.bucket_size * self.batch_size
+        for start in range(0, len(idx), step):
+            bucket = idx[start:start+step]
+            # lexsort sorts by the last key first
+            bucket = bucket[np.lexsort(self.lengths[bucket].T[::-1])].tolist()
+            if self.max_tokens is None:
+                batches.extend(bucket[i:i+self.batch_size] 
+                        for i in range(0, len(bucket), self.batch_size))
+            else:
+                batches.extend(self._pack(bucket))
+        return batches
+
+    def _pack(self, bucket):
+        batch, max_lens = [], None
+        for i, lens in zip(bucket, self.lengths[bucket].tolist()):
+            if batch:
+                lens = [max(a, b) for a, b in zip(max_lens, lens)]
+                if len(batch) == self.batch_size \
+                        or (len(batch) + 1) * sum(lens) > self.max_tokens:
+                    yield batch
+                    batch, lens = [], self.lengths[i].tolist()
+            batch.append(i)
+            max_lens = lens
+        if batch:
+            yield batch
+       
+ 
+class ResumableBatchSampler(Sampler):
+    """Batches of batch_sampler, skip drops the first batches of the next epoch 
+    before their examples are loaded, for resuming in the middle of an epoch
+    """
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.skip = 0
+
+    def set_epoch(self, epoch):
+        for sampler in (self.batch_sampler, getattr(self.batch_sampler, 'sampler', None)):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        skip, self.skip = self.skip, 0
+        return itertools.islice(iter(self.batch_sampler), skip, None)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
 class DataLoaderX(DataLoader):
 
     def __iter__(self):
         return BackgroundGenerator(super().__iter__()) 
 
+
+def build_dataloader(dataset, args, **kwargs):
+    """DataLoader with the loader options of args
+
+    num_workers: worker processes, collate_fn and dataset must be picklable
+    prefetch_factor, persistent_workers: only used if num_workers > 0
+    background_prefetch: use DataLoaderX, load the next batches in a thread
+
+    In distributed training, a map style dataset without batch_sampler is 
+    split to the processes by DistributedSampler, call set_loader_epoch every epoch.
+    The batches of map style datasets are from a ResumableBatchSampler, see skip_loader_batches.
+    """
+    if not isinstance(dataset, IterableDataset):
+        batch_sampler = kwargs.pop('batch_sampler', None)
+        if batch_sampler is None:
+            shuffle = kwargs.pop('shuffle', False)
+            if dist.is_initialized():
+                sampler = DistributedSampler(dataset, shuffle=shuffle, seed=args.seed)
+            elif shuffle:
+                sampler = RandomSampler(dataset)
+            else:
+                sampler = SequentialSampler(dataset)
+            batch_sampler = BatchSampler(sampler, kwargs.pop('batch_size', 1), 
+                    kwargs.pop('drop_last', False))
+        kwargs['batch_sampler'] = ResumableBatchSampler(batch_sampler)
+    if args.num_workers > 0:
+        kwargs.update(num_workers=args.num_workers, 
+                prefetch_factor=args.prefetch_factor,
+                persistent_workers=args.persistent_workers)
+    if args.background_prefetch:
+        return DataLoaderX(dataset, **kwargs)
+    return DataLoader(dataset, **kwargs)
+
  
+def skip_loader_batches(data_iter, n):
+    """Skip the first n batches of the next epoch of data_iter without loading them,
+    False if it can't (no ResumableBatchSampler, e.g. stream datasets)
+    """
+    if not isinstance(data_iter.batch_sampler, ResumableBatchSampler):
+        return False
+    data_iter.batch_sampler.skip = n
+    return True
+
+
+def set_loader_epoch(data_iter, epoch):
+    """Set epoch of the distributed samplers of data_iter, for a new order every epoch"""
+    for sampler in (data_iter.sampler, data_iter.batch_sampler):
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+
+
+def init_distributed(backend='gloo'):
+    """Init the default process group if launched by torchrun with WORLD_SIZE > 1
+
+    Returns:
+        rank, local_rank, world_size, (0, 0, 1) if not distributed
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return 0, 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend)
+    return dist.get_rank(), int(os.environ.get('LOCAL_RANK', 0)), world_size
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def all_reduce_sum(values, device='cpu'):
+    """Sums of the float values over all processes, values if not distributed,
+    device: cpu for gloo, cuda for nccl
+    """
+    if not dist.is_initialized():
+        return list(values)
+    t = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(t)
+    return t.tolist()
+
+
+def distributed_batches(data_iter, device='cpu'):
+    """Batches of data_iter, stop in all processes when one has no more batches
+
+    For the uneven shards of PersonaIterableDataset, the processes must run the 
+    same number of steps, or the gradient all-reduce waits forever.
+    """
+    if not dist.is_initialized():
+        yield from data_iter
+        return
+
+    it = iter(data_iter)
+    while True:
+        batch = next(it, None)
+        has_batch = torch.tensor([batch is not None], dtype=torch.int, device=device)
+        dist.all_reduce(has_batch, op=dist.ReduceOp.MIN)
+        if not has_batch.item():
+            return
+        yield batch
+
+
+def cpu_state(state):
+    """Copy of state with the tensors copied to cpu, nested dicts, lists and tuples are copied"""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, cpu_state(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_state(v) for v in state)
+    return state
+
+
+def atomic_save(obj, fname):
+    """torch.save to a tmp file and rename, fname is the old or the whole new file"""
+    tmp_fname = fname + '.tmp'
+    torch.save(obj, tmp_fname)
+    os.replace(tmp_fname, fname)
+
+
+def atomic_copyfile(src, dst):
+    tmp_dst = dst + '.tmp'
+    shutil.copyfile(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+
+class CheckpointWriter:
+    """Write checkpoint dirs in a background thread
+
+    save copies the states to cpu and returns, the training goes on while they 
+    are written. Only one write runs at once, save waits for the last one.
+    Files are written with atomic_save, a crash never leaves a partial file.
+    The best dir has an empty 'best' file, for list_checkpoints.
+
+    keep_last: keep the last keep_last dirs and the best one, remove the older, 0 to keep all
+    saved, best: dirs written before, from list_checkpoints, they are removed the same way
+    """
+    def __init__(self, keep_last=1, logger=None, saved=(), best=None):
+        self.keep_last = keep_last
+        self.logger = logger
+        self.saved = list(saved)
+        self.best = best
+        self._thread = None
+        self._error = None
+
+    def save(self, dirname, states, copies=None, is_best=False):
+        """states: {fname: state} saved with torch.save, 
+        copies: {fname: src} files copied to dirname
+        """
+        self.wait()
+        states = {fname: cpu_state(state) for fname, state in states.items()}
+        self._thread = threading.Thread(target=self._write, 
+                args=(dirname, states, copies or {}, is_best))
+        self._thread.start()
+
+    def wait(self):
+        """Wait for the running write, raise its error"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self, dirname, states, copies, is_best):
+        try:
+            start_time = time.time()
+            os.makedirs(dirname, exist_ok=True)
+            for fname, state in states.items():
+                atomic_save(state, os.path.join(dirname, fname))
+            for fname, src in copies.items():
+                atomic_copyfile(src, os.path.join(dirname, fname))
+            best_fname = os.path.join(dirname, 'best')
+            if is_best:
+                open(best_fname, 'w').close()
+            elif os.path.exists(best_fname):
+                os.remove(best_fname)
+
+            if dirname in self.saved:
+                self.saved.remove(dirname)
+            self.saved.append(dirname)
+            if is_best:
+                self.best = dirname
+            self._remove_old()
+            if self.logger is not None:
+                self.logger.info('Saved checkpoint %s%s in %.3fs' % (
+                    dirname, ' (best)' if is_best else '', time.time() - start_time))
+        except Exception as e:
+            self._error = e
+
+    def _remove_old(self):
+        if self.keep_last <= 0:
+            return
+        old = [v for v in self.saved[:-self.keep_last] if v != self.best]
+        for dirname in old:
+            shutil.rmtree(dirname, ignore_errors=True)
+            self.saved.remove(dirname)
+
+
+def list_checkpoints(model_path, name_pattern):
+    """CheckpointWriter dirs in model_path with names of name_pattern (regex), 
+    in the order they were written, and the best one (the last one written as best)
+
+    Returns:
+        saved, best, best is None if there is none
+    """
+    if not os.path.isdir(model_path):
+        return [], None
+    saved = [os.path.join(model_path, name) for name in os.listdir(model_path)
+            if re.fullmatch(name_pattern, name)
+            and os.path.exists(os.path.join(model_path, name, 'checkpoint.pt'))]
+    saved.sort(key=lambda v: os.path.getmtime(os.path.join(v, 'checkpoint.pt')))
+    best = [v for v in saved if os.path.exists(os.path.join(v, 'best'))]
+    return saved, best[-1] if best else None
+
+
 def generate_square_subsequent_mask(sz):
     mask = (torch.triu(torch.ones(sz, sz)) == 1).transpose(0, 1)
     mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
     return mask
-     
+
+
+class DecoderCache:
+    """Key/value cache for incremental decoding
+
+    Every decoder layer call has its own dict, layers re-used by num_groups
+    are called several times with different inputs, so they can't share it.
+    The dict keys are the attention names: 'prev' (self attention,
+    appended every step), 'memory' and 'persona' (computed once).
+    """
+    def __init__(self, n_calls):
+        self.layers = [{} for _ in range(n_calls)]
+        # positions already cached
+        self.step = 0
+
+    def __getitem__(self, i):
+        return self.layers[i]
+
+    def __len__(self):
+        return len(self.layers)
+
+    def index_select(self, index):
+        """Keep the batch rows in index (in that order), in place"""
+        for layer in self.layers:
+            for name, (k, v) in layer.items():
+                layer[name] = (k.index_select(0, index), v.index_select(0, index))
+
+
+@dataclass
+class EncoderState:
+    """Encoder outputs of a batch, encode once and decode many steps with it"""
+    __slots__ = ['context_enc', 'persona_enc', 
+            'context_pad_mask', 'persona_pad_mask', 'cache']
+
+    context_enc: torch.Tensor
+    # None when use_mem_n2n
+    persona_enc: torch.Tensor
+    context_pad_mask: torch.Tensor
+    persona_pad_mask: torch.Tensor
+
+    # decoder key/value cache of the decoded steps
+    cache: DecoderCache
+
+    def index_select(self, index):
+        """Keep the batch rows in index (in that order), in place
+
+        Used to drop finished rows while decoding.
+        """
+        self.context_enc = self.context_enc.index_select(1, index)
+        if self.persona_enc is not None:
+            self.persona_enc = self.persona_enc.index_select(1, index)
+        self.context_pad_mask = self.context_pad_mask.index_select(0, index)
+        self.persona_pad_mask = self.persona_pad_mask.index_select(0, index)
+        self.cache.index_select(index)
+
+
+class ResponseBuffer:
+    """Preallocated on device response tokens and masks for decoding
+
+    New tokens are written in place, resp, resp_pad_mask and resp_mask are
+    slices of the decoded positions, the same as the feature fields.
+    All rows decode the same position, so the prefixes in current_output must
+    have one length, ValueError if they are ragged.
+
+    Shape:
+        resp: length X batch_size
+        resp_pad_mask: batch_size X length
+        resp_mask: length X length
+    """
+    def __init__(self, current_output, max_new_length, pad_idx, device):
+        self.pad_idx = pad_idx
+        lengths = set(map(len, current_output))
+        if len(lengths) > 1:
+            raise ValueError('Response prefixes have different lengths %s' % sorted(lengths))
+        self.length = lengths.pop() if lengths else 0
+        max_length = self.length + max_new_length
+        self.tokens = torch.full((max_length, len(current_output)), pad_idx, 
+                dtype=torch.long, device=device)
+        if current_output:
+            self.tokens[:self.length] = pad_sequence(list(map(torch.tensor, current_output)), 
+                    padding_value=pad_idx).to(device)
+        self.pad_mask = (self.tokens == pad_idx).T.contiguous()
+        self.mask = generate_square_subsequent_mask(max_length).to(device)
+
+    @property
+    def resp(self):
+        return self.tokens[:self.length]
+
+    @property
+    def resp_pad_mask(self):
+        return self.pad_mask[:, :self.length]
+
+    @property
+    def resp_mask(self):
+        return self.mask[:self.length, :self.length]
+
+    def append(self, tokens):
+        """tokens: batch_size"""
+        self.tokens[self.length] = tokens
+        self.pad_mask[:, self.length] = tokens == self.pad_idx
+        self.length += 1
+
+    def index_select(self, index):
+        """Keep the batch rows in index (in that order)"""
+        self.tokens = self.tokens.index_select(1, index)
+        self.pad_mask = self.pad_mask.index_select(0, index)
+
+
+def _in_proj(attn, x, i):
+    # i: 0 for query, 1 for key, 2 for value, same as nn.MultiheadAttention in_proj_weight
+    d_model = attn.embed_dim
+    w = attn.in_proj_weight[i*d_model:(i+1)*d_model]
+    b = None if attn.in_proj_bias is None else attn.in_proj_bias[i*d_model:(i+1)*d_model]
+    return F.linear(x, w, b)
+
+
+def cached_multihead_attn(attn, query, key, cache, cache_key,
+        attn_mask=None, key_padding_mask=None, static=False):
+    """nn.MultiheadAttention forward with projected key/value cache
+
+    Same weights and result as attn(query, key, key), but the key/value
+    projections are saved to cache[cache_key]. static keys (encoder outputs)
+    are projected only at the first call, the other keys are appended.
+
+    Shape:
+        query: tgt_len X batch_size X d_model, only the new positions
+        key: src_len X batch_size X d_model, only the new positions if not static
+        attn_mask: tgt_len X total_src_len
+        key_padding_mask: batch_size X total_src_len
+    """
+    n_head = attn.num_heads
+    head_dim = attn.embed_dim // n_head
+    # len X batch_size X d_model --> batch_size X n_head X len X head_dim
+    split_heads = lambda x: x.contiguous().view(
+            x.shape[0], x.shape[1], n_head, head_dim).permute(1, 2, 0, 3)
+
+    q = split_heads(_in_proj(attn, query, 0)) * float(head_dim) ** -0.5
+    if static and cache_key in cache:
+        k, v = cache[cache_key]
+    else:
+        k = split_heads(_in_proj(attn, key, 1))
+        v = split_heads(_in_proj(attn, key, 2))
+        if cache_key in cache:
+            prev_k, prev_v = cache[cache_key]
+            k = torch.cat([prev_k, k], dim=2)
+            v = torch.cat([prev_v, v], dim=2)
+        cache[cache_key] = (k, v)
+
+    # batch_size X n_head X tgt_len X src_len
+    scores = q.matmul(k.transpose(2, 3))
+    if attn_mask is not None:
+        scores = scores + attn_mask
+    if key_padding_mask is not None:
+        scores = scores.masked_fill(key_padding_mask.unsqueeze(1).unsqueeze(2), float('-inf'))
+    weights = F.softmax(scores, dim=-1)
+    weights = F.dropout(weights, p=attn.dropout, training=attn.training)
+
+    out = weights.matmul(v).permute(2, 0, 1, 3)
+    out = out.reshape(out.shape[0], out.shape[1], attn.embed_dim)
+    return attn.out_proj(out)
+
  
 def uniform_init_weights(m):
     for name, param in m.named_parameters():
@@ -479,7 +1355,8 @@ def load_embeddings_and_vocab(vec_fname, vocab_fname):
 def top_filtering(logits, top_k=0., top_p=0.9, threshold=-float('Inf'), filter_value=-float('Inf')):
     """ Filter a distribution of logits using top-k, top-p (nucleus) and/or threshold filtering
         Args:
-            logits: logits distribution shape (vocabulary size)
+            logits: logits distribution shape (vocabulary size) or (batch size, vocabulary size),
+                filtered in place
             top_k: <=0: no filtering, >0: keep only top k tokens with highest probability.
             top_p: <=0.0: no filtering, >0.0: keep only a subset S of candidates, where S is the smallest subset
                 whose total probability mass is greater than or equal to the threshold top_p.
@@ -488,7 +1365,6 @@ def top_filtering(logits, top_k=0., top_p=0.9, threshold=-float('Inf'), filter_v
                 Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
             threshold: a minimal threshold to keep logits
     """
-    assert logits.dim() == 1  # Only work for batch size 1 for now - could update but it would obfuscate a bit the code
     top_k = min(top_k, logits.size(-1))
     if top_k > 0:
         # Remove all tokens with a probability less than the last token in the top-k tokens
@@ -507,7 +1383,7 @@ def top_filtering(logits, top_k=0., top_p=0.9, threshold=-float('Inf'), filter_v
         sorted_indices_to_remove[..., 0] = 0
 
         # Back to unsorted indices and set them to -infinity
-        indices_to_remove = sorted_indices[sorted_indices_to_remove]
+        indices_to_remove = sorted_indices_to_remove.scatter(-1, sorted_indices, sorted_indices_to_remove)
         logits[indices_to_remove] = filter_value
 
     indices_to_remove = logits < threshold
@@ -516,9 +1392,30 @@ def top_filtering(logits, top_k=0., top_p=0.9, threshold=-float('Inf'), filter_v
     return logits
 
 
-def sample_sequence(feature, vocab, model, args, current_output=None):
+def sample_tokens(logits, args, suppress_mask=None):
+    """Sample the next token of every batch row on device, no host sync
+
+    suppress_mask: vocab bool mask of tokens never sampled, e.g. special tokens before min_seq_length
+
+    Shape:
+        logits: batch_size X vocab_size
+        suppress_mask: vocab_size
+        output: batch_size
+    """
+    logits = logits / args.temperature
+    if suppress_mask is not None:
+        logits = logits.masked_fill(suppress_mask, -float('Inf'))
+    logits = top_filtering(logits, top_k=args.top_k, top_p=args.top_p)
+    if args.no_sample:
+        return logits.argmax(dim=-1)
+    probs = F.softmax(logits, dim=-1)
+
+    return torch.multinomial(probs, 1).squeeze(1)
+
+
+def sample_sequence(feature, vocab, model, args, current_output=None, state=None):
     """Copy from https://github.com/huggingface/transfer-learning-conv-ai/blob/master/interact.py
-    For beam search see: https://github.com/atselousov/transformer_chatbot/blob/agent/model/transformer_model.py
+    For beam search see beam_search
 
     Examples:
        >>>  history = []
@@ -534,65 +1431,163 @@ def sample_sequence(feature, vocab, model, args, current_output=None):
        >>>      history = history[-(2*args.max_history+1):]
        >>>      out_text = tokenizer.decode(out_ids, skip_special_tokens=True)
        >>>      print(out_text)
+
+    current_output: response prefixes of the rows, the unfinished ones (not ending 
+           with EOS) must have the same length, see ResponseBuffer
+    state: model.encode_state(feature) result if the caller already has it,
+           its decoder cache must be empty, finished rows are dropped from it
     """
     sos_idx = vocab.stoi(SOS)
     eos_idx = vocab.stoi(EOS)
     special_tokens_ids = [vocab.stoi(k) for k in PRESET_SPECIAL_TOKENS]
     if current_output is None:
         current_output = [[sos_idx] for _ in range(feature.context.shape[1])]
+    # encode once, then every step only decode the new token
+    if state is None:
+        state = model.encode_state(feature)
+
+    device = feature.context.device
+    pad_idx = vocab.stoi(PAD)
+    special_mask = torch.zeros(len(vocab), dtype=torch.bool, device=device)
+    special_mask[special_tokens_ids] = True
+    # current_output index of every row in state, finished rows will not grow anymore
+    rows = [i for i, vs in enumerate(current_output) if vs[-1] != eos_idx]
+    if len(rows) < len(current_output):
+        state.index_select(torch.tensor(rows, dtype=torch.long, device=device))
+    buffer = ResponseBuffer([current_output[i] for i in rows], 
+            args.max_seq_length, pad_idx, device)
+    start_length = buffer.length
+
+    def collect(idx):
+        # append the sampled tokens of batch rows idx to current_output
+        sampled = buffer.tokens[start_length:buffer.length, idx].T.tolist()
+        for i, vs in zip(idx, sampled):
+            current_output[rows[i]].extend(vs)
 
     for seq_i in range(args.max_seq_length):
-        feature = build_input_from_segments(feature, current_output, vocab, with_eos=False)
-
-        batch_logits, _ = model(feature)
-        for batch_idx in range(batch_logits.shape[1]):
-            logits = batch_logits[-1, batch_idx, :] / args.temperature
-            logits = top_filtering(logits, top_k=args.top_k, top_p=args.top_p)
-            probs = F.softmax(logits, dim=-1)
-
-            prev = torch.topk(probs, 1)[1] if args.no_sample else torch.multinomial(probs, 1)
-            if seq_i < args.min_seq_length and prev.item() in special_tokens_ids:
-                while prev.item() in special_tokens_ids:
-                    if probs.max().item() == 1:
-                        if current_output[batch_idx][-1] != eos_idx:
-                            current_output[batch_idx].append(eos_idx)
-                        print("Warning: model generating special token with probability 1.")
-                        break  # avoid infinitely looping over special token
-                    prev = torch.multinomial(probs, num_samples=1)
-
-            if prev.item() in special_tokens_ids:
-                if current_output[batch_idx][-1] != eos_idx:
-                    current_output[batch_idx].append(eos_idx)
-                continue
-            if current_output[batch_idx][-1] != eos_idx:
-                current_output[batch_idx].append(prev.item())
+        if not rows:
+            break
+        start_pos = state.cache.step
+        batch_logits = model.decode_step(state, buffer.resp[start_pos:], 
+                buffer.resp_pad_mask, buffer.resp_mask[start_pos:])
+        # special tokens can not be sampled before min_seq_length,
+        # after that any special token ends the resp
+        prev = sample_tokens(batch_logits[-1], args,
+                special_mask if seq_i < args.min_seq_length else None)
+        prev = prev.masked_fill(special_mask[prev], eos_idx)
+        buffer.append(prev)
+
+        done = (prev == eos_idx).tolist()
+        if not any(done):
+            continue
+        # drop finished rows from the batch
+        collect([i for i, d in enumerate(done) if d])
+        keep = [i for i, d in enumerate(done) if not d]
+        index = torch.tensor(keep, dtype=torch.long, device=device)
+        state.index_select(index)
+        buffer.index_select(index)
+        rows = [rows[i] for i in keep]
+    # rows reached max_seq_length
+    collect(list(range(len(rows))))
 
     current_output = [vs[1:] if vs[-1] == eos_idx else vs[1:] + [eos_idx]
                       for vs in current_output]
-    pad_idx = vocab.stoi(PAD)
-    padded = [vs + [pad_idx] * (args.max_seq_length+1 - len(vs))
+    # longer with the given prefixes
+    width = max([args.max_seq_length + 1] + [len(vs) for vs in current_output])
+    padded = [vs + [pad_idx] * (width - len(vs))
               for vs in current_output]
     padded = torch.tensor(padded).T
 
     return current_output, padded
 
 
-def build_input_from_segments(feature, current_output, vocab, with_eos=False):
-    pad_idx = vocab.stoi(PAD)
+def beam_search(feature, vocab, model, args, state=None):
+    """Batched beam search, all beams of all rows are decoded as one batch
 
-    resp_pad = pad_sequence(list(map(torch.tensor, current_output)), 
-            padding_value=pad_idx)
-    resp_mask = generate_square_subsequent_mask(resp_pad.shape[0])
-    resp_pad_mask = (resp_pad == pad_idx).T
+    args.beam_size beams are kept for every row, candidates are ranked by
+    log prob / ((5 + len) / 6) ** args.length_penalty, the length penalty in
+    Wu et al. (https://arxiv.org/abs/1609.08144), 0 for no penalty.
+    EOS is not generated before args.min_seq_length, other special tokens never.
+
+    state: model.encode_state(feature) result if the caller already has it,
+           its decoder cache must be empty, it is expanded to the beams
+
+    Returns the best beam of every row, the same as sample_sequence
+    """
+    sos_idx = vocab.stoi(SOS)
+    eos_idx = vocab.stoi(EOS)
+    pad_idx = vocab.stoi(PAD)
+    special_tokens_ids = [vocab.stoi(k) for k in PRESET_SPECIAL_TOKENS]
+    # encode once, the beams of a row share the encoder outputs
+    if state is None:
+        state = model.encode_state(feature)
 
     device = feature.context.device
-    feature.resp = resp_pad.to(device)
-    feature.resp_mask = resp_mask.to(device)
-    feature.resp_pad_mask = resp_pad_mask.to(device)
+    batch_size = state.context_pad_mask.shape[0]
+    beam_size = args.beam_size
+    vocab_size = len(vocab)
+    # every beam is a row in state: batch_size*beam_size rows
+    state.index_select(torch.arange(batch_size, device=device).repeat_interleave(beam_size))
+
+    special_mask = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+    special_mask[special_tokens_ids] = True
+    special_no_eos_mask = special_mask.clone()
+    special_no_eos_mask[eos_idx] = False
+    # finished beams can only be followed by pad, and keep their score
+    finished_log_probs = torch.full((vocab_size,), -float('Inf'), device=device)
+    finished_log_probs[pad_idx] = 0
+
+    buffer = ResponseBuffer([[sos_idx]] * (batch_size*beam_size), 
+            args.max_seq_length, pad_idx, device)
+    # all beams start the same, only expand the first one at the first step
+    scores = torch.full((batch_size, beam_size), -float('Inf'), device=device)
+    scores[:, 0] = 0
+    # generated tokens of every beam, EOS included
+    lengths = torch.zeros(batch_size, beam_size, device=device)
+    finished = torch.zeros(batch_size, beam_size, dtype=torch.bool, device=device)
+    beam_offset = torch.arange(batch_size, device=device).unsqueeze(1) * beam_size
+    length_penalty = lambda lengths: ((5 + lengths) / 6) ** args.length_penalty
+
+    for seq_i in range(args.max_seq_length):
+        start_pos = state.cache.step
+        logits = model.decode_step(state, buffer.resp[start_pos:], buffer.resp_pad_mask)[-1]
+        log_probs = F.log_softmax(logits, dim=-1)
+        log_probs = log_probs.masked_fill(special_mask if seq_i < args.min_seq_length 
+                else special_no_eos_mask, -float('Inf'))
+        log_probs = torch.where(finished.view(-1, 1), finished_log_probs, log_probs)
+
+        # batch_size X beam_size X vocab_size
+        cand_scores = scores.unsqueeze(2) + log_probs.view(batch_size, beam_size, vocab_size)
+        cand_lengths = torch.where(finished, lengths, lengths + 1)
+        cand_ranks = cand_scores / length_penalty(cand_lengths).unsqueeze(2)
+        # batch_size X beam_size
+        top = cand_ranks.view(batch_size, -1).topk(beam_size, dim=-1)[1]
+        beam_idx = torch.div(top, vocab_size, rounding_mode='floor')
+        tokens = top % vocab_size
+
+        scores = cand_scores.view(batch_size, -1).gather(1, top)
+        lengths = cand_lengths.gather(1, beam_idx)
+        finished = finished.gather(1, beam_idx) | (tokens == eos_idx)
+        rows = (beam_offset + beam_idx).view(-1)
+        state.index_select(rows)
+        buffer.index_select(rows)
+        buffer.append(tokens.view(-1))
+        if finished.all():
+            break
+
+    best = (scores / length_penalty(lengths)).argmax(dim=-1)
+    rows = beam_offset.squeeze(1) + best
+    current_output = []
+    for vs in buffer.resp[1:, rows].T.tolist():
+        vs = [k for k in vs if k != pad_idx]
+        current_output.append(vs if vs and vs[-1] == eos_idx else vs + [eos_idx])
+    padded = [vs + [pad_idx] * (args.max_seq_length+1 - len(vs))
+              for vs in current_output]
+    padded = torch.tensor(padded).T
+
+    return current_output, padded
 
-    return feature
 
- 
 def create_logger(log_path, name):
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)